@@ -0,0 +1,105 @@
+"""
+TF-IDF cosine vs precomputed sparse BM25: latency and Precision@5.
+
+Precision@5 uses the judgements in eval/eval_queries.csv, collected on
+the filter engine's TF-IDF top 5 with the inferred filters applied, so
+both rankings run the same way (--filter-policy auto). Retrieved
+documents nobody judged count as not relevant; the number of judged hits
+is printed alongside, since BM25 can only look worse for surfacing
+unjudged documents.
+
+If rank-bm25 is installed, its per-document Python scoring is timed on
+the same tokens for reference (rankings differ: it only sees unigrams).
+
+Usage (from the repo root, index built with `python src/idx_tfidf.py --bm25`):
+    python benchmarks/bench_bm25.py [--repeat 200] [--k 5] [--filter-policy auto]
+"""
+
+import sys
+sys.path.append("src")
+
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+import pandas as pd
+
+from filter_search import FilterMontessoriSearchEngine
+from idx_tfidf import preprocess_text
+
+EVAL_FILE = "eval/eval_queries.csv"
+
+
+def precision_at_k(engine, judgements, ranking, k, filter_policy):
+    rows = []
+    for query, q_df in judgements.groupby("query", sort=False):
+        relevant = dict(zip(q_df["doc_id"], q_df["relevant"]))
+        hits = engine.search(query, k=k, filter_policy=filter_policy, fields=["doc_id"], ranking=ranking)
+        ids = [h["doc_id"] for h in hits]
+        rows.append({
+            "query": query,
+            "ranking": ranking,
+            "precision@k": sum(relevant.get(d, 0) for d in ids) / k,
+            "judged": sum(d in relevant for d in ids),
+        })
+    return pd.DataFrame(rows)
+
+
+def latency(fn, queries, repeat):
+    times = []
+    for _ in range(repeat):
+        for q in queries:
+            start = time.perf_counter()
+            fn(q)
+            times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return np.percentile(times, 50), np.percentile(times, 95)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--filter-policy", default="auto", choices=["auto", "off"])
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = FilterMontessoriSearchEngine()
+    if engine.bm25_scorer is None:
+        raise SystemExit("no BM25 index, build it with: python src/idx_tfidf.py --bm25")
+
+    judgements = pd.read_csv(EVAL_FILE)
+    queries = list(judgements["query"].unique())
+
+    metrics = pd.concat([
+        precision_at_k(engine, judgements, ranking, args.k, args.filter_policy)
+        for ranking in ("tfidf", "bm25")
+    ])
+    print("=== Per-Query Results ===")
+    print(metrics.to_string(index=False))
+
+    print(f"\n=== Precision@{args.k} / latency per query (ms) ===")
+    for ranking in ("tfidf", "bm25"):
+        p50, p95 = latency(
+            lambda q: engine.search(
+                q, k=args.k, filter_policy=args.filter_policy, fields=["doc_id"], ranking=ranking
+            ),
+            queries, args.repeat,
+        )
+        mean_p = metrics.loc[metrics["ranking"] == ranking, "precision@k"].mean()
+        print(f"{ranking:<8} P@{args.k} {mean_p:.3f}   p50 {p50:.3f}   p95 {p95:.3f}")
+
+    try:
+        from rank_bm25 import BM25Okapi
+    except ImportError:
+        print("\n(rank-bm25 not installed, skipping the per-document reference)")
+    else:
+        tokens = [t.split() for t in engine.corpus["text"].map(preprocess_text)]
+        bm25 = BM25Okapi(tokens)
+        p50, p95 = latency(
+            lambda q: np.argsort(bm25.get_scores(preprocess_text(q).split()))[::-1][:args.k],
+            queries, max(1, args.repeat // 20),
+        )
+        print(f"{'rank-bm25':<8} (per-document Python)   p50 {p50:.3f}   p95 {p95:.3f}")
@@ -0,0 +1,162 @@
+"""
+Dense (LSA + IVF) search: recall against exact search, latency per nprobe.
+
+Recall@k compares the IVF results over quantised vectors with an exact
+float32 search over the same LSA embeddings, so it measures what the
+index gives up (quantisation + only probing some lists), not LSA itself.
+
+--synthetic N builds an index over N random sparse documents (drawn
+from 200 "topics") in a temporary directory instead, to check build
+time, peak memory and query latency at a larger scale.
+
+Usage (from the repo root, index built with `python src/idx_tfidf.py --dense`):
+    python benchmarks/bench_dense.py [--k 10] [--repeat 50]
+    python benchmarks/bench_dense.py --synthetic 1000000 [--quantization float16]
+"""
+
+import sys
+sys.path.append("src")
+
+import argparse
+import contextlib
+import io
+import resource
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from dense import DEFAULT_NPROBE, QUANTIZATIONS, DenseIndex, embed, write_dense_index
+from idx_tfidf import preprocess_text
+from segments import vectorize
+from topk import top_k_rows
+
+EVAL_FILE = "eval/eval_queries.csv"
+NPROBES = [1, 2, 4, DEFAULT_NPROBE, 16, 32]
+
+
+def recall_and_latency(index, query_matrix, kth, exact_scores, k, repeat):
+    """
+    :param kth: exact k-th best score of every query
+    :param exact_scores: (query number, doc ids) -> their exact scores
+    -----
+    A hit counts as recalled when its exact score reaches the k-th best
+    (near-duplicate documents make the exact top-k id set arbitrary).
+    """
+    rows = []
+    q_emb = index.embed(query_matrix)
+    for nprobe in [n for n in NPROBES if n < index.nlist] + [index.nlist]:
+        found = [index.search_one(q, k, nprobe=nprobe)[0] for q in q_emb]
+        recall = np.mean([
+            np.sum(exact_scores(i, ids) >= kth[i] - 1e-6) / k for i, ids in enumerate(found)
+        ])
+
+        times = []
+        for _ in range(repeat):
+            for i in range(query_matrix.shape[0]):
+                start = time.perf_counter()
+                index.top_k(query_matrix[i], k, nprobe=nprobe)
+                times.append(time.perf_counter() - start)
+        times = np.array(times) * 1000
+        rows.append({
+            "nprobe": nprobe,
+            f"recall@{k}": recall,
+            "p50_ms": np.percentile(times, 50),
+            "p95_ms": np.percentile(times, 95),
+        })
+    return pd.DataFrame(rows)
+
+
+def corpus_benchmark(args):
+    from basic_search import BasicMontessoriSearchEngine
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = BasicMontessoriSearchEngine()
+    if engine.dense_index is None:
+        raise SystemExit("no dense index, build it with: python src/idx_tfidf.py --dense")
+
+    index = engine.dense_index
+    queries = list(pd.read_csv(EVAL_FILE)["query"].unique())
+    query_matrix = vectorize(engine.vectorizer, [preprocess_text(q) for q in queries])
+
+    scores = index.embed(query_matrix) @ embed(engine.tfidf_matrix, index.components).T
+    _, top = top_k_rows(scores, args.k)
+
+    print(f"{len(engine.store)} docs, {index.codes.shape[1]} dims, {index.nlist} lists, "
+          f"{index.codes.dtype} codes ({index.codes.nbytes / 1e6:.1f} MB)")
+    metrics = recall_and_latency(
+        index, query_matrix, top[:, -1], lambda i, ids: scores[i, ids], args.k, args.repeat
+    )
+    print(metrics.to_string(index=False))
+
+
+def synthetic_corpus(rng, n_docs, nnz_per_doc, n_features=30_000, n_topics=200, topic_share=0.8):
+    """
+    Random sparse documents with some structure to find: each one draws
+    most of its terms from its topic's slice of the vocabulary.
+    """
+    block = n_features // n_topics
+    topics = rng.integers(0, n_topics, n_docs)
+    n_topical = int(nnz_per_doc * topic_share)
+    cols = np.concatenate([
+        topics[:, None] * block + rng.integers(0, block, (n_docs, n_topical)),
+        rng.integers(0, n_features, (n_docs, nnz_per_doc - n_topical)),
+    ], axis=1)
+    indptr = np.arange(0, n_docs * nnz_per_doc + 1, nnz_per_doc)
+    matrix = csr_matrix((rng.random(cols.size), cols.ravel(), indptr), shape=(n_docs, n_features))
+    matrix.sum_duplicates()
+    return matrix
+
+
+def synthetic_benchmark(args):
+    rng = np.random.default_rng(0)
+    matrix = synthetic_corpus(rng, args.synthetic, args.nnz_per_doc)
+    queries = synthetic_corpus(rng, 50, 5)
+
+    with tempfile.TemporaryDirectory() as dense_dir:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        start = time.perf_counter()
+        manifest = write_dense_index(
+            matrix, {"build_id": "synthetic"}, dense_dir,
+            n_components=args.dims, quantization=args.quantization,
+        )
+        build_s = time.perf_counter() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        index = DenseIndex.from_dir(dense_dir, manifest)
+        print(f"{args.synthetic} docs, {manifest['dims']} dims, {manifest['nlist']} lists, "
+              f"{args.quantization} codes ({index.codes.nbytes / 1e6:.1f} MB)")
+        print(f"build {build_s:.1f}s, peak RSS {rss_before:.0f} -> {rss_after:.0f} MB "
+              f"(input matrix {(matrix.data.nbytes + matrix.indices.nbytes) / 1e6:.0f} MB)")
+
+        # exact k-th best scores over the float32 embeddings, in chunks
+        q_emb = index.embed(queries)
+        best = np.empty((len(q_emb), 0))
+        for start in range(0, matrix.shape[0], 50_000):
+            chunk = q_emb @ embed(matrix[start:start + 50_000], index.components).T
+            _, best = top_k_rows(np.concatenate([best, chunk], axis=1), args.k)
+
+        metrics = recall_and_latency(
+            index, queries, best[:, -1],
+            lambda i, ids: embed(matrix[ids], index.components) @ q_emb[i],
+            args.k, args.repeat,
+        )
+        print(metrics.to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--synthetic", type=int, default=0, help="number of random documents")
+    parser.add_argument("--nnz-per-doc", type=int, default=40)
+    parser.add_argument("--dims", type=int, default=128)
+    parser.add_argument("--quantization", default="int8", choices=QUANTIZATIONS)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        synthetic_benchmark(args)
+    else:
+        corpus_benchmark(args)
@@ -0,0 +1,89 @@
+"""
+Cost and effect of search(..., diversify=...) for growing candidate
+counts N: time of the "diversify" stage alone and of the whole search,
+distinct source files in the top k, mean pairwise TF-IDF cosine of the
+top k (lower = more diverse) and Precision@k on the judged queries.
+
+Judgements (eval/eval_queries.csv) were collected on the TF-IDF top 5,
+so unjudged hits count as not relevant and the judged hits are printed
+too: diversified lists trade some of the judged hits for unjudged ones.
+
+Usage (from the repo root):
+    python benchmarks/bench_diversify.py [--repeat 20] [--k 5] [--n 50 100 200 500]
+"""
+
+import sys
+sys.path.append("src")
+
+import argparse
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+
+from filter_search import FilterMontessoriSearchEngine
+
+EVAL_FILE = "eval/eval_queries.csv"
+
+
+def intra_list_similarity(engine, doc_ids):
+    sim = engine.diversifier.similarities(doc_ids)
+    n = len(doc_ids)
+    return (sim.sum() - np.trace(sim)) / (n * (n - 1)) if n > 1 else 0.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--n", type=int, nargs="+", default=[50, 100, 200, 500])
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = FilterMontessoriSearchEngine()
+
+    judgements = pd.read_csv(EVAL_FILE)
+    relevant = {
+        q: dict(zip(q_df["doc_id"], q_df["relevant"]))
+        for q, q_df in judgements.groupby("query", sort=False)
+    }
+
+    source_codes = np.asarray(engine.store.factorize("source_file")[0])
+
+    configs = [(None, args.k)] + [(m, n) for m in ("mmr", "source") for n in args.n]
+    rows = []
+    for method, n in configs:
+        engine.diversifier.n_candidates = n
+        stage_ms, total_ms = [], []
+        for _ in range(args.repeat):
+            for query in relevant:
+                hits = engine.search(query, k=args.k, filter_policy="off", fields=["doc_id"], trace=True,
+                                     diversify=method)
+                stage_ms.append(hits.trace.stages.get("diversify", 0.0))
+                total_ms.append(hits.trace.total_ms)
+
+        precision, judged, sources, ils = [], [], [], []
+        for query, rel in relevant.items():
+            hits = engine.search(query, k=args.k, filter_policy="off", fields=["doc_id"],
+                                 diversify=method)
+            ids = [h["doc_id"] for h in hits]
+            precision.append(sum(rel.get(d, 0) for d in ids) / args.k)
+            judged.append(sum(d in rel for d in ids))
+            indices = np.array([h.index for h in hits])
+            sources.append(len(set(source_codes[indices])))
+            ils.append(intra_list_similarity(engine, indices))
+
+        rows.append({
+            "diversify": method or "-",
+            "N": n,
+            "stage_p50_ms": np.percentile(stage_ms, 50),
+            "stage_p95_ms": np.percentile(stage_ms, 95),
+            "search_p50_ms": np.percentile(total_ms, 50),
+            "sources": np.mean(sources),
+            "ils": np.mean(ils),
+            f"P@{args.k}": np.mean(precision),
+            "judged": np.mean(judged),
+        })
+
+    print(pd.DataFrame(rows).to_string(index=False))
@@ -0,0 +1,121 @@
+"""
+Row-by-row vs column-wise passage metadata inference (merge_corpora.load_passages).
+
+The legacy iterrows()/apply() implementation is kept here as the reference:
+both versions must produce identical frames before any timing is reported.
+
+Usage (from the repo root):
+    python benchmarks/bench_load_passages.py [--scale 10] [--workers 4] [--repeat 3]
+"""
+
+import sys
+sys.path.append("src")
+
+import argparse
+import time
+
+import pandas as pd
+
+import merge_corpora
+from merge_corpora import (
+    PASSAGE_FILE,
+    build_passage_indexed_text,
+    contains_material,
+    detect_citation,
+    read_passage_table,
+)
+
+
+def legacy_load_passages(df):
+    """
+    load_passages() as it was before vectorisation, on an already loaded frame.
+    """
+    df = df.copy()
+    approaches, evidence_types, domains = [], [], []
+
+    for i, row in df.iterrows():
+        filename = row["source_file"]
+        text = row["text"]
+
+        if filename.startswith("cleaned_ch"):
+            approaches.append("Traditional" if "traditional" in text.lower() else "Montessori")
+        else:
+            approaches.append(None)
+
+        if filename.startswith("research-paper"):
+            evidence_types.append("Study")
+        elif contains_material(text):
+            evidence_types.append("Material")
+        elif detect_citation(text):
+            evidence_types.append("Study")
+        else:
+            evidence_types.append("Example")
+
+        if filename.startswith("research-paper"):
+            domains.append("Cognitive")
+        elif evidence_types[-1] == "Study":
+            domains.append("Behavioral/Cognitive")
+        else:
+            domains.append(None)
+
+    df["approach"] = approaches
+    df["evidence_type"] = evidence_types
+    df["domain"] = domains
+    df["raw_text"] = df["text"]
+    df["text"] = df.apply(build_passage_indexed_text, axis=1)
+    return df
+
+
+def vectorised_load_passages(df, workers=1, chunk_size=20000):
+    """
+    the current load_passages(), fed the same in-memory frame.
+    """
+    original = merge_corpora.read_passage_table
+    merge_corpora.read_passage_table = lambda path: df.copy()
+    try:
+        return merge_corpora.load_passages(workers=workers, chunk_size=chunk_size)
+    finally:
+        merge_corpora.read_passage_table = original
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=1, help="replicate the passage table N times")
+    parser.add_argument("--workers", type=int, default=4, help="process pool size for the chunked mode")
+    parser.add_argument("--chunk-size", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    df = read_passage_table(PASSAGE_FILE)
+    df = pd.concat([df] * args.scale, ignore_index=True)
+    print(f"{len(df)} passages ({PASSAGE_FILE} x{args.scale})")
+
+    legacy_t, legacy = best_of(lambda: legacy_load_passages(df), args.repeat)
+    columns = list(vectorised_load_passages(df.head(1)).columns)
+    legacy = legacy[columns]
+
+    runs = [("row-by-row (iterrows)", legacy_t, legacy)]
+    runs.append(("column-wise", *best_of(lambda: vectorised_load_passages(df), args.repeat)))
+    if args.workers > 1:
+        runs.append((
+            f"column-wise, {args.workers} workers",
+            *best_of(lambda: vectorised_load_passages(df, args.workers, args.chunk_size), args.repeat),
+        ))
+
+    for name, _, out in runs[1:]:
+        if not out.equals(legacy):
+            diff = (out != legacy) & ~(out.isna() & legacy.isna())
+            raise SystemExit(f"{name}: output differs from the row-by-row version in {diff.any(axis=1).sum()} rows")
+
+    print("outputs identical\n")
+    for name, t, _ in runs:
+        print(f"{name:<32} {t * 1000:9.1f} ms   x{legacy_t / t:5.1f}")
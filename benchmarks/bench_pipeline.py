@@ -0,0 +1,88 @@
+"""
+Multi-stage pipeline configurations: Precision@5, latency, and what the
+latency budget did to the rerank stages.
+
+Judgements (eval/eval_queries.csv) were collected on the TF-IDF top 5
+with the inferred filters applied; unjudged hits count as not relevant,
+so the number of judged hits is printed too.
+
+Usage (from the repo root; BM25/dense stages need `python src/idx_tfidf.py --bm25 --dense`):
+    python benchmarks/bench_pipeline.py [--repeat 50] [--k 5] [--budget-ms 1.5]
+"""
+
+import sys
+sys.path.append("src")
+
+import argparse
+import contextlib
+import io
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from filter_search import FilterMontessoriSearchEngine
+from pipeline import BM25Rerank, DenseRerank, MetadataBoost, SearchPipeline
+
+EVAL_FILE = "eval/eval_queries.csv"
+
+
+def configs(engine, budget_ms):
+    return {
+        "tfidf": SearchPipeline(engine, []),
+        "tfidf > bm25": SearchPipeline(engine, [BM25Rerank(1.0)]),
+        "tfidf > dense": SearchPipeline(engine, [DenseRerank(0.5)]),
+        "tfidf > bm25 > dense > meta": SearchPipeline(
+            engine, [BM25Rerank(0.5), DenseRerank(0.5), MetadataBoost(0.2)], n_candidates=200
+        ),
+        f"same, {budget_ms}ms budget": SearchPipeline(
+            engine, [BM25Rerank(0.5), DenseRerank(0.5), MetadataBoost(0.2)],
+            n_candidates=200, budget_ms=budget_ms,
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=1.5)
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = FilterMontessoriSearchEngine()
+
+    judgements = pd.read_csv(EVAL_FILE)
+    relevant = {
+        q: dict(zip(q_df["doc_id"], q_df["relevant"]))
+        for q, q_df in judgements.groupby("query", sort=False)
+    }
+
+    rows = []
+    for name, pipeline in configs(engine, args.budget_ms).items():
+        precision, judged, times = [], [], []
+        statuses = Counter()
+        for _ in range(args.repeat):
+            for query, rel in relevant.items():
+                start = time.perf_counter()
+                hits, report = pipeline.search(query, k=args.k, fields=["doc_id"])
+                times.append(time.perf_counter() - start)
+                statuses.update(f"{r.stage} {r.status}" for r in report[1:] if r.status != "ran")
+
+        for query, rel in relevant.items():
+            ids = [h["doc_id"] for h in pipeline.search(query, k=args.k, fields=["doc_id"])[0]]
+            precision.append(sum(rel.get(d, 0) for d in ids) / args.k)
+            judged.append(sum(d in rel for d in ids))
+
+        times = np.array(times) * 1000
+        rows.append({
+            "pipeline": name,
+            f"P@{args.k}": np.mean(precision),
+            "judged": np.mean(judged),
+            "p50_ms": np.percentile(times, 50),
+            "p95_ms": np.percentile(times, 95),
+            "budget": ", ".join(f"{s} x{n}" for s, n in sorted(statuses.items())) or "-",
+        })
+
+    print(pd.DataFrame(rows).to_string(index=False))
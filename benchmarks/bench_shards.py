@@ -0,0 +1,78 @@
+"""
+Sharded scoring: single-query latency against the number of shards,
+and a check that the results equal the unsharded scorer's.
+
+Runs on N random sparse documents (see bench_dense.synthetic_corpus),
+sharded into a temporary directory, so no index needs to be built.
+Latency only drops with shards when there are cores to run them on.
+
+Usage (from the repo root):
+    python benchmarks/bench_shards.py [--docs 500000] [--shards 1,2,4,8] [--executor process]
+"""
+
+import sys
+sys.path.append("src")
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from bench_dense import synthetic_corpus
+from index_store import compute_row_norms
+from shards import EXECUTORS, ShardedIndex, write_shards
+from topk import PostingsScorer
+
+
+def latency(scorer, queries, k, repeat):
+    times = []
+    for _ in range(repeat):
+        for i in range(queries.shape[0]):
+            start = time.perf_counter()
+            scorer.top_k(queries[i], k)
+            times.append(time.perf_counter() - start)
+    return np.array(times) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=500_000)
+    parser.add_argument("--nnz-per-doc", type=int, default=40)
+    parser.add_argument("--shards", default="1,2,4,8")
+    parser.add_argument("--executor", default="process", choices=EXECUTORS)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrix = synthetic_corpus(rng, args.docs, args.nnz_per_doc)
+    queries = synthetic_corpus(rng, 50, 5)
+    print(f"{args.docs} docs, {matrix.nnz} postings, {os.cpu_count()} cpus, executor={args.executor}")
+
+    unsharded = PostingsScorer.from_matrix(matrix, compute_row_norms(matrix))
+    expected = [unsharded.top_k(queries[i], args.k) for i in range(queries.shape[0])]
+    times = latency(unsharded, queries, args.k, args.repeat)
+    rows = [{"shards": "-", "p50_ms": np.percentile(times, 50), "p95_ms": np.percentile(times, 95),
+             "identical": True}]
+
+    for n_shards in [int(n) for n in args.shards.split(",")]:
+        with tempfile.TemporaryDirectory() as shards_dir:
+            manifest = write_shards(matrix, {"build_id": "synthetic"}, shards_dir, n_shards)
+            index = ShardedIndex(shards_dir, manifest, executor=args.executor, workers=n_shards)
+            scorer = index.scorer("tfidf")
+            try:
+                results = [scorer.top_k(queries[i], args.k) for i in range(queries.shape[0])]
+                identical = all(
+                    np.array_equal(ids, e_ids) and np.array_equal(scores, e_scores)
+                    for (ids, scores), (e_ids, e_scores) in zip(results, expected)
+                )
+                times = latency(scorer, queries, args.k, args.repeat)
+            finally:
+                index.close()
+        rows.append({"shards": n_shards, "p50_ms": np.percentile(times, 50),
+                     "p95_ms": np.percentile(times, 95), "identical": identical})
+
+    print(pd.DataFrame(rows).to_string(index=False))
@@ -0,0 +1,91 @@
+"""
+In-memory TfidfVectorizer.fit_transform vs the chunked two-pass build
+(tfidf_build.build_tfidf_chunked), on the corpus replicated --scale times.
+
+Both must give the same vocabulary and idf and the same matrix (up to
+float rounding in the row norms) before any timing is reported. Each
+build runs in its own process so its peak RSS is its own; the chunked
+build's workers are measured separately (largest worker).
+
+Usage (from the repo root):
+    python benchmarks/bench_tfidf_build.py [--scale 10] [--workers 4] [--chunk-size 20000]
+"""
+
+import sys
+sys.path.append("src")
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from idx_tfidf import CORPUS_FILE, TFIDF_PARAMS, preprocess_text
+from tfidf_build import build_tfidf_chunked
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def in_memory(corpus_file):
+    start = time.perf_counter()
+    df = pd.read_csv(corpus_file)
+    vectorizer = TfidfVectorizer(**TFIDF_PARAMS)
+    matrix = vectorizer.fit_transform(df["text"].apply(preprocess_text))
+    return time.perf_counter() - start, peak_rss_mb(), vectorizer, matrix
+
+
+def chunked(corpus_file, workers, chunk_size):
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        start = time.perf_counter()
+        vectorizer, matrix, _ = build_tfidf_chunked(
+            corpus_file, TFIDF_PARAMS, preprocess_text, scratch_dir, workers=workers, chunk_size=chunk_size
+        )
+        elapsed = time.perf_counter() - start
+        rss, worker_rss = peak_rss_mb(), peak_rss_mb(resource.RUSAGE_CHILDREN)
+        # off the scratch memmaps before they are deleted (not measured)
+        matrix = matrix.copy()
+    return elapsed, rss, worker_rss, vectorizer, matrix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=20_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_file = os.path.join(tmp, "corpus.csv")
+        df = pd.read_csv(CORPUS_FILE)
+        copies = [df.assign(doc_id=df["doc_id"].astype(str) + f"_r{i}") for i in range(args.scale)]
+        pd.concat(copies, ignore_index=True).to_csv(corpus_file, index=False)
+        del df, copies
+        print(f"{args.scale}x corpus, {args.workers} workers, chunks of {args.chunk_size}")
+
+        # one fresh process per build, for honest peak RSS
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            mem_s, mem_rss, ref_vec, ref_matrix = pool.submit(in_memory, corpus_file).result()
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            chunk_s, chunk_rss, worker_rss, vec, matrix = pool.submit(
+                chunked, corpus_file, args.workers, args.chunk_size
+            ).result()
+
+    assert vec.vocabulary_ == ref_vec.vocabulary_, "vocabulary differs"
+    assert np.array_equal(vec.idf_, ref_vec.idf_), "idf differs"
+    assert matrix.shape == ref_matrix.shape
+    diff = abs(matrix - ref_matrix).max()
+    assert diff < 1e-12, f"matrix differs by {diff}"
+
+    print(pd.DataFrame([
+        {"build": "fit_transform", "seconds": mem_s, "peak_rss_mb": mem_rss, "worker_peak_rss_mb": None},
+        {"build": "chunked", "seconds": chunk_s, "peak_rss_mb": chunk_rss, "worker_peak_rss_mb": worker_rss},
+    ]).to_string(index=False))
+    print(f"identical vocabulary ({len(vec.vocabulary_)} terms) and idf, max |diff| {diff:.2e}")
@@ -0,0 +1,29 @@
+"""
+Reproducible build/search performance suite.
+
+Every measurement runs in a fresh Python process inside a scratch
+directory holding its own data/full_corpus.csv (the repo's corpus,
+optionally replicated N times), so nothing under the repo's models/ is
+touched and each process's peak memory is its own:
+
+    build        build_tfidf_index() wall time + peak RSS
+    cold_start   import + engine construction + first query, per engine
+    latency      single-query p50/p95/p99 per ranking
+    throughput   queries/s, one at a time and with search_many batches
+
+Queries are the ones in eval/eval_queries.txt plus queries sampled from
+the built vocabulary (seeded, see queries.py). Results are written as
+JSON; `compare` flags metrics that got worse than a stored baseline by
+more than a threshold (exit status 1, for CI).
+
+Usage (from the repo root):
+    python -m benchmarks.perf run --out benchmarks/results/current.json [--scales 1,10,100] [--quick]
+    python -m benchmarks.perf compare benchmarks/results/baseline.json benchmarks/results/current.json [--threshold 0.2]
+
+Layout:
+    __main__.py   command line (run / compare)
+    runner.py     scratch directories, replicated corpora, worker processes
+    worker.py     the measurements themselves (python -m benchmarks.perf.worker)
+    queries.py    eval + vocabulary-sampled query sets
+    compare.py    flattening results and flagging regressions
+"""
@@ -0,0 +1,89 @@
+"""
+python -m benchmarks.perf run | compare   (see __init__.py)
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from .compare import compare
+from .runner import run_suite
+
+
+def cmd_run(args):
+    options = {
+        "bm25": args.bm25,
+        "dense": args.dense,
+        "build_workers": args.build_workers,
+        "k": args.k,
+        "n_sampled": 20 if args.quick else args.n_sampled,
+        "seed": args.seed,
+        "repeat": 1 if args.quick else args.repeat,
+        "warmup": 5,
+        "cold_runs": 1 if args.quick else args.cold_runs,
+        "batch_sizes": [32, 256],
+    }
+    scales = [int(s) for s in args.scales.split(",")]
+
+    results = run_suite(scales, options, log=lambda msg: print(msg, file=sys.stderr))
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.out}", file=sys.stderr)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        return report(json.load(open(args.baseline)), results, args.threshold)
+    return 0
+
+
+def report(baseline, current, threshold):
+    rows = compare(baseline, current, threshold)
+    regressions = [r for r in rows if r["regression"]]
+
+    for r in rows:
+        flag = "REGRESSION" if r["regression"] else ""
+        print(f"{r['metric']:<48} {r['baseline']:>12.4g} -> {r['current']:>12.4g}  {r['change']:+7.1%}  {flag}")
+    print(f"\n{len(regressions)} regression(s) over {threshold:.0%} in {len(rows)} metrics")
+    return 1 if regressions else 0
+
+
+def cmd_compare(args):
+    baseline = json.load(open(args.baseline))
+    current = json.load(open(args.current))
+    return report(baseline, current, args.threshold)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.perf")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="measure and write JSON results")
+    run.add_argument("--out", help="results file (default: stdout)")
+    run.add_argument("--scales", default="1,10", help="corpus replication factors, e.g. 1,10,100")
+    run.add_argument("--bm25", action="store_true", help="also build/measure BM25")
+    run.add_argument("--dense", action="store_true", help="also build/measure the dense index")
+    run.add_argument("--build-workers", type=int, default=0,
+                     help="build the TF-IDF matrix out of core over N processes (idx_tfidf.py --workers)")
+    run.add_argument("--k", type=int, default=5)
+    run.add_argument("--n-sampled", type=int, default=200, help="vocabulary-sampled queries")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--repeat", type=int, default=5)
+    run.add_argument("--cold-runs", type=int, default=3)
+    run.add_argument("--quick", action="store_true", help="fewer queries and repeats")
+    run.add_argument("--baseline", help="also compare against this results file")
+    run.add_argument("--threshold", type=float, default=0.2)
+    run.set_defaults(func=cmd_run)
+
+    cmp = sub.add_parser("compare", help="flag regressions against a baseline")
+    cmp.add_argument("baseline")
+    cmp.add_argument("current")
+    cmp.add_argument("--threshold", type=float, default=0.2, help="relative change counted as a regression")
+    cmp.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,54 @@
+"""
+Regression check of a results file against a baseline.
+"""
+
+# metric names ending like this are better when higher; everything
+# else measured (seconds, ms, MB) is better when lower
+HIGHER_IS_BETTER = ("_qps",)
+
+# counts describing the run, not performance
+NOT_METRICS = ("n_docs", "n_queries")
+
+
+def flatten(results, prefix=""):
+    """
+    {"x1": {"build": {"wall_s": 1.2}}} -> {"x1.build.wall_s": 1.2}
+    """
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and key not in NOT_METRICS:
+            flat[name] = float(value)
+    return flat
+
+
+def compare(baseline, current, threshold=0.2, min_ms=0.05):
+    """
+    :param baseline, current: suite outputs (runner.run_suite)
+    :param threshold: relative change counted as a regression
+    :param min_ms: ignore *_ms metrics whose baseline is below this (noise)
+    -----
+    RETURNS list of dicts (metric, baseline, current, change, regression),
+    change > 0 meaning worse
+    """
+    base = flatten(baseline["results"])
+    cur = flatten(current["results"])
+
+    rows = []
+    for metric in sorted(base.keys() & cur.keys()):
+        b, c = base[metric], cur[metric]
+        if b == 0 or (metric.endswith("_ms") and b < min_ms):
+            continue
+        change = (c - b) / abs(b)
+        if metric.endswith(HIGHER_IS_BETTER):
+            change = -change
+        rows.append({
+            "metric": metric,
+            "baseline": b,
+            "current": c,
+            "change": change,
+            "regression": change > threshold,
+        })
+    return rows
@@ -0,0 +1,32 @@
+"""
+Query sets: the eval queries plus a seeded sampler over the vocabulary.
+"""
+
+import numpy as np
+
+
+def eval_queries(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def vocabulary_queries(vectorizer, doc_freq, n, seed=0, min_terms=1, max_terms=4):
+    """
+    n queries of min_terms..max_terms unigrams from the vectorizer's
+    vocabulary, drawn in proportion to their document frequency (so they
+    look like real queries rather than lists of rare words).
+    -----
+    :param doc_freq: document frequency of every feature (len(vocabulary))
+    """
+    rng = np.random.default_rng(seed)
+    terms = vectorizer.get_feature_names_out()
+    unigrams = np.flatnonzero(np.char.find(terms.astype(str), " ") < 0)
+
+    weights = np.asarray(doc_freq, dtype=np.float64)[unigrams]
+    weights /= weights.sum()
+
+    queries = []
+    for length in rng.integers(min_terms, max_terms + 1, n):
+        picked = rng.choice(unigrams, size=length, replace=False, p=weights)
+        queries.append(" ".join(terms[picked]))
+    return queries
@@ -0,0 +1,114 @@
+"""
+Scratch directories with (replicated) corpora, and the worker processes
+measuring them.
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CORPUS_FILE = os.path.join(REPO_ROOT, "data", "full_corpus.csv")
+EVAL_FILE = os.path.join(REPO_ROOT, "eval", "eval_queries.txt")
+
+ENGINES = ["basic", "filter"]
+
+
+def replicate_corpus(corpus_file, scale, out_file):
+    """
+    The corpus repeated scale times; copies get "_r<i>" doc_id suffixes
+    so ids stay unique. (Vocabulary and idf are those of the original,
+    with every count multiplied.)
+    """
+    df = pd.read_csv(corpus_file)
+    copies = [df] + [df.assign(doc_id=df["doc_id"].astype(str) + f"_r{i}") for i in range(1, scale)]
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    pd.concat(copies, ignore_index=True).to_csv(out_file, index=False)
+
+
+def run_worker(task, args, workdir):
+    """
+    RETURNS the worker's JSON result; raises RuntimeError if it failed
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.join(REPO_ROOT, "src"), REPO_ROOT] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    proc = subprocess.run(
+        [sys.executable, "-m", "benchmarks.perf.worker", task, json.dumps(args)],
+        cwd=workdir, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"worker {task} failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_scale(scale, options, log=print):
+    """
+    Build + measure one corpus size in a scratch directory.
+    """
+    workdir = tempfile.mkdtemp(prefix=f"perf_x{scale}_")
+    try:
+        replicate_corpus(CORPUS_FILE, scale, os.path.join(workdir, "data", "full_corpus.csv"))
+
+        log(f"[x{scale}] build")
+        result = {"build": run_worker("build", {
+            "bm25": options["bm25"], "dense": options["dense"], "workers": options.get("build_workers", 0),
+        }, workdir)}
+
+        result["cold_start"] = {}
+        for engine in ENGINES:
+            log(f"[x{scale}] cold start ({engine})")
+            runs = [run_worker("cold_start", {"engine": engine}, workdir) for _ in range(options["cold_runs"])]
+            # median run, so one slow process start doesn't decide it
+            result["cold_start"][engine] = sorted(runs, key=lambda r: r["load_s"])[len(runs) // 2]
+
+        result["search"] = {}
+        for engine in ENGINES:
+            log(f"[x{scale}] latency / throughput ({engine})")
+            result["search"][engine] = run_worker("search", {
+                "engine": engine,
+                "eval_file": EVAL_FILE,
+                "n_sampled": options["n_sampled"],
+                "seed": options["seed"],
+                "k": options["k"],
+                "repeat": options["repeat"],
+                "warmup": options["warmup"],
+                "batch_sizes": options["batch_sizes"],
+            }, workdir)
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_suite(scales, options, log=print):
+    return {
+        "meta": {**machine_info(), "options": options, "scales": scales},
+        "results": {f"x{scale}": run_scale(scale, options, log) for scale in scales},
+    }
@@ -0,0 +1,152 @@
+"""
+One measurement per process, run by runner.py inside a scratch
+directory (cwd) with src/ on the path:
+
+    python -m benchmarks.perf.worker <task> '<json args>'
+
+Prints a single JSON object on the last line of stdout.
+"""
+
+import contextlib
+import io
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+    }
+
+
+def load_engine(name):
+    if name == "basic":
+        from basic_search import BasicMontessoriSearchEngine
+        return BasicMontessoriSearchEngine()
+    from filter_search import FilterMontessoriSearchEngine
+    return FilterMontessoriSearchEngine()
+
+
+def search_one(engine, name, query, k, ranking):
+    if name == "basic":
+        return engine.search(query, k=k, fields=["doc_id"], ranking=ranking)
+    return engine.search(query, k=k, filter_policy="auto", fields=["doc_id"], ranking=ranking)
+
+
+def query_set(engine, args):
+    from .queries import eval_queries, vocabulary_queries
+
+    queries = eval_queries(args["eval_file"])
+    doc_freq = np.diff(engine.scorer.indptr)[:len(engine.vectorizer.vocabulary_)]
+    queries += vocabulary_queries(engine.vectorizer, doc_freq, args["n_sampled"], seed=args["seed"])
+    return queries
+
+
+# ----------------------------------------------
+# TASKS
+# ----------------------------------------------
+
+def task_build(args):
+    rss_before = peak_rss_mb()
+    from idx_tfidf import build_tfidf_index
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        build_tfidf_index(bm25=args["bm25"], dense=args["dense"], workers=args.get("workers", 0))
+    return {
+        "wall_s": time.perf_counter() - start,
+        "peak_rss_mb": peak_rss_mb(),
+        "import_rss_mb": rss_before,
+        "worker_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def task_cold_start(args):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = load_engine(args["engine"])
+    loaded = time.perf_counter()
+    search_one(engine, args["engine"], "montessori classroom", 5, "tfidf")
+    first = time.perf_counter()
+    return {
+        "load_s": loaded - start,
+        "first_query_ms": (first - loaded) * 1000,
+        "rss_mb": peak_rss_mb(),
+        "n_docs": len(engine.store),
+    }
+
+
+def task_search(args):
+    name = args["engine"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = load_engine(name)
+    queries = query_set(engine, args)
+
+    rankings = ["tfidf"]
+    if engine.bm25_scorer is not None:
+        rankings.append("bm25")
+    if engine.dense_index is not None:
+        rankings.append("dense")
+
+    latency = {}
+    for ranking in rankings:
+        for q in queries[:args["warmup"]]:
+            search_one(engine, name, q, args["k"], ranking)
+        times = []
+        for _ in range(args["repeat"]):
+            for q in queries:
+                start = time.perf_counter()
+                search_one(engine, name, q, args["k"], ranking)
+                times.append(time.perf_counter() - start)
+        latency[ranking] = percentiles(times)
+
+    n_total = len(queries) * args["repeat"]
+    throughput = {}
+    start = time.perf_counter()
+    for _ in range(args["repeat"]):
+        for q in queries:
+            search_one(engine, name, q, args["k"], "tfidf")
+    throughput["sequential_qps"] = n_total / (time.perf_counter() - start)
+
+    for batch_size in args["batch_sizes"]:
+        start = time.perf_counter()
+        for _ in range(args["repeat"]):
+            for i in range(0, len(queries), batch_size):
+                batch = queries[i:i + batch_size]
+                if name == "basic":
+                    engine.search_many(batch, k=args["k"], fields=["doc_id"])
+                else:
+                    engine.search_many(batch, k=args["k"], filters="auto", fields=["doc_id"])
+        throughput[f"batch{batch_size}_qps"] = n_total / (time.perf_counter() - start)
+
+    return {
+        "n_queries": len(queries),
+        "latency": latency,
+        "throughput": throughput,
+        "rss_mb": peak_rss_mb(),
+    }
+
+
+TASKS = {
+    "build": task_build,
+    "cold_start": task_cold_start,
+    "search": task_search,
+}
+
+
+if __name__ == "__main__":
+    task, args = sys.argv[1], json.loads(sys.argv[2])
+    print(json.dumps(TASKS[task](args)))
@@ -0,0 +1,267 @@
+"""
+Non-interactive batch evaluation: every judged query is run through the
+batched search path (search_many) of one or more engine configurations,
+and P@k, Recall@k, MRR and nDCG@k are computed over all queries at once
+(numpy over a (queries x depth) matrix of relevance grades), next to
+each query's latency.
+
+Configurations are "<engine>-<ranking>": engine "basic" or "filter"
+(inferred filters applied, filter_policy="auto"), ranking "tfidf",
+"bm25" or "dense" (see topk.RANKINGS; bm25 / dense need idx_tfidf.py
+--bm25 / --dense). Each one runs in its own worker process.
+
+Qrels:
+    csv   query,doc_id,relevant   (eval/eval_queries.csv; relevant may be a grade)
+    trec  qid iter doc_id grade   (whitespace separated) + --topics file
+          with "qid<TAB>query text" lines
+
+Documents without a judgment count as not relevant. Recall and nDCG are
+relative to the judged relevant documents, so with shallow judgments
+(like eval_queries.csv: the top 5 of one system) they are optimistic.
+
+Usage (from the repo root):
+    python eval/batch_eval.py
+    python eval/batch_eval.py --configs filter-tfidf filter-bm25 basic-tfidf --k 1 5 10
+    python eval/batch_eval.py --qrels run.qrels --topics run.topics --per-query per_query.csv
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.append("src")
+
+
+QRELS_FILE = "eval/eval_queries.csv"
+DEFAULT_CONFIGS = ["filter-tfidf", "basic-tfidf"]
+DEFAULT_KS = [1, 5, 10]
+ENGINES = ("basic", "filter")
+
+
+# ----------------------------------------------
+# QRELS
+# ----------------------------------------------
+
+def load_qrels(path, topics=None, fmt="auto"):
+    """
+    :param path: qrels file, csv (query,doc_id,relevant) or TREC
+    :param topics: TREC only, file of "qid<TAB>query" lines
+    :param fmt: "csv", "trec" or "auto" (csv if the file has a header with "query")
+    -----
+    RETURNS (queries, judgments): query strings in file order and, per
+    query, a dict doc_id -> grade
+    """
+    if fmt == "auto":
+        with open(path, encoding="utf-8") as f:
+            first = f.readline()
+        fmt = "csv" if "query" in first.split(",")[0].lower() else "trec"
+
+    if fmt == "csv":
+        df = pd.read_csv(path)
+        df["doc_id"] = df["doc_id"].astype(str)
+        judgments = {}
+        for query, doc_id, grade in zip(df["query"], df["doc_id"], df["relevant"]):
+            judgments.setdefault(query, {})[doc_id] = int(grade)
+        return list(judgments), list(judgments.values())
+
+    if topics is None:
+        raise ValueError("TREC qrels need a --topics file (qid<TAB>query)")
+    with open(topics, encoding="utf-8") as f:
+        query_of = dict(line.rstrip("\n").split("\t", 1) for line in f if line.strip())
+
+    judgments = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            qid, _, doc_id, grade = line.split()
+            judgments.setdefault(qid, {})[doc_id] = int(grade)
+
+    missing = [qid for qid in judgments if qid not in query_of]
+    if missing:
+        raise ValueError(f"no topic for qids {missing[:5]}")
+    return [query_of[qid] for qid in judgments], list(judgments.values())
+
+
+# ----------------------------------------------
+# METRICS
+# ----------------------------------------------
+
+def relevance_matrix(ranked, judgments, depth):
+    """
+    RETURNS (grades, ideal): (n_queries x depth) grades of the ranked
+    documents, and of the best possible ranking (judged grades sorted)
+    """
+    grades = np.zeros((len(ranked), depth))
+    ideal = np.zeros((len(ranked), depth))
+    for i, (doc_ids, judged) in enumerate(zip(ranked, judgments)):
+        row = [judged.get(d, 0) for d in doc_ids[:depth]]
+        grades[i, :len(row)] = row
+        best = sorted(judged.values(), reverse=True)[:depth]
+        ideal[i, :len(best)] = best
+    return grades, ideal
+
+
+def ir_metrics(grades, ideal, ks):
+    """
+    Per-query metrics from relevance_matrix(), all queries at once.
+    -----
+    RETURNS dict metric name -> array over queries (nan where undefined,
+    e.g. recall of a query without relevant documents)
+    """
+    depth = grades.shape[1]
+    relevant = grades > 0
+    hits = np.cumsum(relevant, axis=1)
+    n_relevant = (ideal > 0).sum(axis=1)
+
+    discounts = 1 / np.log2(np.arange(2, depth + 2))
+    dcg = np.cumsum((2 ** grades - 1) * discounts, axis=1)
+    idcg = np.cumsum((2 ** ideal - 1) * discounts, axis=1)
+
+    first = relevant.argmax(axis=1)
+    metrics = {"mrr": np.where(relevant.any(axis=1), 1 / (first + 1), 0.0)}
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for k in ks:
+            metrics[f"p@{k}"] = hits[:, k - 1] / k
+            metrics[f"recall@{k}"] = np.where(n_relevant > 0, hits[:, k - 1] / n_relevant, np.nan)
+            metrics[f"ndcg@{k}"] = np.where(idcg[:, k - 1] > 0, dcg[:, k - 1] / idcg[:, k - 1], np.nan)
+    return metrics
+
+
+# ----------------------------------------------
+# RUNNING CONFIGURATIONS
+# ----------------------------------------------
+
+def parse_config(name):
+    engine, _, ranking = name.partition("-")
+    if engine not in ENGINES or not ranking:
+        raise ValueError(f"config must be <engine>-<ranking> with engine in {ENGINES}, got {name!r}")
+    return engine, ranking
+
+
+def run_config(name, queries, depth, latency=True, batch_size=256):
+    """
+    Worker: load the engine, rank all queries with search_many() and, if
+    latency, time each query through search() too.
+    -----
+    RETURNS dict with name, ranked doc_ids per query, latency_ms per
+    query (or None), batch_s, and error (None unless the config failed)
+    """
+    engine_name, ranking = parse_config(name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if engine_name == "basic":
+            from basic_search import BasicMontessoriSearchEngine
+            engine = BasicMontessoriSearchEngine()
+            batch_kwargs, search_kwargs = {}, {}
+        else:
+            from filter_search import FilterMontessoriSearchEngine
+            engine = FilterMontessoriSearchEngine()
+            batch_kwargs, search_kwargs = {"filters": "auto"}, {"filter_policy": "auto"}
+
+    try:
+        start = time.perf_counter()
+        results = engine.search_many(
+            queries, k=depth, batch_size=batch_size, fields=["doc_id"], ranking=ranking, **batch_kwargs
+        )
+        batch_s = time.perf_counter() - start
+    except ValueError as e:
+        return {"name": name, "error": str(e)}
+
+    latency_ms = None
+    if latency:
+        latency_ms = []
+        for query in queries:
+            start = time.perf_counter()
+            engine.search(query, k=depth, fields=["doc_id"], ranking=ranking, **search_kwargs)
+            latency_ms.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "name": name,
+        "error": None,
+        "ranked": [[h["doc_id"] for h in hits] for hits in results],
+        "latency_ms": latency_ms,
+        "batch_s": batch_s,
+    }
+
+
+def evaluate(configs, queries, judgments, ks=DEFAULT_KS, workers=None, latency=True):
+    """
+    Run every configuration (in parallel worker processes) and score it.
+    -----
+    RETURNS (summary, per_query) DataFrames: one row per configuration,
+    and one per (configuration, query)
+    """
+    depth = max(ks)
+    workers = workers or min(len(configs), os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        runs = list(pool.map(
+            run_config, configs, [queries] * len(configs), [depth] * len(configs), [latency] * len(configs)
+        ))
+
+    summary, per_query = [], []
+    for run in runs:
+        if run["error"]:
+            print(f"[{run['name']}] skipped: {run['error']}", file=sys.stderr)
+            continue
+
+        grades, ideal = relevance_matrix(run["ranked"], judgments, depth)
+        metrics = ir_metrics(grades, ideal, ks)
+
+        frame = pd.DataFrame({"config": run["name"], "query": queries, **metrics})
+        row = {"config": run["name"], "n_queries": len(queries)}
+        row.update({m: float(np.nanmean(v)) if not np.isnan(v).all() else None for m, v in metrics.items()})
+        row["batch_qps"] = len(queries) / run["batch_s"]
+        if run["latency_ms"] is not None:
+            frame["latency_ms"] = run["latency_ms"]
+            row["p50_ms"] = float(np.percentile(run["latency_ms"], 50))
+            row["p95_ms"] = float(np.percentile(run["latency_ms"], 95))
+        summary.append(row)
+        per_query.append(frame)
+
+    per_query = pd.concat(per_query, ignore_index=True) if per_query else pd.DataFrame()
+    return pd.DataFrame(summary), per_query
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch IR evaluation over judged queries")
+    parser.add_argument("--qrels", default=QRELS_FILE)
+    parser.add_argument("--topics", help="TREC qrels only: qid<TAB>query file")
+    parser.add_argument("--format", choices=["auto", "csv", "trec"], default="auto")
+    parser.add_argument("--configs", nargs="+", default=DEFAULT_CONFIGS,
+                        help="<engine>-<ranking>, e.g. filter-tfidf basic-bm25 filter-dense")
+    parser.add_argument("--k", type=int, nargs="+", default=DEFAULT_KS, help="cutoffs")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per config, up to #cpus)")
+    parser.add_argument("--no-latency", action="store_true", help="skip the per-query timing pass")
+    parser.add_argument("--per-query", help="write per-query metrics + latency to this csv")
+    parser.add_argument("--json", help="write the summary to this json file")
+    args = parser.parse_args()
+
+    for name in args.configs:
+        parse_config(name)
+    queries, judgments = load_qrels(args.qrels, args.topics, args.format)
+    print(f"{len(queries)} judged queries, {sum(len(j) for j in judgments)} judgments\n")
+
+    summary, per_query = evaluate(
+        args.configs, queries, judgments, ks=sorted(args.k), workers=args.workers, latency=not args.no_latency
+    )
+
+    print("=== Summary (means over queries) ===")
+    print(summary.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+    if args.per_query:
+        per_query.to_csv(args.per_query, index=False)
+        print(f"\nPer-query results written to {args.per_query}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary.to_dict(orient="records"), f, indent=2)
+        print(f"Summary written to {args.json}")
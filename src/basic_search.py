@@ -1,16 +1,11 @@
-import pickle
-import numpy as np
 import sys
-from sklearn.metrics.pairwise import cosine_similarity
 from idx_tfidf import preprocess_text
+from hits import build_hits, build_hits_many
+from snippets import highlight
+from engine_base import SearchEngineBase
 
 
-VECTORIZER_FILE = "models/tfidf_vectorizer.pkl"
-MATRIX_FILE = "models/tfidf_matrix.pkl"
-CORPUS_FILE = "models/corpus_processed.pkl"
-
-
-class BasicMontessoriSearchEngine:
+class BasicMontessoriSearchEngine(SearchEngineBase):
     """
     BasicMontessoriSearchEngine:
     Class to perform a basic query returning top-k ranked documents
@@ -20,44 +15,107 @@ class BasicMontessoriSearchEngine:
     """
     def __init__(self):
         print("Loading TF-IDF index...")
-        self.vectorizer = pickle.load(open(VECTORIZER_FILE, "rb"))
-        self.tfidf_matrix = pickle.load(open(MATRIX_FILE, "rb"))
-        self.corpus = pickle.load(open(CORPUS_FILE, "rb"))
+        self._load_index()
 
-        print(f"Loaded {len(self.corpus)} documents.")
+        print(f"Loaded {len(self.store)} documents.")
         print("Search engine ready.\n")
 
     # TO DO FOR ADVANCED MODEL: filters for approach="Montessori", domain="Cognitive", evidence_type="Study"
-    def search(self, query, k=5):
-        processed = preprocess_text(query)
-        query_vec = self.vectorizer.transform([processed])
+    def search(self, query, k=5, fields=None, ranking="tfidf", trace=False, snippets=False, collapse=False,
+               diversify=None, group_by=None):
+        """
+        Top-k documents for a query, as lazy Hits (see hits.py).
+        -----
+        :param fields: fields the hits expose, default all of RESULT_FIELDS;
+            hits only read a field from the corpus when it is accessed
+        :param ranking: "tfidf" (cosine), "bm25" (needs idx_tfidf.py --bm25)
+            or "dense" (LSA, approximate; needs idx_tfidf.py --dense)
+        :param trace: attach this query's stage times and counters as
+            results.trace (see instrumentation.py)
+        :param snippets: give every hit a "snippet": the passage window
+            with the most query terms, highlighted (see snippets.py)
+        :param collapse: one hit per near-duplicate cluster (the best
+            scoring), if there is a duplicate map (see dedup.py)
+        :param diversify: "mmr" or "source": pick the k hits from the
+            top diversifier.n_candidates for diversity (see diversify.py)
+        :param group_by: "source_file" or "source_title": the best hit of
+            each of the k best groups of matches instead, each with a
+            "group" entry {"field", "value", "n_hits"} (see grouping.py);
+            results.groups gives the documents and groups matched
+        """
+        self._check_group_by(group_by, diversify)
 
-        scores = cosine_similarity(query_vec, self.tfidf_matrix).flatten()
-        valid_indices = np.arange(len(scores))
+        with self.instrumentation.start() as timer:
+            processed = preprocess_text(query)
+            timer.mark("preprocess")
+            scorer, query_vec = self._ranking([processed], ranking)
+            timer.mark("vectorize")
 
-        # ranking
-        filtered_scores = scores[valid_indices]
-        top_k_idx = np.argsort(filtered_scores)[::-1][:k]
-        actual_indices = valid_indices[top_k_idx]
+            # ranking (term-at-a-time over the postings, see topk.py)
+            if group_by:
+                _, (top_k, top_scores, values, n_hits, summary) = self._top_groups(
+                    scorer, query_vec, group_by, k, self.live_mask, timer, collapse
+                )
+            else:
+                n_fetch = self.diversifier.fetch(diversify, k)
+                top_k, top_scores = self._top_k(scorer, query_vec, n_fetch, self.live_mask, timer, collapse)
+            if diversify:
+                top_k, top_scores = self.diversifier.rerank(diversify, top_k, top_scores, k)
+                timer.mark("diversify")
+            results = build_hits(self.store, top_k, top_scores, fields)
+            if group_by:
+                self.grouper.attach(results, group_by, values, n_hits)
+                results.groups = summary
+            timer.mark("hits")
+            if snippets:
+                self.snippets.attach(results, query_vec.indices)
+                timer.mark("snippets")
+            results.trace = timer.finish(trace)
+        return results
 
-        results = []
-        for idx in actual_indices:
-            row = self.corpus.iloc[idx]
-            results.append({
-                "score": float(scores[idx]),
-                "doc_id": row["doc_id"],
-                "text": row["text"],
-                "raw_text": row["raw_text"],
-                "approach": row["approach"],
-                "domain": row["domain"],
-                "evidence_type": row["evidence_type"],
-                "source_title": row["source_title"],
-                "source_type": row["source_type"],
-                "paragraph_index": row["paragraph_index"]
-            })
+    def search_many(self, queries, k=5, batch_size=256, fields=None, ranking="tfidf", trace=False, snippets=False,
+                    collapse=False, diversify=None):
+        """
+        Batched version of search(): all queries are preprocessed and
+        vectorized together and scored with one sparse matrix product
+        per batch.
+        -----
+        :param queries: list of query strings
+        :param k: number of results per query
+        :param batch_size: queries per scoring batch (bounds memory)
+        :param fields: as for search()
+        :param ranking: as for search()
+        :param trace: attach the batch's trace to every result list
+        :param snippets: as for search()
+        :param collapse: as for search()
+        :param diversify: as for search()
+        -----
+        RETURNS one result list (as from search()) per query
+        """
+        with self.instrumentation.start(n_queries=len(queries)) as timer:
+            processed = [preprocess_text(q) for q in queries]
+            timer.mark("preprocess")
+            scorer, query_matrix = self._ranking(processed, ranking)
+            timer.mark("vectorize")
 
+            n_fetch = self.diversifier.fetch(diversify, k)
+            ranked = self._top_k_many(scorer, query_matrix, n_fetch, self.live_mask, batch_size, collapse)
+            timer.mark("score")
+            if diversify:
+                ranked = [self.diversifier.rerank(diversify, ids, scores, k) for ids, scores in ranked]
+                timer.mark("diversify")
+            results = build_hits_many(self.store, ranked, fields)
+            timer.mark("hits")
+            if snippets:
+                for i, hits in enumerate(results):
+                    self.snippets.attach(hits, query_matrix[i].indices)
+                timer.mark("snippets")
+            batch_trace = timer.finish(trace)
+        for r in results:
+            r.trace = batch_trace
         return results
-    
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Query needed! Run:\n  python basic_search.py 'your query here.'")
@@ -68,7 +126,7 @@ if __name__ == "__main__":
     print("\nSearching for relevant texts...")
 
     engine = BasicMontessoriSearchEngine()
-    results = engine.search(query, k=5)
+    results = engine.search(query, k=5, snippets=True)
 
     for i, r in enumerate(results, 1):
         print(f"\n--- Result {i} ---")
@@ -79,5 +137,5 @@ if __name__ == "__main__":
             print(f"Approach: {r['approach']}")
         if r["domain"] is not None and str(r["domain"]).lower() != "nan":
             print(f"Domain: {r['domain']}")
-        print(f"Text: {r['raw_text'][:min(500, len(r['raw_text']))]}...")
+        print(f"Text: {highlight(r['snippet'])}")
     print("\n=== END SEARCH ===\n")
\ No newline at end of file
@@ -2,9 +2,16 @@ import os
 import glob
 import pandas as pd
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 TEXT_DIR = "text-data/"
 CORP_FILE = "data/corpus.csv"
+CHUNK_SIZE = 5000   # passages per written chunk
+
+PASSAGE_COLUMNS = [
+    "doc_id", "source_file", "source_title", "paragraph_index", "text", "source_type"
+]
 
 
 def clean_text(text):
@@ -53,46 +60,148 @@ def clean_title(filename):
     return title
 
 
-def build_passage_corpus():
-    records = []
-    filepaths = glob.glob(os.path.join(TEXT_DIR, "*.txt"))
-    
-    for filepath in filepaths:
+# ----------------------------------------------
+# STREAMING PIPELINE
+# ----------------------------------------------
+
+def process_file(filepath):
+    """
+    Read (once), validate, clean, segment and title a single file.
+    Runs in a worker process.
+    -----
+    :param filepath: path of a .txt file
+    -----
+    RETURNS (filepath, passage records, error message or None)
+    """
+    try:
         with open(filepath, "r", encoding="utf-8") as f:
             raw_text = f.read()
-        
-        cleaned = clean_text(raw_text)
-        passages = split_into_passages(cleaned)
-        source_title = clean_title(filepath)
-
-        for i, passage in enumerate(passages):
-            records.append({
-                "doc_id": f"{os.path.basename(filepath)}_p{i}",
-                "source_file": os.path.basename(filepath),
-                "source_title": source_title,
-                "paragraph_index": i,
-                "text": passage,
-                "source_type": "full_text_passage"
-            })
-
-    df = pd.DataFrame(records)
-    os.makedirs("data", exist_ok=True)
-    df.to_csv(CORP_FILE, index=False)
-    print(f"Saved {len(df)} passages to {CORP_FILE}")
-
+    except Exception as e:
+        return filepath, [], f"{type(e).__name__}: {e}"
+
+    cleaned = clean_text(raw_text)
+    passages = split_into_passages(cleaned)
+    source_title = clean_title(filepath)
+    filename = os.path.basename(filepath)
+
+    records = [
+        {
+            "doc_id": f"{filename}_p{i}",
+            "source_file": filename,
+            "source_title": source_title,
+            "paragraph_index": i,
+            "text": passage,
+            "source_type": "full_text_passage"
+        }
+        for i, passage in enumerate(passages)
+    ]
+    return filepath, records, None
+
+
+def iter_passages(filepaths, workers=None):
+    """
+    Generator over passage records, files processed in a process pool.
+    -----
+    :param filepaths: .txt files, passages come out in this order
+    :param workers: pool size (default: all cores); 1 = no pool
+    -----
+    At most 2 x workers files are in flight, so memory stays bounded
+    no matter how many files there are.
+    """
+    workers = workers or os.cpu_count() or 1
 
-if __name__ == "__main__":
+    def report(filepath, error):
+        if error is None:
+            print(f"OK: {filepath}")
+        else:
+            print(f"ERROR in file: {filepath}")
+            print(f"  {error}")
+
+    if workers == 1:
+        for filepath in filepaths:
+            filepath, records, error = process_file(filepath)
+            report(filepath, error)
+            yield from records
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        paths = iter(filepaths)
+
+        for filepath in paths:
+            pending.append(pool.submit(process_file, filepath))
+            if len(pending) >= 2 * workers:
+                break
+
+        while pending:
+            filepath, records, error = pending.popleft().result()
+            report(filepath, error)
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append(pool.submit(process_file, next_path))
+            yield from records
+
+
+def iter_chunks(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield pd.DataFrame(chunk, columns=PASSAGE_COLUMNS)
+            chunk = []
+    if chunk:
+        yield pd.DataFrame(chunk, columns=PASSAGE_COLUMNS)
+
+
+def write_chunks(chunks, out_file):
+    """
+    Write DataFrame chunks as they come: appended to a csv, or as row
+    groups of a Parquet file if out_file ends in .parquet (needs pyarrow).
+    -----
+    RETURNS number of rows written
+    """
+    os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+    total = 0
 
-    TEXT_DIR = "text-data/"
-    filepaths = glob.glob(os.path.join(TEXT_DIR, "*.txt"))
+    if out_file.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
 
-    for filepath in filepaths:
+        writer = None
         try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                f.read()
-            print(f"OK: {filepath}")
-        except Exception as e:
-            print(f"ERROR in file: {filepath}")
-            print(f"  {type(e).__name__}: {e}")
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(out_file, table.schema)
+                writer.write_table(table)
+                total += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            pd.DataFrame(columns=PASSAGE_COLUMNS).to_parquet(out_file, index=False)
+        return total
+
+    pd.DataFrame(columns=PASSAGE_COLUMNS).to_csv(out_file, index=False)
+    for chunk in chunks:
+        chunk.to_csv(out_file, mode="a", header=False, index=False)
+        total += len(chunk)
+    return total
+
+
+def build_passage_corpus(out_file=CORP_FILE, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Stream every .txt file in TEXT_DIR through the pipeline into out_file.
+    -----
+    :param out_file: .csv (default) or .parquet
+    :param workers: process pool size (default: all cores)
+    :param chunk_size: passages held in memory before a chunk is written
+    """
+    filepaths = sorted(glob.glob(os.path.join(TEXT_DIR, "*.txt")))
+    passages = iter_passages(filepaths, workers=workers)
+    total = write_chunks(iter_chunks(passages, chunk_size), out_file)
+    print(f"Saved {total} passages to {out_file}")
+
 
-    build_passage_corpus()
\ No newline at end of file
+if __name__ == "__main__":
+    build_passage_corpus()
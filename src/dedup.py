@@ -0,0 +1,402 @@
+"""
+Near-duplicate detection between corpus documents (MinHash + LSH).
+
+The Y Montessori excerpts are cut from the same book chapters that
+build_corpus.py segments into passages, so most excerpts reappear
+(nearly) verbatim inside a passage, and both tend to rank next to each
+other. Excerpts are usually shorter than the passage holding them, so
+documents are compared by containment (share of the smaller document's
+shingles found in the larger one) rather than by Jaccard similarity.
+
+    shingles     5-word shingles of preprocess_text(raw_text), hashed to
+                 uint64 (token ids + splitmix64, no Python string hashing)
+    MinHash      N_PERM minimums of multiply-shift hashes per document
+    LSH          BANDS bands of 2 rows: documents sharing a band bucket
+                 are candidate pairs (a Jaccard of 0.2 collides with
+                 p = 0.93, and contained excerpts have Jaccard ~ their
+                 length ratio). Buckets larger than MAX_BUCKET (boiler-
+                 plate) are skipped
+    verify       exact containment of each candidate pair from the
+                 sorted shingle hashes, kept if >= CONTAINMENT
+    clusters     stars: going from the longest document down, every
+                 unassigned document contained in it becomes its
+                 duplicate, so a dropped document's text is always
+                 (>= CONTAINMENT) part of its canonical one. Usually a
+                 passage absorbs excerpts; an excerpt spanning several
+                 short passages absorbs them
+
+All of it is linear in the corpus size plus the candidate pairs.
+
+The duplicate map (data/duplicates.csv: doc_id, canonical_id,
+containment) is used in two ways:
+
+    merge time   merge_corpora.build_full_corpus(dedup=True) drops the
+                 duplicates; the canonical row keeps its doc_id and text,
+                 with the curated tags of the excerpts in its cluster
+                 (approach, evidence_type, merged domain, excerpt header)
+                 and the location of its passages (source_file,
+                 source_title, paragraph_index)
+    query time   with the rows kept, the engines collapse hits of one
+                 cluster to the best scoring one (search(..., collapse=True))
+
+Usage:
+    python src/dedup.py [--corpus data/full_corpus.csv] [--map data/duplicates.csv] [--collapse-to FILE]
+"""
+
+import argparse
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+from idx_tfidf import preprocess_text
+from topk import fill_with_zero_scores, top_k_indices
+
+
+DUPLICATES_FILE = "data/duplicates.csv"
+CORPUS_FILE = "data/full_corpus.csv"
+
+SHINGLE_SIZE = 5        # words per shingle
+N_PERM = 128            # MinHash permutations
+BANDS = 64              # LSH bands of N_PERM // BANDS rows
+MAX_BUCKET = 500        # skip LSH buckets with more documents than this
+CONTAINMENT = 0.8       # share of the smaller document inside the larger
+SEED = 0
+
+DOMAIN_SEP = "/"
+EXCERPT_MARKER = "Excerpt: "
+
+
+# ----------------------------------------------
+# SHINGLES / MINHASH
+# ----------------------------------------------
+
+def _mix64(x):
+    """
+    splitmix64 finaliser over a uint64 array (wrapping arithmetic)
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def shingle_hashes(texts, k=SHINGLE_SIZE):
+    """
+    RETURNS per document, the sorted distinct uint64 hashes of its k-word
+    shingles (a document shorter than k words is one shingle; empty
+    documents get none)
+    """
+    vocabulary = {}
+    shingles = []
+    powers = _mix64(np.arange(1, k + 1, dtype=np.uint64))
+    for text in texts:
+        ids = np.array(
+            [vocabulary.setdefault(w, len(vocabulary) + 1) for w in preprocess_text(text).split()],
+            dtype=np.uint64,
+        )
+        if len(ids) == 0:
+            shingles.append(np.empty(0, dtype=np.uint64))
+            continue
+        width = min(k, len(ids))
+        windows = np.lib.stride_tricks.sliding_window_view(ids, width)
+        with np.errstate(over="ignore"):
+            shingles.append(np.unique(_mix64((windows * powers[:width]).sum(axis=1, dtype=np.uint64))))
+    return shingles
+
+
+def minhash_signatures(shingles, n_perm=N_PERM, seed=SEED):
+    """
+    RETURNS (n_docs x n_perm) uint32 MinHash signatures (all bits set
+    for documents without shingles; those are never verified as
+    duplicates)
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 63, size=n_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 63, size=n_perm, dtype=np.uint64)
+    signatures = np.full((len(shingles), n_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    with np.errstate(over="ignore"):
+        for i, h in enumerate(shingles):
+            if len(h):
+                # multiply-shift: the high 32 bits of a * h + b
+                signatures[i] = ((np.outer(a, h) + b[:, None]) >> np.uint64(32)).min(axis=1)
+    return signatures
+
+
+def lsh_candidates(signatures, bands=BANDS, max_bucket=MAX_BUCKET):
+    """
+    RETURNS (pairs x 2) int64 array of document pairs (i < j) sharing at
+    least one band bucket
+    """
+    n_docs, n_perm = signatures.shape
+    rows = n_perm // bands
+    pairs = []
+    for band in range(bands):
+        # the band's rows folded into one uint64 key
+        keys = np.zeros(n_docs, dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            for row in range(band * rows, (band + 1) * rows):
+                keys = _mix64(keys ^ signatures[:, row].astype(np.uint64))
+        _, bucket, sizes = np.unique(keys, return_inverse=True, return_counts=True)
+        shared = np.flatnonzero((sizes > 1) & (sizes <= max_bucket))
+        if not len(shared):
+            continue
+        docs = np.flatnonzero(np.isin(bucket, shared))
+        docs = docs[np.argsort(bucket[docs], kind="stable")]
+        bounds = np.flatnonzero(np.diff(bucket[docs])) + 1
+        for group in np.split(docs, bounds):
+            i, j = np.triu_indices(len(group), k=1)
+            pairs.append(np.stack([group[i], group[j]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs).astype(np.int64), axis=0)
+
+
+def containment(small, large):
+    """
+    share of the sorted distinct hashes small that are also in large
+    """
+    if not len(small):
+        return 0.0
+    return len(np.intersect1d(small, large, assume_unique=True)) / len(small)
+
+
+# ----------------------------------------------
+# DUPLICATES
+# ----------------------------------------------
+
+def find_duplicates(corpus, threshold=CONTAINMENT, k=SHINGLE_SIZE, n_perm=N_PERM, bands=BANDS):
+    """
+    Near-duplicate map of a corpus (see module docstring).
+    -----
+    :param corpus: DataFrame with doc_id, raw_text and source_type
+    :param threshold: minimum containment of a duplicate in its canonical document
+    -----
+    RETURNS DataFrame (doc_id, canonical_id, containment), one row per
+    duplicate (canonical documents are not listed)
+    """
+    shingles = shingle_hashes(corpus["raw_text"].tolist(), k)
+    signatures = minhash_signatures(shingles, n_perm)
+    pairs = lsh_candidates(signatures, bands)
+
+    sizes = np.array([len(h) for h in shingles])
+    # longest first; on ties the non-excerpt (the one with a location)
+    is_excerpt = (corpus["source_type"] == "excerpt").to_numpy()
+    order = np.lexsort((np.arange(len(sizes)), is_excerpt, -sizes))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    # each pair as (larger, smaller) in processing order, grouped by the larger
+    first = rank[pairs[:, 0]] < rank[pairs[:, 1]]
+    large = np.where(first, pairs[:, 0], pairs[:, 1])
+    small = np.where(first, pairs[:, 1], pairs[:, 0])
+    by_large = np.argsort(rank[large], kind="stable")
+    large, small = large[by_large], small[by_large]
+
+    canonical = np.full(len(sizes), -1)
+    score = np.zeros(len(sizes))
+    for c, d in zip(large.tolist(), small.tolist()):
+        if canonical[c] >= 0 or canonical[d] >= 0:
+            continue
+        contained = containment(shingles[d], shingles[c])
+        if contained >= threshold:
+            canonical[d] = c
+            score[d] = contained
+
+    dups = np.flatnonzero(canonical >= 0)
+    doc_ids = corpus["doc_id"].to_numpy(dtype=object)
+    return pd.DataFrame({
+        "doc_id": doc_ids[dups],
+        "canonical_id": doc_ids[canonical[dups]],
+        "containment": score[dups],
+    })
+
+
+def _merge_domains(values):
+    """
+    Union of the domains in values, written the way the corpus writes
+    compound domains (stripped, sorted: "Academic/Cognitive") so that
+    DOMAIN_FILTER_MAP's "implies" lists match it
+    """
+    parts = {p.strip() for value in values if isinstance(value, str) for p in value.split(DOMAIN_SEP)}
+    parts.discard("")
+    return DOMAIN_SEP.join(sorted(parts)) if parts else None
+
+
+def _header(text):
+    """
+    The metadata lines in front of the EXCERPT_MARKER of a text ("" if none)
+    """
+    text = text if isinstance(text, str) else ""
+    return text[:text.rfind(EXCERPT_MARKER)] if EXCERPT_MARKER in text else ""
+
+
+def _merge_headers(header, passage_header, domain):
+    """
+    The excerpt's header with the merged domain, plus the lines of the
+    passage's header it lacks (its "Source: <chapter>" line)
+    """
+    lines = {}
+    for line in header.splitlines() + passage_header.splitlines():
+        lines.setdefault(line.split(":", 1)[0], line)
+    if domain is not None and "Domain" in lines:
+        lines["Domain"] = f"Domain: {domain}"
+    return "".join(f"{line}\n" for line in lines.values())
+
+
+def collapse_duplicates(corpus, duplicates):
+    """
+    Merge-time collapse: drop the duplicates and merge metadata into the
+    canonical rows. A passage that absorbed excerpts takes their curated
+    tags (approach, evidence_type of the first, domains of all) and the
+    first one's metadata header (plus its own Source line) in front of
+    its raw_text; an excerpt that absorbed passages takes the first
+    passage's location. doc_id and raw_text stay.
+    -----
+    RETURNS the corpus without duplicate rows (same columns, index reset)
+    """
+    corpus = corpus.copy()
+    row_of = pd.Series(np.arange(len(corpus)), index=corpus["doc_id"].to_numpy())
+    dup_rows = row_of.loc[duplicates["doc_id"]].to_numpy()
+    can_rows = row_of.loc[duplicates["canonical_id"]].to_numpy()
+    is_excerpt = (corpus["source_type"] == "excerpt").to_numpy()
+    col = {c: corpus.columns.get_loc(c) for c in corpus.columns}
+
+    # passages that absorbed excerpts: curated tags + header
+    keep = is_excerpt[dup_rows] & ~is_excerpt[can_rows]
+    absorbed = pd.DataFrame({"dup": dup_rows[keep], "canonical": can_rows[keep]}).sort_values(["canonical", "dup"])
+    for can, group in absorbed.groupby("canonical")["dup"]:
+        excerpts = corpus.iloc[group.to_numpy()]
+        first = excerpts.iloc[0]
+        domain = _merge_domains(excerpts["domain"])
+        header = _merge_headers(_header(first["text"]), _header(corpus["text"].iat[can]), domain)
+        corpus.iat[can, col["approach"]] = first["approach"]
+        corpus.iat[can, col["evidence_type"]] = first["evidence_type"]
+        corpus.iat[can, col["domain"]] = domain
+        corpus.iat[can, col["text"]] = header + EXCERPT_MARKER + str(corpus["raw_text"].iat[can])
+
+    # excerpts that absorbed passages: location of the first passage
+    keep = ~is_excerpt[dup_rows] & is_excerpt[can_rows]
+    absorbed = pd.DataFrame({"dup": dup_rows[keep], "canonical": can_rows[keep]}).sort_values(["canonical", "dup"])
+    for can, group in absorbed.groupby("canonical")["dup"]:
+        first = group.iat[0]
+        for c in ("source_file", "source_title", "paragraph_index"):
+            corpus.iat[can, col[c]] = corpus.iat[first, col[c]]
+
+    dropped = np.zeros(len(corpus), dtype=bool)
+    dropped[dup_rows] = True
+    return corpus[~dropped].reset_index(drop=True)
+
+
+# ----------------------------------------------
+# QUERY-TIME COLLAPSE
+# ----------------------------------------------
+
+class DuplicateClusters:
+    """
+    Cluster (canonical row) of every row of the engine's corpus, to show
+    one hit per cluster: the best scoring.
+    """
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.n_duplicates = int(np.count_nonzero(cluster != np.arange(len(cluster))))
+
+    def collapse(self, top_k, top_scores, k):
+        """
+        RETURNS (ids, scores): the first (best) hit of each cluster, at most k
+        """
+        top_k = np.asarray(top_k)
+        _, first = np.unique(self.cluster[top_k], return_index=True)
+        keep = np.sort(first)[:k]
+        return top_k[keep], np.asarray(top_scores)[keep]
+
+    def top_k(self, search, k):
+        """
+        :param search: fetch -> (ids, scores), the best fetch hits
+        RETURNS k collapsed hits, fetching twice as many until there are
+        enough (or no more)
+        """
+        fetch = k
+        while True:
+            top_k, top_scores = search(fetch)
+            ids, scores = self.collapse(top_k, top_scores, k)
+            if len(ids) >= k or len(top_k) < fetch or fetch >= len(self.cluster):
+                return ids, scores
+            fetch = min(2 * fetch, len(self.cluster))
+
+    def top_k_of(self, doc_ids, scores, k, n_docs, candidates=None):
+        """
+        top_k from matches that are already scored, without scoring again
+        -----
+        :param doc_ids, scores: every match of the query (e.g. from
+            PostingsScorer.top_k_matches), padded with zero-score documents
+            as topk.py does
+        RETURNS the same hits as top_k over the scorer's top_k
+        """
+        ranked = top_k_indices(scores, len(scores))
+        doc_ids, scores = np.asarray(doc_ids)[ranked], np.asarray(scores)[ranked]
+        return self.top_k(
+            lambda fetch: fill_with_zero_scores(doc_ids[:fetch], scores[:fetch], fetch, n_docs, candidates), k
+        )
+
+    def top_k_many(self, search_many, search, k):
+        """
+        :param search_many: fetch -> list of (ids, scores), one per query
+        :param search: (query number, fetch) -> (ids, scores)
+        RETURNS k collapsed hits per query: 2k fetched for all, then the
+        queries still short of k one at a time with top_k()
+        """
+        fetch = min(2 * k, len(self.cluster))
+        ranked = []
+        for i, (top_k, top_scores) in enumerate(search_many(fetch)):
+            ids, scores = self.collapse(top_k, top_scores, k)
+            if len(ids) < k and len(top_k) == fetch and fetch < len(self.cluster):
+                ids, scores = self.top_k(functools.partial(search, i), k)
+            ranked.append((ids, scores))
+        return ranked
+
+
+def load_duplicate_clusters(store, path=DUPLICATES_FILE):
+    """
+    Used by the search engines.
+    -----
+    :param store: the engine's column store (hits.ColumnStore / DocStore)
+    RETURNS DuplicateClusters over its rows, or None if there is no
+    duplicate map or none of its pairs are in the corpus (e.g. after a
+    merge-time collapse)
+    """
+    if not os.path.exists(path):
+        return None
+    duplicates = pd.read_csv(path, dtype={"doc_id": str, "canonical_id": str})
+    doc_ids = store.column("doc_id")
+    row_of = pd.Series(np.arange(len(doc_ids)), index=pd.Index(doc_ids).astype(str))
+    row_of = row_of[~row_of.index.duplicated()]
+    dup = row_of.reindex(duplicates["doc_id"]).to_numpy()
+    can = row_of.reindex(duplicates["canonical_id"]).to_numpy()
+    present = ~np.isnan(dup) & ~np.isnan(can)
+    if not present.any():
+        return None
+
+    cluster = np.arange(len(doc_ids))
+    cluster[dup[present].astype(np.int64)] = can[present].astype(np.int64)
+    return DuplicateClusters(cluster)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate documents in the corpus")
+    parser.add_argument("--corpus", default=CORPUS_FILE)
+    parser.add_argument("--map", default=DUPLICATES_FILE, help="duplicate map to write")
+    parser.add_argument("--threshold", type=float, default=CONTAINMENT)
+    parser.add_argument("--collapse-to", help="also write the corpus without duplicates to this csv")
+    args = parser.parse_args()
+
+    corpus = pd.read_csv(args.corpus)
+    duplicates = find_duplicates(corpus, args.threshold)
+    duplicates.to_csv(args.map, index=False)
+    print(f"{len(duplicates)} near-duplicates of {duplicates['canonical_id'].nunique()} documents "
+          f"(of {len(corpus)}) written to {args.map}")
+
+    if args.collapse_to:
+        collapsed = collapse_duplicates(corpus, duplicates)
+        collapsed.to_csv(args.collapse_to, index=False)
+        print(f"Collapsed corpus ({len(collapsed)} docs) written to {args.collapse_to}")
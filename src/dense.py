@@ -0,0 +1,415 @@
+"""
+Dense (LSA) retrieval with quantised embeddings and an IVF index.
+
+TF-IDF only matches documents sharing a term with the query
+("concentration" never finds a passage that only says "attention").
+Here the TF-IDF matrix is projected onto its top singular vectors
+(TruncatedSVD, i.e. LSA), so related terms end up close together, and
+queries are ranked by cosine similarity in that space.
+
+Documents are not all scored: the unit embeddings are clustered with
+spherical k-means into nlist inverted lists (IVF), and a query only scores
+the documents of the nprobe lists whose centroids are closest to it.
+nprobe trades recall for speed (nprobe = nlist is exact search over the
+quantised vectors). Embeddings are stored quantised, int8 with a scale per
+dimension (or float16), grouped by list so a probe reads contiguous rows.
+
+Building is chunked (the SVD is fitted on a sample of rows, k-means on a
+sample of embeddings), so memory stays bounded with the corpus size; at
+query time everything is memory-mapped and only the probed lists are read.
+
+Usage:
+    python src/idx_tfidf.py --dense [--dense-dims 128] [--quantization int8]
+    engine.search("concentration", k=5, ranking="dense")
+    engine.dense_index.nprobe = 16      # more recall, more work
+
+Layout of DENSE_DIR:
+    manifest.json     format version, build id of the TF-IDF index it was
+                      built from, dims, nlist, quantization
+    components.bin    (n_features x dims) LSA projection, float32
+    centroids.bin     (nlist x dims) unit-norm list centroids, float32
+    list_offsets.bin  list c is rows list_offsets[c]:list_offsets[c+1]
+    list_ids.bin      doc index of every row
+    codes.bin         (n_docs x dims) quantised unit embeddings, by list
+    scales.bin        per-dimension scale of the int8 codes
+"""
+
+import os
+import time
+import uuid
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.decomposition import TruncatedSVD
+
+from index_store import INDEX_DIR, StaleIndexError, open_array, read_manifest, write_array, write_manifest
+from topk import fill_with_zero_scores, select_matches, top_k_indices
+
+
+DENSE_DIR = os.path.join(INDEX_DIR, "dense")
+FORMAT_VERSION = 1
+
+DENSE_DIMS = 128
+QUANTIZATIONS = ("int8", "float16")
+DEFAULT_NPROBE = 8
+
+# rows the SVD is fitted on / embeddings k-means is trained on (per list)
+SVD_FIT_SAMPLE = 100_000
+KMEANS_SAMPLE_PER_LIST = 64
+KMEANS_ITERATIONS = 20
+
+# documents embedded at a time while building
+BUILD_CHUNK = 50_000
+
+
+# ----------------------------------------------
+# HELPERS
+# ----------------------------------------------
+
+def default_nlist(n_docs):
+    """
+    ~sqrt(n_docs) lists of ~sqrt(n_docs) documents each
+    """
+    return max(1, int(round(np.sqrt(n_docs))))
+
+
+def embed(matrix, components):
+    """
+    Rows of a sparse (n x n_features) matrix -> unit LSA embeddings
+    -----
+    :param components: (n_features x dims) projection
+    RETURNS (n x dims) float32; all-zero rows stay zero
+    """
+    # same dtype on both sides, or scipy upcasts a copy of the components
+    emb = np.asarray(csr_matrix(matrix, dtype=components.dtype) @ components)
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    np.divide(emb, norms, out=emb, where=norms > 0)
+    return emb
+
+
+def fit_lsa(tfidf_matrix, n_components=DENSE_DIMS, sample=SVD_FIT_SAMPLE, seed=0):
+    """
+    TruncatedSVD over (a sample of) the TF-IDF rows.
+    -----
+    RETURNS (n_features x n_components) float32 projection
+    """
+    n_docs, n_features = tfidf_matrix.shape
+    n_components = max(1, min(n_components, n_docs - 1, n_features - 1))
+
+    rows = tfidf_matrix
+    if n_docs > sample:
+        rng = np.random.default_rng(seed)
+        rows = tfidf_matrix[np.sort(rng.choice(n_docs, sample, replace=False))]
+
+    svd = TruncatedSVD(n_components=n_components, algorithm="randomized", random_state=seed)
+    svd.fit(rows)
+    return np.ascontiguousarray(svd.components_.T, dtype=np.float32)
+
+
+def train_centroids(points, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    Spherical k-means (cosine) over unit vectors.
+    -----
+    RETURNS (nlist x dims) unit-norm centroids
+    """
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist, len(points))
+    centroids = points[rng.choice(len(points), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        sims = points @ centroids.T
+        assign = np.argmax(sims, axis=1)
+
+        # per-list sums as a (lists x points) one-hot product
+        one_hot = csr_matrix(
+            (np.ones(len(points), dtype=np.float32), (assign, np.arange(len(points)))),
+            shape=(nlist, len(points)),
+        )
+        sums = np.asarray(one_hot @ points)
+        empty = np.flatnonzero(np.bincount(assign, minlength=nlist) == 0)
+        if len(empty):
+            # reseed empty lists with the points furthest from their centroid
+            worst = np.argsort(sims[np.arange(len(points)), assign])[:len(empty)]
+            sums[empty[:len(worst)]] = points[worst]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        np.divide(sums, norms, out=sums, where=norms > 0)
+        centroids = sums.astype(np.float32)
+
+    return centroids
+
+
+def quantize(emb, quantization, scales=None):
+    if quantization == "int8":
+        return np.clip(np.rint(emb / scales), -127, 127).astype(np.int8)
+    return emb.astype(np.float16)
+
+
+def _write_rows(dense_dir, name, chunks, dtype, shape):
+    """
+    write_array for an array produced chunk by chunk (never fully in memory)
+    """
+    filename = f"{name}.bin"
+    tmp_path = os.path.join(dense_dir, filename + ".tmp")
+    with open(tmp_path, "wb") as f:
+        for chunk in chunks:
+            f.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+    os.replace(tmp_path, os.path.join(dense_dir, filename))
+    return {"file": filename, "dtype": np.dtype(dtype).str, "shape": list(shape)}
+
+
+# ----------------------------------------------
+# WRITE
+# ----------------------------------------------
+
+def write_dense_index(tfidf_matrix, index_manifest, dense_dir=DENSE_DIR, n_components=DENSE_DIMS,
+                      nlist=None, quantization="int8", chunk_size=BUILD_CHUNK, seed=0):
+    """
+    Fit LSA over the TF-IDF matrix and write the IVF index (idx_tfidf.py --dense).
+    -----
+    :param tfidf_matrix: (n_docs x n_features) matrix of the index
+    :param index_manifest: manifest of that index (index_store.write_index);
+        the dense index is only used with the same build
+    :param n_components: embedding dimensions
+    :param nlist: number of inverted lists, default ~sqrt(n_docs)
+    :param quantization: "int8" or "float16"
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"quantization must be one of {QUANTIZATIONS}, got {quantization!r}")
+
+    os.makedirs(dense_dir, exist_ok=True)
+    matrix = csr_matrix(tfidf_matrix)
+    n_docs = matrix.shape[0]
+    nlist = min(nlist or default_nlist(n_docs), n_docs)
+
+    components = fit_lsa(matrix, n_components, seed=seed)
+    dims = components.shape[1]
+
+    def chunks(ids):
+        for start in range(0, len(ids), chunk_size):
+            yield embed(matrix[ids[start:start + chunk_size]], components)
+
+    # k-means on a sample of the embeddings
+    rng = np.random.default_rng(seed)
+    n_sample = min(n_docs, nlist * KMEANS_SAMPLE_PER_LIST)
+    sample_ids = np.sort(rng.choice(n_docs, n_sample, replace=False))
+    centroids = train_centroids(np.concatenate(list(chunks(sample_ids))), nlist, seed=seed)
+    nlist = len(centroids)
+
+    # pass 1: list of every document + per-dimension range for the int8 scale
+    assign = np.empty(n_docs, dtype=np.int32)
+    max_abs = np.zeros(dims, dtype=np.float32)
+    all_ids = np.arange(n_docs)
+    for start, emb in zip(range(0, n_docs, chunk_size), chunks(all_ids)):
+        assign[start:start + len(emb)] = np.argmax(emb @ centroids.T, axis=1)
+        np.maximum(max_abs, np.abs(emb).max(axis=0), out=max_abs)
+    scales = np.where(max_abs > 0, max_abs / 127, 1.0).astype(np.float32)
+
+    # pass 2: embeddings again, grouped by list
+    list_ids = np.argsort(assign, kind="stable")
+    list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=nlist), out=list_offsets[1:])
+
+    code_dtype = np.int8 if quantization == "int8" else np.float16
+    arrays = {
+        "components": write_array(dense_dir, "components", components),
+        "centroids": write_array(dense_dir, "centroids", centroids),
+        "list_offsets": write_array(dense_dir, "list_offsets", list_offsets),
+        "list_ids": write_array(dense_dir, "list_ids", list_ids.astype(np.int32)),
+        "codes": _write_rows(
+            dense_dir, "codes",
+            (quantize(emb, quantization, scales) for emb in chunks(list_ids)),
+            code_dtype, (n_docs, dims),
+        ),
+        "scales": write_array(dense_dir, "scales", scales),
+    }
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "build_id": uuid.uuid4().hex,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "index_build_id": index_manifest["build_id"],
+        "n_docs": int(n_docs),
+        "n_features": int(matrix.shape[1]),
+        "dims": int(dims),
+        "nlist": int(nlist),
+        "quantization": quantization,
+        "arrays": arrays,
+    }
+    write_manifest(dense_dir, manifest)
+    return manifest
+
+
+# ----------------------------------------------
+# SEARCH
+# ----------------------------------------------
+
+class DenseIndex:
+    """
+    IVF search over the quantised LSA embeddings. Same top_k / top_k_many
+    interface as topk.PostingsScorer, taking TF-IDF query vectors.
+    -----
+    :param nprobe: lists scored per query; more lists are probed when the
+        first nprobe hold fewer than k candidate documents
+    """
+    def __init__(self, components, centroids, list_offsets, list_ids, codes, scales,
+                 quantization="int8", nprobe=DEFAULT_NPROBE):
+        # plain ndarray views of the memmaps, no copy
+        self.components = np.asarray(components)
+        self.centroids = np.asarray(centroids)
+        self.list_offsets = np.asarray(list_offsets)
+        self.list_ids = np.asarray(list_ids)
+        self.codes = np.asarray(codes)
+        self.scales = np.asarray(scales) if quantization == "int8" else np.ones(codes.shape[1], dtype=np.float32)
+        self.n_docs = len(self.list_ids)
+        self.nprobe = nprobe
+        self._rows = None
+
+    @classmethod
+    def from_dir(cls, dense_dir, manifest, nprobe=DEFAULT_NPROBE):
+        arrays = {name: open_array(dense_dir, entry) for name, entry in manifest["arrays"].items()}
+        return cls(
+            arrays["components"], arrays["centroids"], arrays["list_offsets"], arrays["list_ids"],
+            arrays["codes"], arrays["scales"], manifest["quantization"], nprobe,
+        )
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def embed(self, query_matrix):
+        return embed(query_matrix, self.components)
+
+    def score_docs(self, q_emb, doc_ids):
+        """
+        Scores of given documents (no probing), e.g. to rerank candidates
+        from another ranking.
+        """
+        if self._rows is None:
+            # row of every document in the list-ordered codes
+            self._rows = np.argsort(self.list_ids)
+        rows = self._rows[doc_ids]
+        return (self.codes[rows].astype(np.float32) @ (q_emb * self.scales)).astype(np.float64)
+
+    def _probe_order(self, q_emb, k, nprobe, candidates):
+        """
+        Lists to score: the nprobe closest, then more until they hold k candidates
+        """
+        order = np.argsort(-(self.centroids @ q_emb), kind="stable")
+        if candidates is None:
+            sizes = np.diff(self.list_offsets)
+        else:
+            counts = np.concatenate([[0], np.cumsum(candidates[self.list_ids])])
+            sizes = counts[self.list_offsets[1:]] - counts[self.list_offsets[:-1]]
+        n = min(nprobe, len(order))
+        enough = np.flatnonzero(np.cumsum(sizes[order]) >= k)
+        if len(enough):
+            n = max(n, enough[0] + 1)
+        else:
+            n = len(order)
+        return order[:n]
+
+    def search_one(self, q_emb, k, candidates=None, nprobe=None, timer=None):
+        """
+        Top-k for one unit query embedding
+        -----
+        :param timer: as for PostingsScorer.top_k
+        RETURNS (doc_ids, scores), best first
+        """
+        return self._search(q_emb, k, candidates, nprobe, timer)[0]
+
+    def _search(self, q_emb, k, candidates=None, nprobe=None, timer=None, min_score=None, top_n=None):
+        """
+        RETURNS (top-k, matches): matches (see topk.select_matches) are
+        taken over the probed documents, None unless min_score is given
+        """
+        if not q_emb.any():
+            empty = np.empty(0, dtype=np.intp), np.empty(0)
+            top = fill_with_zero_scores(*empty, k, self.n_docs, candidates)
+            return top, (empty if min_score is not None else None)
+
+        lists = self._probe_order(q_emb, max(k, top_n or 0), nprobe or self.nprobe, candidates)
+        q_scaled = q_emb * self.scales
+        doc_ids, scores = [], []
+        for c in lists:
+            # one contiguous slice of the (memory-mapped) codes per list
+            start, end = self.list_offsets[c], self.list_offsets[c + 1]
+            doc_ids.append(self.list_ids[start:end])
+            scores.append(self.codes[start:end].astype(np.float32) @ q_scaled)
+        doc_ids = np.concatenate(doc_ids)
+        scores = np.concatenate(scores)
+
+        if candidates is not None:
+            keep = candidates[doc_ids]
+            doc_ids, scores = doc_ids[keep], scores[keep]
+        if timer is not None:
+            timer.mark("score")
+            timer.count("candidates_scored", len(doc_ids))
+
+        scores = scores.astype(np.float64)
+        matches = None
+        if min_score is not None:
+            matches = select_matches(doc_ids.astype(np.intp), scores, min_score, top_n)
+
+        top = top_k_indices(scores, k)
+        result = doc_ids[top].astype(np.intp), scores[top]
+        if timer is not None:
+            timer.mark("select")
+        return result, matches
+
+    def top_k(self, query_vec, k, candidates=None, nprobe=None, timer=None):
+        """
+        :param query_vec: (1 x n_features) TF-IDF query vector
+        """
+        q_emb = self.embed(query_vec)[0]
+        if timer is not None:
+            timer.mark("vectorize")
+        return self.search_one(q_emb, k, candidates, nprobe, timer)
+
+    def top_k_matches(self, query_vec, k, candidates=None, min_score=0.0, top_n=None, nprobe=None, timer=None):
+        """
+        As PostingsScorer.top_k_matches, over the documents of the probed
+        lists (enough lists are probed to cover max(k, top_n) candidates)
+        """
+        q_emb = self.embed(query_vec)[0]
+        if timer is not None:
+            timer.mark("vectorize")
+        return self._search(q_emb, k, candidates, nprobe, timer, min_score, top_n)
+
+    def top_k_many(self, query_matrix, k, candidates=None, batch_size=256, nprobe=None):
+        """
+        top_k for every row of query_matrix; candidates as for
+        PostingsScorer.top_k_many
+        """
+        n_queries = query_matrix.shape[0]
+        if candidates is None or isinstance(candidates, np.ndarray):
+            candidates = [candidates] * n_queries
+
+        results = []
+        for start in range(0, n_queries, batch_size):
+            q_emb = self.embed(query_matrix[start:start + batch_size])
+            for row, mask in zip(q_emb, candidates[start:start + batch_size]):
+                results.append(self.search_one(row, k, mask, nprobe))
+        return results
+
+
+def load_dense_index(index_manifest, dense_dir=DENSE_DIR, nprobe=DEFAULT_NPROBE):
+    """
+    Used by the search engines.
+    -----
+    RETURNS DenseIndex, or None if there is none or it was built from
+    another TF-IDF index
+    """
+    manifest = read_manifest(dense_dir)
+    if manifest is None or index_manifest is None:
+        return None
+    try:
+        if manifest.get("format_version") != FORMAT_VERSION:
+            raise StaleIndexError(f"format version {manifest.get('format_version')}, expected {FORMAT_VERSION}")
+        if manifest["index_build_id"] != index_manifest["build_id"]:
+            raise StaleIndexError("built from another TF-IDF index")
+        return DenseIndex.from_dir(dense_dir, manifest, nprobe)
+    except StaleIndexError as e:
+        print(f"** Ignoring stale dense index in {dense_dir}: {e}")
+        print("** Re-run idx_tfidf.py --dense to rebuild.")
+        return None
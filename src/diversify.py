@@ -0,0 +1,166 @@
+"""
+Result diversification over the top-N candidates.
+
+Queries like "benefits of the Pink Tower" come back as neighbouring
+paragraphs of one chapter. search(..., diversify=...) ranks the usual
+top-N candidates (N = Diversifier.n_candidates) and picks k of them:
+
+    "mmr"      maximal marginal relevance: repeatedly the candidate with
+               the best  lam * relevance - (1 - lam) * max similarity to
+               the ones already picked. The similarities are one N x N
+               block of TF-IDF cosines from a single sparse product;
+               each pick is one vectorised update of the N running
+               maxima, so the cost is one N-row product + O(k * N).
+               By default (mmr_quota) it also keeps the source quota
+               below: similarity alone barely separates the paragraphs
+               of one chapter ("Pink Tower": the same 2 chapters as
+               without diversify, up to lam = 0.5)
+    "source"   quota: at most per_source hits per source_file (chapter),
+               best first; rank within each source computed at once
+
+Relevance is the first stage's score scaled to [0, 1]. Candidates not
+scoring above 0 (topk.py's zero-score fill) are never picked for
+diversity, only to fill up to k. Hit scores stay the first stage's
+scores, in the new order.
+
+Usage:
+    hits = engine.search("benefits of the pink tower", k=5, diversify="mmr")
+    engine.diversifier.mmr_lambda = 0.5    # more diversity
+    engine.diversifier.mmr_quota = False   # plain MMR
+    engine.diversifier.n_candidates = 200
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+DIVERSIFY_METHODS = ("mmr", "source")
+
+N_CANDIDATES = 100
+MMR_LAMBDA = 0.7
+MMR_QUOTA = True
+PER_SOURCE = 2
+QUOTA_FIELD = "source_file"
+
+
+class Diversifier:
+    """
+    :param matrix: the engine's TF-IDF matrix (rows = documents)
+    :param store: the engine's column store (for the quota field)
+    :param mmr_quota: MMR picks also stay within per_source per quota_field
+    """
+    def __init__(self, matrix, store, n_candidates=N_CANDIDATES, mmr_lambda=MMR_LAMBDA,
+                 mmr_quota=MMR_QUOTA, per_source=PER_SOURCE, quota_field=QUOTA_FIELD):
+        self.matrix = matrix
+        self.store = store
+        self.n_candidates = n_candidates
+        self.mmr_lambda = mmr_lambda
+        self.mmr_quota = mmr_quota
+        self.per_source = per_source
+        self.quota_field = quota_field
+        self._codes = None
+
+    @staticmethod
+    def check(method):
+        if method not in DIVERSIFY_METHODS:
+            raise ValueError(f"diversify must be one of {DIVERSIFY_METHODS}, got {method!r}")
+
+    def fetch(self, method, k):
+        """
+        Number of candidates to rank for k hits diversified with method
+        (k if method is None)
+        """
+        if method is None:
+            return k
+        self.check(method)
+        return max(k, self.n_candidates)
+
+    def similarities(self, doc_ids):
+        """
+        RETURNS dense (n x n) cosine similarities of the documents
+        """
+        rows = self.matrix[doc_ids]
+        norms = np.sqrt(np.asarray(rows.multiply(rows).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        rows = sparse.diags(1.0 / norms) @ rows
+        return (rows @ rows.T).toarray()
+
+    def mmr(self, doc_ids, scores, k):
+        """
+        RETURNS positions (into doc_ids) of the MMR picks, in pick order
+        (fewer than k if the source quota runs out of candidates)
+        """
+        n = len(doc_ids)
+        sim = self.similarities(doc_ids)
+        relevance = scores / scores.max()
+        if self.mmr_quota:
+            codes = self.source_codes(doc_ids)
+            per_code = {}
+
+        max_sim = np.zeros(n)
+        blocked = np.zeros(n, dtype=bool)   # picked, or its source's quota is used up
+        order = []
+        for _ in range(min(k, n)):
+            gain = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * max_sim
+            gain[blocked] = -np.inf
+            best = int(np.argmax(gain))
+            if blocked[best]:
+                break
+            order.append(best)
+            blocked[best] = True
+            np.maximum(max_sim, sim[best], out=max_sim)
+            if self.mmr_quota:
+                code = codes[best]
+                per_code[code] = per_code.get(code, 0) + 1
+                if per_code[code] >= self.per_source:
+                    blocked |= codes == code
+        return np.array(order, dtype=np.intp)
+
+    def source_codes(self, doc_ids):
+        """
+        RETURNS quota_field codes of the documents
+        """
+        if self._codes is None:
+            self._codes = np.asarray(self.store.factorize(self.quota_field)[0])
+        return self._codes[doc_ids]
+
+    def source_quota(self, doc_ids, k):
+        """
+        RETURNS positions (into doc_ids, which are best first) of the first
+        k candidates within their source's quota
+        """
+        codes = self.source_codes(doc_ids)
+
+        # rank of each candidate within its source
+        by_source = np.argsort(codes, kind="stable")
+        sorted_codes = codes[by_source]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        group_start = np.repeat(starts, np.diff(np.r_[starts, len(codes)]))
+        rank = np.empty(len(codes), dtype=np.intp)
+        rank[by_source] = np.arange(len(codes)) - group_start
+
+        return np.flatnonzero(rank < self.per_source)[:k]
+
+    def rerank(self, method, top_k, top_scores, k):
+        """
+        :param method: one of DIVERSIFY_METHODS
+        :param top_k, top_scores: the candidates, best first (topk.py)
+        RETURNS (ids, scores) of k diversified hits
+        """
+        self.check(method)
+        top_k = np.asarray(top_k)
+        top_scores = np.asarray(top_scores, dtype=np.float64)
+        positive = np.flatnonzero(top_scores > 0)
+
+        if len(positive) == 0:
+            order = np.empty(0, dtype=np.intp)
+        elif method == "mmr":
+            order = positive[self.mmr(top_k[positive], top_scores[positive], k)]
+        else:
+            order = positive[self.source_quota(top_k[positive], k)]
+
+        if len(order) < k:
+            # filled with the best remaining candidates
+            rest = np.setdiff1d(np.arange(len(top_k)), order, assume_unique=True)
+            order = np.concatenate([order, rest[:k - len(order)]])
+        return top_k[order], top_scores[order]
@@ -0,0 +1,399 @@
+"""
+Memory-mapped document store (corpus text + metadata), written at index time.
+
+The pickled corpus DataFrame keeps every document's text three times
+(text, raw_text, processed_text) as Python strings, all loaded into the
+heap of every search process. Here the corpus is written column by column
+into flat binary files that are np.memmap'ed on open:
+
+    blob columns      UTF-8 bytes of all rows in one file + int64 offsets
+                      (doc_id, raw_text)
+    dict columns      small-int codes (-1 = missing) + a dictionary of the
+                      distinct values, itself a blob column (approach,
+                      domain, evidence_type, source_type, source_title,
+                      source_file)
+    float columns     float64 (paragraph_index)
+
+"text" is not stored: it is the metadata header merge_corpora.py puts in
+front of the excerpt, so it is kept as a dict column of headers
+("text_prefix") and rebuilt as prefix + raw_text. processed_text is only
+needed to fit the vectorizer and is dropped.
+
+Layout of DOC_STORE_DIR:
+    manifest.json     format version, n_docs, corpus checksum, columns
+    <column>_*.bin    the arrays above
+"""
+
+import os
+import pickle
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from hits import RESULT_FIELDS, ColumnStore
+from index_store import (
+    INDEX_DIR, ArrayAppender, StaleIndexError, file_checksum, file_stat, file_unchanged, open_array,
+    read_manifest, write_manifest,
+)
+
+
+DOC_STORE_DIR = os.path.join(INDEX_DIR, "docs")
+FORMAT_VERSION = 1
+
+BLOB_COLUMNS = ["doc_id", "raw_text"]
+DICT_COLUMNS = ["approach", "domain", "evidence_type", "source_type", "source_title", "source_file"]
+FLOAT_COLUMNS = ["paragraph_index"]
+
+WRITE_CHUNK = 1 << 20     # codes narrowed per write
+
+STORE_COLUMNS = [
+    "doc_id", "text", "raw_text", "approach", "domain", "evidence_type",
+    "source_type", "source_title", "source_file", "paragraph_index"
+]
+
+
+# ----------------------------------------------
+# WRITE
+# ----------------------------------------------
+
+def _code_dtype(n_values):
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_values <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def write_blob(store_dir, name, values):
+    """
+    strings -> one UTF-8 blob + offsets (row i is blob[offsets[i]:offsets[i+1]])
+    """
+    writer = BlobWriter(store_dir, name)
+    writer.append(values)
+    return writer.finish()
+
+
+def write_dict_column(store_dir, name, values):
+    """
+    values -> codes into a dictionary of distinct (non-missing) values
+    """
+    writer = DictColumnWriter(store_dir, name)
+    writer.append(values)
+    return writer.finish()
+
+
+class BlobWriter:
+    """
+    write_blob over chunks of values
+    """
+    def __init__(self, store_dir, name):
+        self.blob = ArrayAppender(store_dir, f"{name}_blob", np.uint8)
+        self.offsets = ArrayAppender(store_dir, f"{name}_offsets", np.int64)
+        self.offsets.append([0])
+        self.end = 0
+
+    def append(self, values):
+        encoded = [str(v).encode("utf-8") for v in values]
+        offsets = np.cumsum([len(b) for b in encoded], dtype=np.int64) + self.end
+        self.blob.append(np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        self.offsets.append(offsets)
+        self.end = int(offsets[-1]) if len(offsets) else self.end
+
+    def finish(self):
+        return {"blob": self.blob.finish(), "offsets": self.offsets.finish()}
+
+    def discard(self):
+        self.blob.discard()
+        self.offsets.discard()
+
+
+class DictColumnWriter:
+    """
+    write_dict_column over chunks of values: codes in order of first
+    appearance, narrowed to the smallest dtype once all are known
+    """
+    def __init__(self, store_dir, name):
+        self.store_dir = store_dir
+        self.name = name
+        self.values = {}
+        self.codes = ArrayAppender(store_dir, f"{name}_codes_wide", np.int64)
+
+    def append(self, values):
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+        mapping = np.array([self.values.setdefault(u, len(self.values)) for u in uniques] + [-1], dtype=np.int64)
+        self.codes.append(mapping[codes])
+
+    def finish(self):
+        wide = self.codes.finish()
+        narrow = ArrayAppender(self.store_dir, f"{self.name}_codes", _code_dtype(len(self.values)))
+        codes = open_array(self.store_dir, wide)
+        for start in range(0, len(codes), WRITE_CHUNK):
+            narrow.append(codes[start:start + WRITE_CHUNK])
+        del codes
+        os.remove(os.path.join(self.store_dir, wide["file"]))
+
+        arrays = {"codes": narrow.finish()}
+        arrays.update({
+            f"dict_{key}": entry
+            for key, entry in write_blob(self.store_dir, f"{self.name}_dict", list(self.values)).items()
+        })
+        return arrays
+
+    def discard(self):
+        self.codes.discard()
+
+
+def write_doc_store(corpus, corpus_file, store_dir=DOC_STORE_DIR):
+    """
+    Write the corpus DataFrame (idx_tfidf.py) in the memory-mapped format.
+    -----
+    :param corpus: DataFrame with STORE_COLUMNS
+    :param corpus_file: corpus csv it was read from (checksummed)
+    """
+    return write_doc_store_chunks([corpus], corpus_file, store_dir)
+
+
+def write_doc_store_chunks(chunks, corpus_file, store_dir=DOC_STORE_DIR):
+    """
+    write_doc_store over DataFrame chunks of the corpus, in order (e.g.
+    pd.read_csv(..., chunksize=...) for idx_tfidf.py --workers): only one
+    chunk and the distinct values of the dict columns are in memory.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    blobs = {col: BlobWriter(store_dir, col) for col in BLOB_COLUMNS}
+    dicts = {col: DictColumnWriter(store_dir, col) for col in DICT_COLUMNS}
+    floats = {col: ArrayAppender(store_dir, col, np.float64) for col in FLOAT_COLUMNS}
+
+    # text = header + raw_text; store the header only when that holds for
+    # every row, so the full text is written too until the end shows that
+    prefixes = DictColumnWriter(store_dir, "text_prefix")
+    texts = BlobWriter(store_dir, "text")
+    prefixed = True
+
+    n_docs = 0
+    for corpus in chunks:
+        for col in BLOB_COLUMNS:
+            blobs[col].append(corpus[col])
+        for col in DICT_COLUMNS:
+            dicts[col].append(corpus[col])
+        for col in FLOAT_COLUMNS:
+            floats[col].append(corpus[col].to_numpy(dtype=np.float64))
+
+        text = corpus["text"].astype(object).to_numpy()
+        raw = corpus["raw_text"].astype(object).to_numpy()
+        texts.append(text)
+        if prefixed:
+            prefixed = all(isinstance(t, str) and isinstance(r, str) and t.endswith(r) for t, r in zip(text, raw))
+        if prefixed:
+            prefixes.append([t[:len(t) - len(r)] for t, r in zip(text, raw)])
+        n_docs += len(corpus)
+
+    columns = {}
+    for col in BLOB_COLUMNS:
+        columns[col] = {"kind": "blob", "arrays": blobs[col].finish()}
+    for col in DICT_COLUMNS:
+        columns[col] = {"kind": "dict", "arrays": dicts[col].finish()}
+    for col in FLOAT_COLUMNS:
+        columns[col] = {"kind": "float", "arrays": {"values": floats[col].finish()}}
+
+    if prefixed:
+        texts.discard()
+        columns["text"] = {"kind": "prefixed", "suffix": "raw_text", "arrays": prefixes.finish()}
+    else:
+        prefixes.discard()
+        columns["text"] = {"kind": "blob", "arrays": texts.finish()}
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "build_id": uuid.uuid4().hex,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "n_docs": n_docs,
+        "corpus_sha256": file_checksum(corpus_file),
+        "corpus_stat": file_stat(corpus_file),
+        "columns": columns,
+    }
+    write_manifest(store_dir, manifest)
+    return manifest
+
+
+# ----------------------------------------------
+# READ
+# ----------------------------------------------
+
+class BlobColumn:
+    def __init__(self, store_dir, arrays, prefix=""):
+        self.blob = open_array(store_dir, arrays[f"{prefix}blob"])
+        self.offsets = open_array(store_dir, arrays[f"{prefix}offsets"])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, index):
+        return bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]).decode("utf-8")
+
+    def get_bytes(self, index, start=0, end=None):
+        lo, hi = self.offsets[index], self.offsets[index + 1]
+        return bytes(self.blob[lo + start:hi if end is None else min(hi, lo + end)])
+
+    def to_list(self):
+        data = bytes(self.blob)
+        offsets = self.offsets.tolist()
+        return [data[a:b].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+class DictColumn:
+    def __init__(self, store_dir, arrays):
+        self.codes = open_array(store_dir, arrays["codes"])
+        self.values = BlobColumn(store_dir, arrays, prefix="dict_").to_list()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def get(self, index):
+        code = self.codes[index]
+        return self.values[code] if code >= 0 else np.nan
+
+    def to_list(self):
+        values = np.array(self.values + [np.nan], dtype=object)
+        return values[np.asarray(self.codes)].tolist()
+
+
+class DocStore(ColumnStore):
+    """
+    Read side of the document store. Same interface as hits.ColumnStore:
+    single values are decoded straight from the memory-mapped files,
+    whole columns only when column() is asked for.
+    """
+    def __init__(self, store_dir, manifest):
+        self.store_dir = store_dir
+        self.manifest = manifest
+        self.n_docs = manifest["n_docs"]
+        self.fields = list(RESULT_FIELDS)
+        self._columns = {}
+        self._frame = None
+
+        self._readers = {}
+        for col, spec in manifest["columns"].items():
+            if spec["kind"] == "blob":
+                self._readers[col] = BlobColumn(store_dir, spec["arrays"])
+            elif spec["kind"] in ("dict", "prefixed"):
+                self._readers[col] = DictColumn(store_dir, spec["arrays"])
+            else:
+                self._readers[col] = open_array(store_dir, spec["arrays"]["values"])
+
+        for col, reader in self._readers.items():
+            if len(reader) != self.n_docs:
+                raise StaleIndexError(f"doc store column {col} does not have {self.n_docs} rows")
+
+    def __len__(self):
+        return self.n_docs
+
+    def _is_prefixed(self, field):
+        return self.manifest["columns"][field]["kind"] == "prefixed"
+
+    def get(self, field, index):
+        if field in self._columns:
+            return self._columns[field][index]
+        reader = self._readers.get(field)
+        if reader is None:
+            raise KeyError(field)
+        if isinstance(reader, np.ndarray):
+            return float(reader[index])
+        if self._is_prefixed(field):
+            suffix = self.manifest["columns"][field]["suffix"]
+            return reader.get(index) + self.get(suffix, index)
+        return reader.get(index)
+
+    def raw_bytes(self, field, index, start=0, end=None):
+        """
+        UTF-8 bytes [start:end] of a blob column value, sliced from the
+        memory-mapped blob without decoding the rest of the row
+        """
+        reader = self._readers.get(field)
+        if isinstance(reader, BlobColumn):
+            return reader.get_bytes(index, start, end)
+        return super().raw_bytes(field, index, start, end)
+
+    def column(self, field):
+        values = self._columns.get(field)
+        if values is not None:
+            return values
+
+        reader = self._readers.get(field)
+        if reader is None:
+            raise KeyError(field)
+        if isinstance(reader, np.ndarray):
+            values = np.asarray(reader, dtype=np.float64).astype(object)
+        elif self._is_prefixed(field):
+            suffix = self.column(self.manifest["columns"][field]["suffix"])
+            values = np.array([p + s for p, s in zip(reader.to_list(), suffix)], dtype=object)
+        else:
+            values = np.array(reader.to_list(), dtype=object)
+
+        self._columns[field] = values
+        return values
+
+    def factorize(self, field):
+        """
+        (codes, distinct values) straight from a dict column
+        """
+        reader = self._readers.get(field)
+        if isinstance(reader, DictColumn) and not self._is_prefixed(field):
+            return np.asarray(reader.codes, dtype=np.intp), reader.values
+        return super().factorize(field)
+
+    def to_frame(self):
+        """
+        The whole corpus as a DataFrame (like the pickle, minus
+        processed_text). Built on first use only.
+        """
+        if self._frame is None:
+            self._frame = pd.DataFrame({col: self.column(col) for col in STORE_COLUMNS})
+            self._frame["paragraph_index"] = self._frame["paragraph_index"].astype(np.float64)
+        return self._frame
+
+
+def open_doc_store(store_dir=DOC_STORE_DIR, corpus_file=None):
+    """
+    RETURNS DocStore; raises FileNotFoundError if there is none,
+    StaleIndexError if it does not match corpus_file.
+    """
+    manifest = read_manifest(store_dir)
+    if manifest is None:
+        raise FileNotFoundError(store_dir)
+
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise StaleIndexError(
+            f"doc store format version {manifest.get('format_version')}, expected {FORMAT_VERSION}"
+        )
+    if corpus_file is not None and os.path.exists(corpus_file):
+        if not file_unchanged(corpus_file, manifest["corpus_sha256"], manifest.get("corpus_stat")):
+            raise StaleIndexError(f"{corpus_file} changed since the doc store was written")
+
+    return DocStore(store_dir, manifest)
+
+
+def load_corpus(corpus_pickle, store_dir=DOC_STORE_DIR, corpus_file=None):
+    """
+    Used by the search engines: prefer the memory-mapped doc store, fall
+    back to the pickled DataFrame if there is none or it is stale.
+    -----
+    RETURNS DocStore or DataFrame
+    """
+    try:
+        return open_doc_store(store_dir, corpus_file)
+    except FileNotFoundError:
+        pass
+    except StaleIndexError as e:
+        print(f"** Ignoring stale doc store in {store_dir}: {e}")
+        print("** Falling back to the pickled corpus. Re-run idx_tfidf.py to rebuild.")
+
+    return pickle.load(open(corpus_pickle, "rb"))
+
+
+def as_column_store(corpus):
+    """
+    DocStore as is, a DataFrame wrapped in a ColumnStore
+    """
+    return corpus if isinstance(corpus, ColumnStore) else ColumnStore(corpus)
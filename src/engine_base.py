@@ -0,0 +1,190 @@
+"""
+What BasicMontessoriSearchEngine and FilterMontessoriSearchEngine share:
+loading the index (memory-mapped or pickled) with its delta segments and
+optional extras (BM25, dense, shards, snippets, duplicate clusters), and
+the ranking steps their search() / search_many() are built from.
+
+    _ranking         scorer + query vectors for "tfidf" / "bm25" / "dense"
+    _top_k           scorer.top_k, collapsed to one hit per duplicate cluster
+    _top_k_many      the same for a batch of queries
+    _top_groups      best hit of each of the k best groups (grouping.py)
+
+Usage:
+    class MyEngine(SearchEngineBase):
+        def __init__(self):
+            self._load_index()
+"""
+
+import pickle
+
+import numpy as np
+
+from dedup import DUPLICATES_FILE, load_duplicate_clusters
+from dense import DENSE_DIR, load_dense_index
+from diversify import Diversifier
+from doc_store import DOC_STORE_DIR, as_column_store, load_corpus
+from grouping import HitGrouper
+from index_store import INDEX_DIR, compute_row_norms, load_tfidf_matrix
+from instrumentation import Instrumentation
+from segments import attach_segments, count_vectorize, vectorize
+from shards import SHARDS_DIR, load_shards
+from snippets import SNIPPETS_DIR, load_snippet_index
+from topk import RANKINGS, PostingsScorer
+
+
+VECTORIZER_FILE = "models/tfidf_vectorizer.pkl"
+MATRIX_FILE = "models/tfidf_matrix.pkl"
+CORPUS_FILE = "models/corpus_processed.pkl"
+SOURCE_CORPUS_FILE = "data/full_corpus.csv"
+
+
+class SearchEngineBase:
+    """
+    Index loading and ranking steps of the search engines (see module docstring).
+    """
+    def _load_index(self):
+        self.vectorizer = pickle.load(open(VECTORIZER_FILE, "rb"))
+
+        # memory-mapped document store if there is a valid one, else the pickle
+        corpus = load_corpus(CORPUS_FILE, DOC_STORE_DIR, SOURCE_CORPUS_FILE)
+
+        # memory-mapped index if there is a valid one, else the pickle
+        self.tfidf_matrix, self.row_norms, self.index_manifest = load_tfidf_matrix(
+            MATRIX_FILE,
+            index_dir=INDEX_DIR,
+            corpus_file=SOURCE_CORPUS_FILE,
+            vectorizer_file=VECTORIZER_FILE,
+            n_docs=len(corpus),
+        )
+
+        # delta segments / tombstones from incremental updates (segments.py)
+        segments = attach_segments(self.tfidf_matrix, corpus, self.index_manifest)
+        self.tfidf_matrix = segments.matrix
+        self.live_mask = segments.live_mask
+        self.segment_generation = segments.generation
+        self.oov_buckets = segments.oov_buckets
+
+        # hits read their fields from here, only when accessed
+        self.store = as_column_store(segments.corpus)
+
+        if self.index_manifest is not None and not segments.n_delta_docs and not self.oov_buckets:
+            self.scorer = PostingsScorer.from_index(INDEX_DIR, self.index_manifest)
+        else:
+            if segments.n_delta_docs:
+                self.row_norms = compute_row_norms(self.tfidf_matrix)
+            self.scorer = PostingsScorer.from_matrix(self.tfidf_matrix, self.row_norms)
+
+        # BM25 postings if the index has them (idx_tfidf.py --bm25); they
+        # only cover the base documents, so not with delta segments
+        self.bm25_scorer = None
+        if self.index_manifest is not None and "bm25" in self.index_manifest and not segments.n_delta_docs:
+            self.bm25_scorer = PostingsScorer.from_bm25_index(INDEX_DIR, self.index_manifest)
+
+        # LSA embeddings + IVF index if built (idx_tfidf.py --dense), same
+        # restriction; engine.dense_index.nprobe tunes its recall
+        self.dense_index = None
+        if not segments.n_delta_docs:
+            self.dense_index = load_dense_index(self.index_manifest, DENSE_DIR)
+
+        # document shards scored in parallel (idx_tfidf.py --shards), only
+        # without delta segments / OOV hashing; same results as self.scorer
+        self.shards = None
+        if self.index_manifest is not None and not segments.n_delta_docs and not self.oov_buckets:
+            self.shards = load_shards(self.index_manifest, SHARDS_DIR)
+
+        # token offsets for query-aware snippets (search(..., snippets=True))
+        self.snippets = load_snippet_index(self.index_manifest, self.vectorizer, SNIPPETS_DIR)
+
+        # near-duplicate clusters (dedup.py) for search(..., collapse=True)
+        self.duplicates = load_duplicate_clusters(self.store, DUPLICATES_FILE)
+
+        # MMR / per-source quota over the top-N (search(..., diversify=...))
+        self.diversifier = Diversifier(self.tfidf_matrix, self.store)
+
+        # doc -> source_file / source_title codes (search(..., group_by=...))
+        self.grouper = HitGrouper(self.store)
+
+        # per-stage timers / counters / sampled profiling (instrumentation.py)
+        self.instrumentation = Instrumentation()
+
+    def check_ranking(self, ranking):
+        """
+        ValueError unless ranking is in RANKINGS and this engine's index has it
+        """
+        if ranking not in RANKINGS:
+            raise ValueError(f"ranking must be one of {RANKINGS}, got {ranking!r}")
+        if ranking == "bm25" and self.bm25_scorer is None:
+            raise ValueError("no BM25 index, rebuild it with: python src/idx_tfidf.py --bm25")
+        if ranking == "dense" and self.dense_index is None:
+            raise ValueError("no dense index, rebuild it with: python src/idx_tfidf.py --dense")
+
+    def _ranking(self, processed, ranking):
+        """
+        RETURNS (scorer, query vectors) for a ranking in RANKINGS
+        """
+        self.check_ranking(ranking)
+        if ranking == "bm25":
+            return self._scorer("bm25", self.bm25_scorer), count_vectorize(self.vectorizer, processed)
+        if ranking == "dense":
+            return self.dense_index, vectorize(self.vectorizer, processed)
+        return self._scorer("tfidf", self.scorer), vectorize(self.vectorizer, processed, self.oov_buckets)
+
+    def _top_k(self, scorer, query_vec, k, candidates, timer, collapse):
+        """
+        scorer.top_k, one hit per near-duplicate cluster if collapse
+        """
+        if collapse and self.duplicates is not None:
+            return self.duplicates.top_k(
+                lambda fetch: scorer.top_k(query_vec, fetch, candidates=candidates, timer=timer), k
+            )
+        return scorer.top_k(query_vec, k, candidates=candidates, timer=timer)
+
+    def _top_groups(self, scorer, query_vec, group_by, k, candidates, timer, collapse):
+        """
+        Every match of the query, and the best hit of each of the k best
+        groups of them (grouping.py), one per near-duplicate cluster if
+        collapse
+        """
+        _, (doc_ids, scores) = scorer.top_k_matches(query_vec, k, candidates=candidates, timer=timer)
+        matches = doc_ids, scores
+        if collapse and self.duplicates is not None:
+            order = np.argsort(-scores, kind="stable")
+            doc_ids, scores = self.duplicates.collapse(doc_ids[order], scores[order], len(order))
+        grouped = self.grouper.top_groups(group_by, doc_ids, scores, k)
+        timer.mark("group")
+        return matches, grouped
+
+    def _check_group_by(self, group_by, diversify):
+        if group_by is not None:
+            self.grouper.check(group_by)
+            if diversify:
+                raise ValueError("group_by and diversify can't be combined")
+
+    def _top_k_many(self, scorer, query_matrix, k, candidates, batch_size, collapse):
+        """
+        scorer.top_k_many, one hit per near-duplicate cluster if collapse
+        """
+        if collapse and self.duplicates is not None:
+            per_query = candidates if isinstance(candidates, list) else [candidates] * query_matrix.shape[0]
+            return self.duplicates.top_k_many(
+                lambda fetch: scorer.top_k_many(query_matrix, fetch, candidates=candidates, batch_size=batch_size),
+                lambda i, fetch: scorer.top_k(query_matrix[i], fetch, candidates=per_query[i]),
+                k,
+            )
+        return scorer.top_k_many(query_matrix, k, candidates=candidates, batch_size=batch_size)
+
+    def _scorer(self, kind, scorer):
+        """
+        The shard coordinator for kind if there are shards with it, else scorer
+        """
+        if self.shards is not None and kind in self.shards.kinds:
+            return self.shards.scorer(kind)
+        return scorer
+
+    @property
+    def corpus(self):
+        """
+        The corpus as a DataFrame, only materialised when asked for
+        (searching goes through self.store).
+        """
+        return self.store.to_frame()
@@ -0,0 +1,163 @@
+"""
+Facet index for metadata filtering.
+
+Every (lowercased) value of a metadata column gets a packed bitmap
+(one bit per document, np.packbits). Filters are then evaluated with
+bitwise AND/OR over these bitmaps instead of pandas string scans.
+Compound domains (e.g. "Behavioral/Cognitive") are values of their own,
+so whatever DOMAIN_FILTER_MAP["implies"] expands to is a bitmap OR.
+
+For facet counts (how many Montessori vs Traditional hits a query has)
+the COUNT_COLUMNS are also kept as integer codes per document; counts()
+is then one np.bincount over the codes of the matched documents. A
+compound domain counts towards each of its parts.
+"""
+
+import numpy as np
+import pandas as pd
+
+from hits import ColumnStore
+
+
+FACET_COLUMNS = ["approach", "evidence_type", "domain"]
+COUNT_COLUMNS = ["approach", "evidence_type", "domain", "source_type", "source_title"]
+
+# multi-valued columns: separator between the values of one document
+SPLIT_VALUES = {"domain": "/"}
+
+# popcount of every byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class FacetIndex:
+    """
+    Packed bitmaps per metadata value, built once from the corpus.
+    """
+    def __init__(self, n_docs, bitmaps, live_mask=None, codes=None):
+        self.n_docs = n_docs
+        self.bitmaps = bitmaps     # {column: {lowercased value: packed bitmap}}
+        self.codes = codes or {}   # {column: (int32 code per doc, -1 missing; labels)}
+        self._parts = {col: _split_labels(labels, SPLIT_VALUES[col])
+                       for col, (_, labels) in self.codes.items() if col in SPLIT_VALUES}
+        self.n_bytes = (n_docs + 7) // 8
+        if live_mask is None:
+            live_mask = np.ones(n_docs, dtype=bool)
+        self._live = np.packbits(live_mask)
+
+    @classmethod
+    def from_corpus(cls, corpus, columns=FACET_COLUMNS, live_mask=None, count_columns=COUNT_COLUMNS):
+        """
+        :param corpus: DataFrame, or a column store (hits.ColumnStore /
+            doc_store.DocStore), whose factorize() gives the codes directly
+        :param live_mask: optional boolean mask of non-deleted documents
+            (see segments.py); all_docs() only covers these
+        :param count_columns: columns kept as codes for counts()
+        """
+        if isinstance(corpus, pd.DataFrame):
+            corpus = ColumnStore(corpus)
+
+        factorized = {col: corpus.factorize(col) for col in dict.fromkeys(columns + count_columns)}
+        count_codes = {
+            col: (factorized[col][0].astype(np.int32), [str(v) for v in factorized[col][1]])
+            for col in count_columns
+        }
+
+        bitmaps = {}
+        for col in columns:
+            codes, values = factorized[col]
+            # case variants of a value share one bitmap
+            lowered, merged = pd.factorize(pd.Series([str(v).lower() for v in values], dtype=object))
+            codes = np.where(codes >= 0, np.append(lowered, -1)[codes], -1)
+            bitmaps[col] = {
+                value: np.packbits(codes == code)
+                for code, value in enumerate(merged)
+            }
+        return cls(len(corpus), bitmaps, live_mask, count_codes)
+
+    # ----------------------------------------------
+    # BITMAP OPS
+    # ----------------------------------------------
+
+    def all_docs(self):
+        return self._live.copy()
+
+    def none(self):
+        return np.zeros(self.n_bytes, dtype=np.uint8)
+
+    def value(self, column, value):
+        """
+        Bitmap of documents where column == value (case-insensitive).
+        """
+        return self.bitmaps[column].get(value.lower(), self.none())
+
+    def any_of(self, column, values):
+        """
+        Bitmap of documents where column is one of values (bitwise OR).
+        """
+        bitmap = self.none()
+        for v in values:
+            bitmap = bitmap | self.value(column, v)
+        return bitmap
+
+    def count(self, bitmap):
+        return int(_POPCOUNT[bitmap].sum())
+
+    def to_mask(self, bitmap):
+        """
+        Unpack to a boolean mask over documents (what the scorer takes).
+        """
+        return np.unpackbits(bitmap, count=self.n_docs).astype(bool)
+
+    def to_doc_ids(self, bitmap):
+        return np.flatnonzero(self.to_mask(bitmap))
+
+    def contains(self, bitmap, doc_ids):
+        """
+        Boolean array: is each of doc_ids set in bitmap (without unpacking it)
+        """
+        doc_ids = np.asarray(doc_ids)
+        return ((bitmap[doc_ids >> 3] >> (7 - (doc_ids & 7))) & 1).astype(bool)
+
+    # ----------------------------------------------
+    # COUNTS
+    # ----------------------------------------------
+
+    def counts(self, doc_ids, columns=None):
+        """
+        Facet counts over some documents (e.g. the matches of a query).
+        -----
+        :param doc_ids: document indices
+        :param columns: any of the count columns (default all)
+        -----
+        RETURNS {column: {value: count}}, most frequent first, zero counts left out
+        """
+        columns = list(self.codes) if columns is None else columns
+        unknown = [c for c in columns if c not in self.codes]
+        if unknown:
+            raise ValueError(f"no facet counts for {unknown}, expected any of {list(self.codes)}")
+
+        doc_ids = np.asarray(doc_ids, dtype=np.intp)
+        result = {}
+        for col in columns:
+            codes, labels = self.codes[col]
+            # shifted by one so missing values (-1) land in bin 0
+            counts = np.bincount(codes[doc_ids] + 1, minlength=len(labels) + 1)[1:]
+            if col in self._parts:
+                part_of, labels = self._parts[col]
+                counts = counts @ part_of
+            order = np.argsort(-counts, kind="stable")
+            result[col] = {labels[i]: int(counts[i]) for i in order if counts[i]}
+        return result
+
+
+def _split_labels(labels, sep):
+    """
+    RETURNS (part_of, parts): part_of[i, j] = 1 if value i contains part j
+    """
+    split = [[p.strip() for p in label.split(sep) if p.strip()] for label in labels]
+    parts = list(dict.fromkeys(p for ps in split for p in ps))
+    position = {p: j for j, p in enumerate(parts)}
+    part_of = np.zeros((len(labels), len(parts)), dtype=np.int64)
+    for i, ps in enumerate(split):
+        part_of[i, [position[p] for p in ps]] = 1
+    return part_of, parts
@@ -14,221 +14,332 @@ Usage:
 """
 
 
-import pickle
 import numpy as np
 import sys
-from sklearn.metrics.pairwise import cosine_similarity
 from idx_tfidf import preprocess_text
+from topk import select_matches
+from hits import build_hits, build_hits_many
+from snippets import highlight
+from engine_base import SearchEngineBase
+from facets import FacetIndex
+from lexicon import DOMAIN_FILTER_MAP, query_lexicon
 import time
+FILTER_POLICIES = ("prompt", "auto", "suggest", "off")
 
-
-VECTORIZER_FILE = "models/tfidf_vectorizer.pkl"
-MATRIX_FILE = "models/tfidf_matrix.pkl"
-CORPUS_FILE = "models/corpus_processed.pkl"
-
-MONTESSORI_MATERIALS = {
-    "pink tower", "metal inset", "stamp game", "movable alphabet",
-    "spindle box", "binomial cube", "trinomial cube",
-    "knobbed cylinder", "golden bead", "sandpaper letter",
-    "red rod", "long rod", "brown stair", "color tablet",
-    "sound cylinder", "rough and smooth board", "geometry cabinet",
-    "botany cabinet", "fraction inset"
-}
-
-DOMAIN_FILTER_MAP = {
-    "Cognitive": {
-        "keywords": [
-            "cognitive", "attention", "memory", "executive",
-            "problem solving", "thinking", "concentration"
-        ],
-        "implies": [
-            "Cognitive",
-            "Behavioral/Cognitive",
-            "Academic/Cognitive",
-            "Behavioral", # pretty hand in hand/similar
-        ],
-    },
-
-    "Behavioral": {
-        "keywords": [
-            "behavior", "misbehavior", "discipline", "self-regulation",
-            "motivation", "reward", "punishment", "control"
-        ],
-        "implies": [
-            "Behavioral",
-            "Behavioral/Cognitive",
-            "Behavioral/Social",
-            "Cognitive", # pretty hand in hand/similar
-        ],
-    },
-
-    "Social": {
-        "keywords": [
-            "social", "peer", "collaboration", "interaction",
-            "community", "group", "age"
-        ],
-        "implies": [
-            "Social",
-            "Behavioral/Social",
-            "Cognitive/Social",
-        ],
-    },
-
-    "Academic": {
-        "keywords": [
-            "academic", "reading", "math", "literacy",
-            "numeracy", "achievement", "school performance"
-        ],
-        "implies": [
-            "Academic",
-            "Academic/Cognitive",
-            "Academic/Behavioral",
-        ],
-    },
-
-    "Environment": {
-        "keywords": [
-            "environment", "classroom", "noise", "space",
-            "materials", "prepared environment"
-        ],
-        "implies": [
-            "Environment",
-            "Cognitive/Environment",
-            "Academic/Environment",
-        ],
-    },
-}
-
-def infer_domains(query):
-    q = query.lower()
+def _domains(matched):
     domains = set()
 
-    for group in DOMAIN_FILTER_MAP.values():
-        if any(kw in q for kw in group["keywords"]):
-            domains.update(group["implies"])
+    for name in matched.get("domain", ()):
+        domains.update(DOMAIN_FILTER_MAP[name]["implies"])
 
-    return list(domains) if domains else None
+    return sorted(domains) if domains else None
 
 
-def infer_evidence_type(query):
-    q = query.lower()
+def _evidence_type(matched):
+    evidence_types = matched.get("evidence_type", ())
 
-    if any(mat in q for mat in MONTESSORI_MATERIALS):
+    if "Material" in evidence_types:
         return "Material"
-    
-    if any(w in q for w in ["study", "studies", "research", "citation"]):
+
+    if "Study" in evidence_types:
         return "Study"
 
     return None
 
 
-class FilterMontessoriSearchEngine:
-    
+def infer_domains(query, lexicon=None):
+    return _domains((lexicon or query_lexicon()).labels(query))
+
+
+def infer_evidence_type(query, lexicon=None):
+    return _evidence_type((lexicon or query_lexicon()).labels(query))
+
+
+class FilterMontessoriSearchEngine(SearchEngineBase):
+
     def __init__(self):
         # print("Loading TF-IDF index...")
-        self.vectorizer = pickle.load(open(VECTORIZER_FILE, "rb"))
-        self.tfidf_matrix = pickle.load(open(MATRIX_FILE, "rb"))
-        self.corpus = pickle.load(open(CORPUS_FILE, "rb"))
+        self._load_index()
+
+        # bitmaps for approach / evidence_type / domain filtering
+        self.facets = FacetIndex.from_corpus(self.store, live_mask=self.live_mask)
+        self.n_live = len(self.store) if self.live_mask is None else int(np.count_nonzero(self.live_mask))
 
-        print(f"Loaded {len(self.corpus)} documents.")
+        # compiled keyword lexicons for filter inference
+        self.lexicon = query_lexicon()
+
+        print(f"Loaded {len(self.store)} documents.")
         print("Search engine ready.\n")
 
     def infer_filters(self, query):
-        ### FILTERABLES ARE HARD CODED ... COULD BE IMPROVED UPON ###
-        q = query.lower()
+        ### FILTERABLES ARE HARD CODED (lexicon.py) ... COULD BE IMPROVED UPON ###
+        matched = self.lexicon.labels(query)
 
         # APPROACH
-        if "montessori" in q and "traditional" not in q:
-            approach = "Montessori"
-        elif "traditional" in q and "montessori" not in q:
-            approach = "Traditional"
-        else:
-            approach = None
+        approaches = matched.get("approach", set())
+        approach = approaches.pop() if len(approaches) == 1 else None
 
-        evidence = infer_evidence_type(query)
-        domain = infer_domains(query)
+        evidence = _evidence_type(matched)
+        domain = _domains(matched)
 
         return approach, evidence, domain
 
 
-    ## improved search with filters :)
-    def search(self, query, k=5):
+    def suggest_filters(self, query):
+        """
+        Filters inferred from the query, as a dict with only the detected
+        ones ("approach", "evidence_type", "domain"), or None.
+        """
         approach_f, evidence_f, domain_f = self.infer_filters(query)
-        processed = preprocess_text(query)
-        query_vec = self.vectorizer.transform([processed])
-        scores = cosine_similarity(query_vec, self.tfidf_matrix).flatten()
-        valid_indices = np.arange(len(scores)) # for filtering; default is ALL
-
-        if any(x is not None for x in (approach_f, evidence_f, domain_f)):
-
-            filters = {
-                "approach": approach_f,
-                "evidence_type": evidence_f,
-                "domain": domain_f
-            }
-            active_filters = {k: v for k, v in filters.items() if v is not None}
-            filter_str = ", ".join(f"{k}={v}" for k, v in active_filters.items())
+        filters = {
+            "approach": approach_f,
+            "evidence_type": evidence_f,
+            "domain": domain_f
+        }
+        active_filters = {k: v for k, v in filters.items() if v is not None}
+        return active_filters or None
+
+    def _prompt_filters(self, active_filters):
+        filter_str = ", ".join(f"{k}={v}" for k, v in active_filters.items())
+        apply = input(
+            f"\n\t** Recommended filters detected\n"
+            f"\t{filter_str}\n"
+            f"\tApply these filters? [y/N]: "
+        )
+
+        while apply.lower() not in ["y", "n"]:
+            print("\n\tSorry, I didn't quite catch that.")
             apply = input(
                 f"\n\t** Recommended filters detected\n"
                 f"\t{filter_str}\n"
                 f"\tApply these filters? [y/N]: "
             )
 
-            while apply.lower() not in ["y", "n"]:
-                print("\n\tSorry, I didn't quite catch that.")
-                apply = input(
-                    f"\n\t** Recommended filters detected\n"
-                    f"\t{filter_str}\n"
-                    f"\tApply these filters? [y/N]: "
+        return apply.lower().strip() == "y"
+
+    ## improved search with filters :)
+    def search(self, query, k=5, filter_policy="prompt", fields=None, ranking="tfidf", trace=False,
+               facets=None, facet_top_n=None, facet_min_score=0.0, snippets=False, collapse=False, diversify=None,
+               group_by=None):
+        """
+        Top-k documents for a query.
+        -----
+        :param query: query string
+        :param k: number of results
+        :param filter_policy: what to do with filters inferred from the query
+            "prompt"  ask on stdin whether to apply them (interactive CLI)
+            "auto"    apply them
+            "suggest" don't apply them (see suggest_filters() to show them)
+            "off"     don't infer filters at all
+        :param fields: fields the hits expose, default all of RESULT_FIELDS;
+            hits only read a field from the corpus when it is accessed
+        :param ranking: "tfidf" (cosine), "bm25" (needs idx_tfidf.py --bm25)
+            or "dense" (LSA, approximate; needs idx_tfidf.py --dense)
+        :param trace: attach this query's stage times and counters as
+            results.trace (see instrumentation.py)
+        :param facets: True (all of facets.COUNT_COLUMNS) or a list of
+            columns: attach counts of their values over the matching
+            documents as results.facets, {"n_docs": ..., "counts": {column:
+            {value: count}}}, from the same scoring pass
+        :param facet_top_n: only count the best facet_top_n matches
+        :param facet_min_score: only count matches scoring above this
+        :param snippets: give every hit a "snippet": the passage window
+            with the most query terms, highlighted (see snippets.py)
+        :param collapse: one hit per near-duplicate cluster (the best
+            scoring), if there is a duplicate map (see dedup.py)
+        :param diversify: "mmr" or "source": pick the k hits from the
+            top diversifier.n_candidates for diversity (see diversify.py)
+        :param group_by: "source_file" or "source_title": the best hit of
+            each of the k best groups of matches instead, each with a
+            "group" entry {"field", "value", "n_hits"} (see grouping.py);
+            results.groups gives the documents and groups matched
+        -----
+        RETURNS list of lazy Hits (see hits.py)
+        """
+        if filter_policy not in FILTER_POLICIES:
+            raise ValueError(f"filter_policy must be one of {FILTER_POLICIES}, got {filter_policy!r}")
+        self._check_group_by(group_by, diversify)
+
+        with self.instrumentation.start() as timer:
+            processed = preprocess_text(query)
+            timer.mark("preprocess")
+            scorer, query_vec = self._ranking([processed], ranking)
+            timer.mark("vectorize")
+            candidates = self.live_mask
+
+            active_filters = None
+            if filter_policy in ("prompt", "auto"):
+                active_filters = self.suggest_filters(query)
+
+            if active_filters:
+                if filter_policy == "auto" or self._prompt_filters(active_filters):
+                    candidates, fell_back = self.filter_candidates(
+                        active_filters.get("approach"),
+                        active_filters.get("evidence_type"),
+                        active_filters.get("domain"),
+                        k,
+                    )
+                    self._count_filtering(timer, candidates, fell_back)
+                    if filter_policy == "prompt":
+                        if fell_back:
+                            print(f"\t** Filters invalid! reverting to approach filter only... ")
+                        else:
+                            print("\t** Filters valid! proceeding...")
+            timer.mark("filter")
+
+            # top-k among valid indices (only these are scored)
+            n_fetch = self.diversifier.fetch(diversify, k)
+            if group_by:
+                (matched, scores), (top_k, top_scores, values, n_hits, summary) = self._top_groups(
+                    scorer, query_vec, group_by, k, candidates, timer, collapse
                 )
+                if facets:
+                    # over the same matches
+                    counted, _ = select_matches(matched, scores, facet_min_score, facet_top_n)
+                    columns = None if facets is True else facets
+                    facet_counts = {"n_docs": len(counted), "counts": self.facets.counts(counted, columns)}
+                    timer.mark("facets")
+            elif not facets:
+                top_k, top_scores = self._top_k(scorer, query_vec, n_fetch, candidates, timer, collapse)
+            elif collapse and self.duplicates is not None:
+                # every match scored once: the facet counts and the collapsed hits both come from it
+                _, (matched, scores) = scorer.top_k_matches(query_vec, n_fetch, candidates=candidates, timer=timer)
+                top_k, top_scores = self.duplicates.top_k_of(matched, scores, n_fetch, scorer.n_docs, candidates)
+                counted, _ = select_matches(matched, scores, facet_min_score, facet_top_n)
+                columns = None if facets is True else facets
+                facet_counts = {"n_docs": len(counted), "counts": self.facets.counts(counted, columns)}
+                timer.mark("facets")
+            else:
+                (top_k, top_scores), (matched, _) = scorer.top_k_matches(
+                    query_vec, n_fetch, candidates=candidates, min_score=facet_min_score, top_n=facet_top_n,
+                    timer=timer,
+                )
+                columns = None if facets is True else facets
+                facet_counts = {"n_docs": len(matched), "counts": self.facets.counts(matched, columns)}
+                timer.mark("facets")
+            if diversify:
+                top_k, top_scores = self.diversifier.rerank(diversify, top_k, top_scores, k)
+                timer.mark("diversify")
+
+            results = build_hits(self.store, top_k, top_scores, fields)
+            if facets:
+                results.facets = facet_counts
+            if group_by:
+                self.grouper.attach(results, group_by, values, n_hits)
+                results.groups = summary
+            timer.mark("hits")
+            if snippets:
+                self.snippets.attach(results, query_vec.indices)
+                timer.mark("snippets")
+            results.trace = timer.finish(trace)
+        return results
 
-            if apply.lower().strip() == "y":
-
-                # APPLY FILTERS
-                if approach_f:
-                    mask = (self.corpus["approach"].str.lower() == approach_f.lower()).values
-                    valid_indices = valid_indices[mask[valid_indices]]
-
-                if evidence_f:
-                    mask = (self.corpus["evidence_type"].str.lower() == evidence_f.lower()).values
-                    valid_indices = valid_indices[mask[valid_indices]]
-
-                if domain_f:
-                    domain_f_lower = [d.lower() for d in domain_f]
-                    mask = self.corpus["domain"].str.lower().isin(domain_f_lower).values
-                    valid_indices = valid_indices[mask[valid_indices]]
-
-
-                # if not enough docs, revert to whole corpus
-                if len(valid_indices) < k:
-                    print(f"\t** Filters invalid! reverting to approach filter only... ")
-                    valid_indices = np.arange(len(scores))
-                    # only filter on approach instead
-                    if approach_f:
-                        valid_indices = valid_indices[self.corpus["approach"].str.lower() == approach_f.lower()]
-                else:
-                    print("\t** Filters valid! proceeding...")
-
-        # top-k among valid indices
-        top_k = valid_indices[np.argsort(scores[valid_indices])[::-1][:k]]
-
-        results = []
-        for idx in top_k:
-            row = self.corpus.iloc[idx]
-            results.append({
-                "score": float(scores[idx]),
-                "doc_id": row["doc_id"],
-                "text": row["text"],
-                "raw_text": row["raw_text"],
-                "approach": row["approach"],
-                "domain": row["domain"],
-                "evidence_type": row["evidence_type"],
-                "source_title": row["source_title"],
-                "source_type": row["source_type"],
-                "paragraph_index": row["paragraph_index"]
-            })
+    def _count_filtering(self, timer, mask, fell_back, n_queries=1):
+        timer.count("docs_filtered_out", n_queries * (self.n_live - int(np.count_nonzero(mask))))
+        if fell_back:
+            timer.count("filter_fallbacks", n_queries)
+
+    def filter_candidates(self, approach_f, evidence_f, domain_f, k):
+        """
+        Boolean mask of the documents matching the filters, evaluated
+        as bitwise AND/OR over the facet bitmaps.
+        -----
+        If fewer than k documents match, reverts to the approach filter only.
+        RETURNS (mask, fell_back)
+        """
+        bitmap = self.facets.all_docs()
+
+        # APPLY FILTERS
+        if approach_f:
+            bitmap &= self.facets.value("approach", approach_f)
+
+        if evidence_f:
+            bitmap &= self.facets.value("evidence_type", evidence_f)
+
+        if domain_f:
+            bitmap &= self.facets.any_of("domain", domain_f)
+
+        # if not enough docs, revert to whole corpus
+        fell_back = self.facets.count(bitmap) < k
+        if fell_back:
+            # only filter on approach instead
+            bitmap = self.facets.all_docs()
+            if approach_f:
+                bitmap &= self.facets.value("approach", approach_f)
+
+        return self.facets.to_mask(bitmap), fell_back
+
+    def search_many(self, queries, k=5, filters=None, batch_size=256, fields=None, ranking="tfidf", trace=False,
+                    snippets=False, collapse=False, diversify=None):
+        """
+        Batched, non-interactive search: all queries are preprocessed and
+        vectorized together and scored with one sparse matrix product
+        per batch.
+        -----
+        :param queries: list of query strings
+        :param k: number of results per query
+        :param filters: None (no filtering), "auto" (each query's inferred
+            filters, see suggest_filters), one dict with any of
+            "approach"/"evidence_type"/"domain" for every query, or a list
+            with a dict (or None) per query
+        :param batch_size: queries per scoring batch (bounds memory)
+        :param fields: as for search()
+        :param ranking: as for search()
+        :param trace: attach the batch's trace to every result list
+        :param snippets: as for search()
+        :param collapse: as for search()
+        :param diversify: as for search()
+        -----
+        RETURNS one result list (as from search()) per query
+        """
+        with self.instrumentation.start(n_queries=len(queries)) as timer:
+            if filters == "auto":
+                filters = [self.suggest_filters(q) for q in queries]
+            elif filters is None or isinstance(filters, dict):
+                filters = [filters] * len(queries)
+
+            # identical filters share one mask
+            masks = {}
+            uses = {}
+            candidates = []
+            for f in filters:
+                if not f:
+                    candidates.append(self.live_mask)
+                    continue
+                key = (f.get("approach"), f.get("evidence_type"), tuple(f.get("domain") or ()))
+                if key not in masks:
+                    masks[key] = self.filter_candidates(
+                        f.get("approach"), f.get("evidence_type"), f.get("domain"), k
+                    )
+                uses[key] = uses.get(key, 0) + 1
+                candidates.append(masks[key][0])
+            for key, (mask, fell_back) in masks.items():
+                self._count_filtering(timer, mask, fell_back, uses[key])
+            timer.mark("filter")
+
+            processed = [preprocess_text(q) for q in queries]
+            timer.mark("preprocess")
+            scorer, query_matrix = self._ranking(processed, ranking)
+            timer.mark("vectorize")
+
+            n_fetch = self.diversifier.fetch(diversify, k)
+            ranked = self._top_k_many(scorer, query_matrix, n_fetch, candidates, batch_size, collapse)
+            timer.mark("score")
+            if diversify:
+                ranked = [self.diversifier.rerank(diversify, ids, scores, k) for ids, scores in ranked]
+                timer.mark("diversify")
+            results = build_hits_many(self.store, ranked, fields)
+            timer.mark("hits")
+            if snippets:
+                for i, hits in enumerate(results):
+                    self.snippets.attach(hits, query_matrix[i].indices)
+                timer.mark("snippets")
+            batch_trace = timer.finish(trace)
+        for r in results:
+            r.trace = batch_trace
         return results
-    
+
+
 if __name__ == "__main__":
     print("-=+ MONTOSSEORI EVIDENCE RETRIEVAL SYSTEM +=-")
     engine = FilterMontessoriSearchEngine()
@@ -250,7 +361,7 @@ if __name__ == "__main__":
             print("\tInvalid interger, using default (5).")
             k = 5
         
-        results = engine.search(query, k=5)
+        results = engine.search(query, k=5, snippets=True)
         print(f"\n=== QUERY: {query} ===")
         # print("\nSearching for relevant texts...")
 
@@ -263,7 +374,7 @@ if __name__ == "__main__":
                 print(f"Approach: {r['approach']}")
             if r["domain"] is not None and str(r["domain"]).lower() != "nan":
                 print(f"Domain: {r['domain']}")
-            print(f"Text: {r['raw_text'][:min(500, len(r['text']))]}...")
+            print(f"Text: {highlight(r['snippet'])}")
             time.sleep(1)
         print(f"\n=== END SEARCH ON: {query} ===\n")
 
@@ -0,0 +1,163 @@
+"""
+Search hits that resolve their fields lazily.
+
+A Hit is just (doc index, score) plus a reference to the engine's
+ColumnStore; fields such as "text" are only read from the corpus when
+they are accessed. Hits behave like the result dicts the engines used
+to return (hit["raw_text"], hit.get(...), dict(hit)), so existing
+callers keep working, while callers that only need ids and scores never
+touch the text columns.
+
+Usage:
+    hits = engine.search("pink tower", k=100, fields=["doc_id"])
+    [(h["doc_id"], h.score) for h in hits]
+    dict(hits[0])  ->  {"score": ..., "doc_id": ...}
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+
+RESULT_FIELDS = [
+    "doc_id", "text", "raw_text", "approach", "domain", "evidence_type",
+    "source_title", "source_type", "paragraph_index"
+]
+
+
+class ColumnStore:
+    """
+    Read-only column access to the corpus DataFrame by row position. Each
+    column is pulled out of the DataFrame once, the first time it is
+    needed. (doc_store.DocStore is the memory-mapped equivalent.)
+    """
+    def __init__(self, corpus, fields=RESULT_FIELDS):
+        self.corpus = corpus
+        self.fields = list(fields)
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def column(self, field):
+        values = self._columns.get(field)
+        if values is None:
+            if field not in self.corpus:
+                raise KeyError(field)
+            values = self._columns[field] = self.corpus[field].to_numpy(dtype=object)
+        return values
+
+    def factorize(self, field):
+        """
+        RETURNS (codes, distinct values), code -1 for missing values
+        """
+        codes, uniques = pd.factorize(pd.Series(self.column(field)))
+        return codes, list(uniques)
+
+    def to_frame(self):
+        return self.corpus
+
+    def get(self, field, index):
+        return self.column(field)[index]
+
+    def raw_bytes(self, field, index, start=0, end=None):
+        """
+        UTF-8 bytes [start:end] of a text value (b"" if missing)
+        """
+        value = self.get(field, index)
+        return value.encode("utf-8")[start:end] if isinstance(value, str) else b""
+
+    def check_fields(self, fields):
+        """
+        RETURNS fields as a tuple (all of them for None), ValueError on unknown ones
+        """
+        if fields is None:
+            return tuple(self.fields)
+        fields = tuple(fields)
+        unknown = [f for f in fields if f not in self.fields]
+        if unknown:
+            raise ValueError(f"unknown fields {unknown}, expected any of {self.fields}")
+        return fields
+
+
+class Hit(Mapping):
+    """
+    One search result: doc index (row position in the corpus) and score.
+    Keys are "score" plus the projected fields, "snippet" once one has
+    been set (search(..., snippets=True), see snippets.py) and "group"
+    once one has been set (search(..., group_by=...), see grouping.py).
+    """
+    __slots__ = ("index", "score", "snippet", "group", "_store", "_fields")
+
+    def __init__(self, index, score, store, fields):
+        self.index = index
+        self.score = score
+        self.snippet = None
+        self.group = None
+        self._store = store
+        self._fields = fields
+
+    def __getitem__(self, key):
+        if key == "score":
+            return self.score
+        if key == "snippet" and self.snippet is not None:
+            return self.snippet
+        if key == "group" and self.group is not None:
+            return self.group
+        if key not in self._fields:
+            raise KeyError(key)
+        return self._store.get(key, self.index)
+
+    def __iter__(self):
+        yield "score"
+        yield from self._fields
+        if self.snippet is not None:
+            yield "snippet"
+        if self.group is not None:
+            yield "group"
+
+    def __len__(self):
+        return 1 + len(self._fields) + (self.snippet is not None) + (self.group is not None)
+
+    def to_dict(self):
+        return dict(self)
+
+    def __repr__(self):
+        if "doc_id" in self._fields:
+            return f"Hit(doc_id={self['doc_id']!r}, score={self.score:.4f})"
+        return f"Hit(index={self.index}, score={self.score:.4f})"
+
+
+class SearchResults(list):
+    """
+    The hits of one search, best first: a plain list plus optional
+    extras (None unless asked for): trace (see instrumentation.py),
+    facets (FilterMontessoriSearchEngine.search(facets=...)) and groups
+    (search(group_by=...): the field, matching documents and groups).
+    """
+    trace = None
+    facets = None
+    groups = None
+
+
+def build_hits(store, top_k, top_scores, fields=None):
+    """
+    Hits for one ranked list (ids + scores from topk.py).
+    -----
+    :param fields: fields the hits expose (None = all of RESULT_FIELDS)
+    RETURNS SearchResults
+    """
+    fields = store.check_fields(fields)
+    return SearchResults(
+        Hit(idx, score, store, fields)
+        for idx, score in zip(np.asarray(top_k).tolist(), np.asarray(top_scores, dtype=float).tolist())
+    )
+
+
+def build_hits_many(store, ranked, fields=None):
+    """
+    build_hits for every (top_k, top_scores) in ranked
+    """
+    fields = store.check_fields(fields)
+    return [build_hits(store, top_k, top_scores, fields) for top_k, top_scores in ranked]
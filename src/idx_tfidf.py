@@ -1,9 +1,18 @@
+import argparse
 import pandas as pd
 import pickle
 import os
 import re
+import tempfile
 
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
+from index_store import INDEX_DIR, write_index
+from doc_store import DOC_STORE_DIR, STORE_COLUMNS, write_doc_store_chunks
+from dense import DENSE_DIMS, DENSE_DIR, QUANTIZATIONS, write_dense_index
+from shards import SHARDS_DIR, write_shards
+from snippets import SNIPPETS_DIR, write_snippet_index_chunks
+from tfidf_build import CHUNK_SIZE, build_tfidf_chunked, iter_text_chunks
 
 
 CORPUS_FILE = "data/full_corpus.csv"
@@ -11,6 +20,13 @@ VECTORIZER_FILE = "models/tfidf_vectorizer.pkl"
 MATRIX_FILE = "models/tfidf_matrix.pkl"
 PROCESSED_CORPUS_FILE = "models/corpus_processed.pkl"
 
+TFIDF_PARAMS = {
+    "stop_words": "english",
+    "ngram_range": (1, 2),   # unigrams and bigrams
+    "max_df": 0.9,
+    "min_df": 2,
+}
+
 
 # ----------------------------------------------
 # preproc: lowercase, remove punctuation
@@ -27,26 +43,100 @@ def preprocess_text(text):
 # ----------------------------------------------
 # build TF-IDF index
 # ----------------------------------------------
-def build_tfidf_index():
-    df = pd.read_csv(CORPUS_FILE)
-    df["processed_text"] = df["text"].apply(preprocess_text)
+def build_tfidf_index(write_mmap=True, bm25=False, dense=False, dense_dims=DENSE_DIMS, quantization="int8",
+                      shards=0, workers=0, chunk_size=CHUNK_SIZE):
+    """
+    Fit the vectorizer and pickle it alongside the TF-IDF matrix.
+    -----
+    :param write_mmap: also write the memory-mapped index (INDEX_DIR) and
+        document store (doc_store.py) that the search engines load instead
+        of the pickled matrix and corpus, with the token offsets used
+        for snippets (snippets.py)
+    :param bm25: also precompute BM25 weights into the memory-mapped index
+        (ranking="bm25" in the search engines)
+    :param dense: also fit LSA embeddings and write their IVF index
+        (ranking="dense", see dense.py) with dense_dims dimensions,
+        quantised to quantization ("int8" or "float16")
+    :param shards: also split the postings into this many document shards,
+        scored in parallel by the search engines (see shards.py)
+    :param workers: fit the vectorizer and build the matrix out of core,
+        in chunks of chunk_size documents over this many worker processes
+        (see tfidf_build.py; same vocabulary, idf and matrix); 0 = in
+        memory with TfidfVectorizer.fit_transform. The corpus is then
+        never loaded whole: only the vectorizer is pickled, and the
+        memory-mapped index, document store and snippet offsets (which
+        the engines load) are written from chunked reads of the csv
+    """
+    if workers and not write_mmap:
+        raise ValueError("workers needs write_mmap: the out-of-core build is only loadable as the memory-mapped index")
 
-    # processed text for search.py convenience
     os.makedirs("models", exist_ok=True)
-    pickle.dump(df, open(PROCESSED_CORPUS_FILE, "wb"))
+    with_counts = write_mmap and bm25
+    scratch = None
+    if workers:
+        # the matrices are memory-mapped from the scratch dir until the end
+        scratch = tempfile.TemporaryDirectory(prefix="tfidf_build_", dir="models")
+        vectorizer, tfidf_matrix, counts = build_tfidf_chunked(
+            CORPUS_FILE, TFIDF_PARAMS, preprocess_text, scratch.name,
+            workers=workers, chunk_size=chunk_size, with_counts=with_counts,
+        )
+
+        # pickles of an earlier in-memory build would no longer match
+        for stale in (MATRIX_FILE, PROCESSED_CORPUS_FILE):
+            if os.path.exists(stale):
+                os.remove(stale)
+
+        print("Saving vectorizer...")
+        pickle.dump(vectorizer, open(VECTORIZER_FILE, "wb"))
+
+        chunk_rows = chunk_size
+        store_chunks = pd.read_csv(CORPUS_FILE, usecols=STORE_COLUMNS, chunksize=chunk_size)
+        raw_text_chunks = (texts for _, texts in iter_text_chunks(CORPUS_FILE, chunk_size, column="raw_text"))
+    else:
+        df = pd.read_csv(CORPUS_FILE)
+        df["processed_text"] = df["text"].apply(preprocess_text)
+
+        # processed text for search.py convenience
+        pickle.dump(df, open(PROCESSED_CORPUS_FILE, "wb"))
+
+        vectorizer = TfidfVectorizer(**TFIDF_PARAMS)
+        tfidf_matrix = vectorizer.fit_transform(df["processed_text"])
+        # raw term counts over the same vocabulary (no idf, no normalisation)
+        counts = CountVectorizer.transform(vectorizer, df["processed_text"]) if with_counts else None
 
-    vectorizer = TfidfVectorizer(
-        stop_words="english",
-        ngram_range=(1, 2),   # unigrams and bigrams
-        max_df=0.9,
-        min_df=2
-    )
+        print("Saving vectorizer + TF-IDF matrix...")
+        pickle.dump(vectorizer, open(VECTORIZER_FILE, "wb"))
+        pickle.dump(tfidf_matrix, open(MATRIX_FILE, "wb"))
 
-    tfidf_matrix = vectorizer.fit_transform(df["processed_text"])
+        chunk_rows = None
+        store_chunks = [df]
+        raw_text_chunks = [df["raw_text"].tolist()]
 
-    print("Saving vectorizer + TF-IDF matrix...")
-    pickle.dump(vectorizer, open(VECTORIZER_FILE, "wb"))
-    pickle.dump(tfidf_matrix, open(MATRIX_FILE, "wb"))
+    if write_mmap:
+        manifest = write_index(tfidf_matrix, CORPUS_FILE, VECTORIZER_FILE, INDEX_DIR, bm25_counts=counts,
+                               chunk_rows=chunk_rows)
+        print(f"Wrote memory-mapped index to {INDEX_DIR} (build {manifest['build_id']})")
+
+        if shards:
+            shards_manifest = write_shards(tfidf_matrix, manifest, SHARDS_DIR, shards, bm25_counts=counts,
+                                           chunk_rows=chunk_rows)
+            print(f"Wrote {shards_manifest['n_shards']} shards to {SHARDS_DIR}")
+
+        write_doc_store_chunks(store_chunks, CORPUS_FILE, DOC_STORE_DIR)
+        print(f"Wrote memory-mapped document store to {DOC_STORE_DIR}")
+
+        snippets_manifest = write_snippet_index_chunks(raw_text_chunks, vectorizer, manifest, SNIPPETS_DIR)
+        print(f"Wrote snippet offsets ({snippets_manifest['n_tokens']} tokens) to {SNIPPETS_DIR}")
+
+        if dense:
+            dense_manifest = write_dense_index(
+                tfidf_matrix, manifest, DENSE_DIR, n_components=dense_dims, quantization=quantization
+            )
+            print(f"Wrote dense index to {DENSE_DIR} "
+                  f"({dense_manifest['dims']} dims, {dense_manifest['nlist']} lists, {quantization})")
+
+    if scratch is not None:
+        scratch.cleanup()
 
     print("\n-=+ TF-IDF Index Built Successfully +=-")
     print(f"Vocab size: {len(vectorizer.vocabulary_)}")
@@ -55,4 +145,16 @@ def build_tfidf_index():
 
 
 if __name__ == "__main__":
-    build_tfidf_index()
+    parser = argparse.ArgumentParser(description="Build the TF-IDF index")
+    parser.add_argument("--bm25", action="store_true", help="also build BM25 postings")
+    parser.add_argument("--dense", action="store_true", help="also build the LSA/IVF dense index")
+    parser.add_argument("--dense-dims", type=int, default=DENSE_DIMS)
+    parser.add_argument("--quantization", default="int8", choices=QUANTIZATIONS)
+    parser.add_argument("--shards", type=int, default=0, help="split the postings into N document shards")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="fit the TF-IDF matrix out of core over N worker processes (0 = in memory)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="documents per chunk with --workers")
+    args = parser.parse_args()
+
+    build_tfidf_index(bm25=args.bm25, dense=args.dense, dense_dims=args.dense_dims, quantization=args.quantization,
+                      shards=args.shards, workers=args.workers, chunk_size=args.chunk_size)
@@ -0,0 +1,544 @@
+"""
+On-disk TF-IDF index format.
+
+Instead of pickling the whole sparse matrix, the CSR arrays are written as
+raw binary files next to a small JSON manifest. At load time the arrays are
+opened with np.memmap, so starting a search engine does not copy the matrix
+into memory and several processes share the same page cache.
+
+Layout of INDEX_DIR:
+    manifest.json     format version, build id, shapes/dtypes, checksums
+    data.bin          CSR values
+    indices.bin       CSR column indices
+    indptr.bin        CSR row pointers
+    row_norms.bin     L2 norm of every document row
+    postings_*.bin    CSC copy of the row-normalised matrix (per-term
+                      postings lists), used by topk.PostingsScorer
+    term_max.bin      largest normalised weight of every term
+    bm25_*.bin        optional (idx_tfidf.py --bm25): CSC matrix of
+                      precomputed BM25 weights + per-term max weight
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+import uuid
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+
+
+INDEX_DIR = "models/tfidf_index"
+MANIFEST_FILE = "manifest.json"
+FORMAT_VERSION = 2
+
+# BM25 term-frequency saturation and length normalisation
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+class StaleIndexError(Exception):
+    """
+    The on-disk index does not match the corpus/vectorizer it is loaded with.
+    """
+
+
+# ----------------------------------------------
+# HELPERS
+# ----------------------------------------------
+
+_checksums = {}
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """
+    sha256 of a file, read in chunks; computed once per process for a
+    given (path, size, mtime).
+    """
+    key = (os.path.abspath(path), *file_stat(path).values())
+    if key not in _checksums:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(chunk_size), b""):
+                h.update(block)
+        _checksums[key] = h.hexdigest()
+    return _checksums[key]
+
+
+def file_stat(path):
+    """
+    {"size", "mtime_ns"} of a file, the cheap freshness check stored next
+    to its sha256 in the manifests.
+    """
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def file_unchanged(path, sha256, stat=None):
+    """
+    True if the file still is the one with this sha256. Same size and
+    mtime as the stored stat is taken as unchanged, anything else (a
+    touched or copied file, an older manifest without a stat) is settled
+    by the full checksum.
+    """
+    if stat is not None and file_stat(path) == stat:
+        return True
+    return file_checksum(path) == sha256
+
+
+def write_array(index_dir, name, arr):
+    """
+    Write a 1-d array as a raw binary file, return its manifest entry.
+    """
+    arr = np.ascontiguousarray(arr)
+    filename = f"{name}.bin"
+    tmp_path = os.path.join(index_dir, filename + ".tmp")
+    arr.tofile(tmp_path)
+    os.replace(tmp_path, os.path.join(index_dir, filename))
+
+    return {
+        "file": filename,
+        "dtype": arr.dtype.str,
+        "shape": list(arr.shape),
+    }
+
+
+class ArrayAppender:
+    """
+    A 1-d array file written in pieces, e.g. one chunk of documents at a
+    time (.tmp until finish()).
+    """
+    def __init__(self, index_dir, name, dtype):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._path = os.path.join(index_dir, f"{name}.bin")
+        self._file = open(self._path + ".tmp", "wb")
+
+    def append(self, arr):
+        arr = np.ascontiguousarray(arr, dtype=self.dtype)
+        arr.tofile(self._file)
+        self.length += len(arr)
+
+    def finish(self):
+        """
+        RETURNS its manifest entry, as write_array
+        """
+        self._file.close()
+        os.replace(self._path + ".tmp", self._path)
+        return {"file": os.path.basename(self._path), "dtype": self.dtype.str, "shape": [self.length]}
+
+    def discard(self):
+        self._file.close()
+        os.remove(self._path + ".tmp")
+
+
+def create_array(index_dir, name, dtype, length):
+    """
+    Writable memmap of a new 1-d array file, filled in place and then
+    passed to finish_array() (for arrays too large to build in memory).
+    """
+    path = os.path.join(index_dir, f"{name}.bin.tmp")
+    if length == 0:
+        # np.memmap refuses zero-length files
+        open(path, "wb").close()
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="w+", shape=(length,))
+
+
+def finish_array(index_dir, name, arr):
+    """
+    RETURNS the manifest entry of an array from create_array()
+    """
+    if isinstance(arr, np.memmap):
+        arr.flush()
+    filename = f"{name}.bin"
+    os.replace(os.path.join(index_dir, filename + ".tmp"), os.path.join(index_dir, filename))
+    return {"file": filename, "dtype": arr.dtype.str, "shape": list(arr.shape)}
+
+
+def term_destinations(terms, cursor):
+    """
+    Out-of-core transposition: positions in term-major arrays (postings
+    lists) of entries given in document order, with term ids terms.
+    -----
+    :param cursor: next free position of every term's list, advanced in
+        place; chunks fed in document order keep every list in document
+        order, as a full CSR -> CSC conversion would
+    """
+    order = np.argsort(terms, kind="stable")
+    sorted_terms = terms[order]
+    n_terms = np.bincount(terms, minlength=len(cursor))
+    run_start = np.cumsum(n_terms) - n_terms
+    dest = np.empty(len(terms), dtype=np.int64)
+    dest[order] = cursor[sorted_terms] + np.arange(len(terms)) - run_start[sorted_terms]
+    cursor += n_terms
+    return dest
+
+
+def open_array(index_dir, entry):
+    """
+    Memory-map an array described by a manifest entry (read-only).
+    """
+    path = os.path.join(index_dir, entry["file"])
+    dtype = np.dtype(entry["dtype"])
+    shape = tuple(entry["shape"])
+
+    expected = int(np.prod(shape)) * dtype.itemsize
+    actual = os.path.getsize(path)
+    if actual != expected:
+        raise StaleIndexError(
+            f"{entry['file']} is {actual} bytes, manifest expects {expected}"
+        )
+
+    # np.memmap refuses zero-length files
+    if expected == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def read_manifest(index_dir=INDEX_DIR):
+    path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(index_dir, manifest):
+    """
+    Manifest is written last (and atomically), so a half-written index
+    is never picked up.
+    """
+    tmp_path = os.path.join(index_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(index_dir, MANIFEST_FILE))
+
+
+def compute_row_norms(matrix):
+    return np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+
+
+# ----------------------------------------------
+# WRITE
+# ----------------------------------------------
+
+def row_chunks(matrix, chunk_rows=None, lo=0, hi=None):
+    """
+    (first row, CSR rows) of rows lo:hi, chunk_rows at a time (None = all
+    at once, the matrix itself when that is every row)
+    """
+    hi = matrix.shape[0] if hi is None else hi
+    if chunk_rows is None or chunk_rows >= hi - lo:
+        yield lo, matrix if (lo, hi) == (0, matrix.shape[0]) else matrix[lo:hi]
+        return
+    for start in range(lo, hi, chunk_rows):
+        yield start, matrix[start:min(start + chunk_rows, hi)]
+
+
+def chunked_row_norms(matrix, chunk_rows=None):
+    """
+    compute_row_norms, chunk_rows rows at a time
+    """
+    return np.concatenate(
+        [compute_row_norms(rows) for _, rows in row_chunks(matrix, chunk_rows)] + [np.empty(0)]
+    )
+
+
+def normalized_postings(tfidf_matrix, row_norms):
+    """
+    CSC copy of the matrix with every row divided by its L2 norm, so the
+    dot product with a unit query vector is the cosine similarity.
+    -----
+    RETURNS (indptr, indices, data, term_max)
+    """
+    inv = np.zeros(len(row_norms))
+    np.divide(1.0, row_norms, out=inv, where=row_norms > 0)
+
+    postings = (diags(inv) @ csr_matrix(tfidf_matrix)).tocsc()
+    postings.sort_indices()
+    term_max = np.asarray(postings.max(axis=0).todense()).ravel()
+
+    return postings.indptr, postings.indices, postings.data, term_max
+
+
+def row_normalizer(row_norms):
+    """
+    The weigh function of write_postings_chunked for normalized_postings
+    """
+    inv = np.zeros(len(row_norms))
+    np.divide(1.0, row_norms, out=inv, where=row_norms > 0)
+    return lambda start, rows: rows.data * np.repeat(inv[start:start + rows.shape[0]], np.diff(rows.indptr))
+
+
+def bm25_stats(counts, chunk_rows=None):
+    """
+    Document lengths, their mean (avgdl) and idf of every term, for
+    bm25_weights, chunk_rows rows of counts at a time
+    -----
+    RETURNS (doc_len, avgdl, idf)
+    """
+    n_docs, n_features = counts.shape
+    doc_len = np.empty(n_docs)
+    df = np.zeros(n_features, dtype=np.int64)
+    for start, rows in row_chunks(counts, chunk_rows):
+        doc_len[start:start + rows.shape[0]] = np.asarray(rows.sum(axis=1)).ravel()
+        df += np.bincount(rows.indices, minlength=n_features)
+
+    avgdl = doc_len.mean() if n_docs and doc_len.mean() > 0 else 1.0
+    idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+    return doc_len, float(avgdl), idf
+
+
+def bm25_weigher(doc_len, avgdl, idf, k1=BM25_K1, b=BM25_B):
+    """
+    (first row, CSR rows of float64 counts) -> BM25 weight of every stored entry
+    """
+    def weigh(start, counts):
+        # per stored entry: its row's length norm and its column's idf
+        rows = start + np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+        tf = counts.data
+        norm = k1 * (1 - b + b * doc_len[rows] / avgdl)
+        return idf[counts.indices] * tf * (k1 + 1) / (tf + norm)
+    return weigh
+
+
+def bm25_weights(counts, k1=BM25_K1, b=BM25_B):
+    """
+    BM25 weight of every (document, term) entry:
+    -----
+    w(t, d) = idf(t) * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+    idf(t)  = log(1 + (N - df + 0.5) / (df + 0.5))
+    dl is the number of vocabulary terms (unigrams + bigrams) in d.
+    -----
+    :param counts: (n_docs x n_features) term counts over the vectorizer's vocabulary
+    RETURNS (weights, avgdl), weights a CSR matrix shaped like counts
+    """
+    counts = csr_matrix(counts, dtype=np.float64)
+    counts.sort_indices()
+    doc_len, avgdl, idf = bm25_stats(counts)
+    weights = csr_matrix(
+        (bm25_weigher(doc_len, avgdl, idf, k1, b)(0, counts), counts.indices, counts.indptr),
+        shape=counts.shape,
+    )
+    return weights, avgdl
+
+
+def bm25_postings(counts, k1=BM25_K1, b=BM25_B):
+    """
+    CSC matrix of BM25 weights (see bm25_weights), so scoring a query is
+    the same sparse dot product as for TF-IDF (with raw query term counts).
+    -----
+    RETURNS (indptr, indices, data, term_max, avgdl)
+    """
+    weights, avgdl = bm25_weights(counts, k1, b)
+    postings = weights.tocsc()
+    postings.sort_indices()
+    term_max = np.asarray(postings.max(axis=0).todense()).ravel()
+    return postings.indptr, postings.indices, postings.data, term_max, avgdl
+
+
+def write_postings_chunked(index_dir, prefix, matrix, weigh, chunk_rows, lo=0, hi=None):
+    """
+    Out-of-core normalized_postings / bm25_postings of rows lo:hi of a
+    (memory-mapped) CSR matrix, for idx_tfidf.py --workers: one pass over
+    chunk_rows rows at a time counts the postings lengths, a second one
+    scatters every chunk into memory-mapped postings files (see
+    term_destinations). Memory depends on chunk_rows and the vocabulary,
+    not on the number of documents; the arrays equal the in-memory ones.
+    -----
+    :param weigh: (first row, CSR rows) -> the values of their stored
+        entries (row_normalizer / bm25_weigher)
+    RETURNS (manifest entries of postings_indptr / _indices / _data, term_max)
+    """
+    hi = matrix.shape[0] if hi is None else hi
+    n_features = matrix.shape[1]
+
+    lengths = np.zeros(n_features, dtype=np.int64)
+    for _, rows in row_chunks(matrix, chunk_rows, lo, hi):
+        lengths += np.bincount(rows.indices, minlength=n_features)
+    nnz = int(lengths.sum())
+    index_dtype = np.int32 if max(nnz, hi - lo) <= np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(n_features + 1, dtype=index_dtype)
+    np.cumsum(lengths, out=indptr[1:])
+
+    indices = create_array(index_dir, f"{prefix}postings_indices", index_dtype, nnz)
+    data = create_array(index_dir, f"{prefix}postings_data", np.float64, nnz)
+    term_max = np.zeros(n_features)
+    cursor = indptr[:-1].astype(np.int64)
+    for start, rows in row_chunks(matrix, chunk_rows, lo, hi):
+        values = weigh(start, rows)
+        dest = term_destinations(rows.indices, cursor)
+        indices[dest] = np.repeat(np.arange(start - lo, start - lo + rows.shape[0]), np.diff(rows.indptr))
+        data[dest] = values
+        np.maximum.at(term_max, rows.indices, values)
+
+    entries = {
+        "postings_indptr": write_array(index_dir, f"{prefix}postings_indptr", indptr),
+        "postings_indices": finish_array(index_dir, f"{prefix}postings_indices", indices),
+        "postings_data": finish_array(index_dir, f"{prefix}postings_data", data),
+    }
+    return entries, term_max
+
+
+def write_index(tfidf_matrix, corpus_file, vectorizer_file, index_dir=INDEX_DIR,
+                bm25_counts=None, k1=BM25_K1, b=BM25_B, chunk_rows=None):
+    """
+    Write the TF-IDF matrix in the memory-mapped format.
+    -----
+    :param tfidf_matrix: fitted (n_docs x n_features) CSR matrix
+    :param corpus_file: corpus csv the matrix was built from (checksummed)
+    :param vectorizer_file: pickled vectorizer the matrix belongs to (checksummed)
+    :param index_dir: output directory
+    :param bm25_counts: optional term counts of the same documents; also
+        writes BM25 postings (see bm25_postings) with k1 and b
+    :param chunk_rows: build the postings out of core, chunk_rows rows at
+        a time (write_postings_chunked), from memory-mapped matrices
+        (idx_tfidf.py --workers); None = in memory
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    matrix = csr_matrix(tfidf_matrix)
+    matrix.sort_indices()
+
+    arrays = {
+        "data": write_array(index_dir, "data", matrix.data),
+        "indices": write_array(index_dir, "indices", matrix.indices),
+        "indptr": write_array(index_dir, "indptr", matrix.indptr),
+    }
+    if chunk_rows is None:
+        row_norms = compute_row_norms(matrix)
+        p_indptr, p_indices, p_data, term_max = normalized_postings(matrix, row_norms)
+        arrays.update({
+            "row_norms": write_array(index_dir, "row_norms", row_norms),
+            "postings_indptr": write_array(index_dir, "postings_indptr", p_indptr),
+            "postings_indices": write_array(index_dir, "postings_indices", p_indices),
+            "postings_data": write_array(index_dir, "postings_data", p_data),
+        })
+    else:
+        row_norms = chunked_row_norms(matrix, chunk_rows)
+        arrays["row_norms"] = write_array(index_dir, "row_norms", row_norms)
+        postings, term_max = write_postings_chunked(index_dir, "", matrix, row_normalizer(row_norms), chunk_rows)
+        arrays.update(postings)
+    arrays["term_max"] = write_array(index_dir, "term_max", term_max)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "build_id": uuid.uuid4().hex,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "n_docs": int(matrix.shape[0]),
+        "n_features": int(matrix.shape[1]),
+        "nnz": int(matrix.nnz),
+        "corpus_sha256": file_checksum(corpus_file),
+        "corpus_stat": file_stat(corpus_file),
+        "vectorizer_sha256": file_checksum(vectorizer_file),
+        "vectorizer_stat": file_stat(vectorizer_file),
+        "arrays": arrays,
+    }
+
+    if bm25_counts is not None:
+        if chunk_rows is None:
+            b_indptr, b_indices, b_data, b_term_max, avgdl = bm25_postings(bm25_counts, k1, b)
+            bm25_arrays = {
+                "postings_indptr": write_array(index_dir, "bm25_postings_indptr", b_indptr),
+                "postings_indices": write_array(index_dir, "bm25_postings_indices", b_indices),
+                "postings_data": write_array(index_dir, "bm25_postings_data", b_data),
+            }
+        else:
+            counts = csr_matrix(bm25_counts, dtype=np.float64)
+            doc_len, avgdl, idf = bm25_stats(counts, chunk_rows)
+            bm25_arrays, b_term_max = write_postings_chunked(
+                index_dir, "bm25_", counts, bm25_weigher(doc_len, avgdl, idf, k1, b), chunk_rows
+            )
+        bm25_arrays["term_max"] = write_array(index_dir, "bm25_term_max", b_term_max)
+        manifest["bm25"] = {"k1": k1, "b": b, "avgdl": avgdl, "arrays": bm25_arrays}
+
+    write_manifest(index_dir, manifest)
+    return manifest
+
+
+# ----------------------------------------------
+# LOAD
+# ----------------------------------------------
+
+def check_manifest(manifest, corpus_file=None, vectorizer_file=None, n_docs=None):
+    """
+    Raise StaleIndexError if the manifest does not belong to the given
+    corpus csv / vectorizer pickle / number of documents. The files are
+    compared by size + mtime, and only hashed if those changed.
+    """
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise StaleIndexError(
+            f"format version {manifest.get('format_version')}, "
+            f"expected {FORMAT_VERSION}"
+        )
+
+    if n_docs is not None and manifest["n_docs"] != n_docs:
+        raise StaleIndexError(
+            f"index has {manifest['n_docs']} docs, corpus has {n_docs}"
+        )
+
+    if vectorizer_file is not None and os.path.exists(vectorizer_file):
+        if not file_unchanged(vectorizer_file, manifest["vectorizer_sha256"], manifest.get("vectorizer_stat")):
+            raise StaleIndexError(f"{vectorizer_file} changed since the index was built")
+
+    if corpus_file is not None and os.path.exists(corpus_file):
+        if not file_unchanged(corpus_file, manifest["corpus_sha256"], manifest.get("corpus_stat")):
+            raise StaleIndexError(f"{corpus_file} changed since the index was built")
+
+
+def load_index(index_dir=INDEX_DIR, corpus_file=None, vectorizer_file=None, n_docs=None):
+    """
+    Open the memory-mapped index.
+    -----
+    RETURNS (tfidf_matrix, row_norms, manifest)
+    raises FileNotFoundError if there is no index, StaleIndexError if it
+    does not match the corpus/vectorizer.
+    """
+    manifest = read_manifest(index_dir)
+    if manifest is None:
+        raise FileNotFoundError(os.path.join(index_dir, MANIFEST_FILE))
+
+    check_manifest(manifest, corpus_file, vectorizer_file, n_docs)
+
+    arrays = {
+        name: open_array(index_dir, manifest["arrays"][name])
+        for name in ("data", "indices", "indptr", "row_norms")
+    }
+    shape = (manifest["n_docs"], manifest["n_features"])
+
+    if len(arrays["indptr"]) != shape[0] + 1 or arrays["indptr"][-1] != manifest["nnz"]:
+        raise StaleIndexError("indptr does not match the manifest")
+
+    tfidf_matrix = csr_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]),
+        shape=shape,
+        copy=False,
+    )
+    return tfidf_matrix, arrays["row_norms"], manifest
+
+
+def load_tfidf_matrix(matrix_file, index_dir=INDEX_DIR, corpus_file=None,
+                      vectorizer_file=None, n_docs=None):
+    """
+    Used by the search engines: prefer the memory-mapped index, fall back
+    to the pickled matrix if there is none or it is stale.
+    -----
+    RETURNS (tfidf_matrix, row_norms, manifest); manifest is None for the pickle
+    """
+    try:
+        return load_index(index_dir, corpus_file, vectorizer_file, n_docs)
+    except FileNotFoundError:
+        pass
+    except StaleIndexError as e:
+        print(f"** Ignoring stale index in {index_dir}: {e}")
+        print("** Falling back to the pickled matrix. Re-run idx_tfidf.py to rebuild.")
+
+    tfidf_matrix = pickle.load(open(matrix_file, "rb"))
+    if n_docs is not None and tfidf_matrix.shape[0] != n_docs:
+        raise StaleIndexError(
+            f"{matrix_file} has {tfidf_matrix.shape[0]} rows, corpus has {n_docs}"
+        )
+    return tfidf_matrix, compute_row_norms(tfidf_matrix), None
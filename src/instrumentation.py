@@ -0,0 +1,306 @@
+"""
+Per-stage timers, counters and sampled profiling for the search path.
+
+Each engine owns an Instrumentation. A search starts a QueryTimer and
+calls mark(stage) at the end of each stage ("lap" timing: one
+perf_counter() per stage), so the overhead is a few microseconds per
+query. Stages of a single search:
+
+    preprocess   preprocess_text
+    vectorize    vectorizer.transform (+ OOV hashing / LSA projection)
+    filter       filter inference + facet mask (filter engine only)
+    score        term-at-a-time scoring / IVF probing (topk.py, dense.py)
+    select       argpartition top-k + zero-score fill
+    hits         building the lazy hits (fields are read later, on access)
+
+search_many() times the whole batch, with "score" covering scoring +
+selection (candidates_scored is only counted by search()).
+
+Counters: queries, candidates_scored, docs_filtered_out,
+filter_fallbacks. Totals are read with stats() (a dict) or prometheus()
+(Prometheus text format, served on GET /metrics by search_service.py).
+search(..., trace=True) attaches a QueryTrace to the results
+(results.trace) with this query's stage times and counters.
+
+Profiling: enable_profiling(every=N, out="search.prof") runs every Nth
+query under cProfile, aggregates the profiles and dumps them to out
+(readable with pstats / snakeviz) every dump_every profiled queries
+and on dump_profile().
+
+Usage:
+    results = engine.search("pink tower", k=5, trace=True)
+    results.trace.to_dict()  ->  {"n_queries": 1, "total_ms": 0.9, "stages": {"preprocess": 0.01, ...}, "counters": {...}}
+    engine.instrumentation.stats()
+    print(engine.instrumentation.prometheus())
+"""
+
+import cProfile
+import pstats
+import threading
+import time
+from collections import defaultdict
+
+
+METRIC_PREFIX = "montessori_search"
+
+# search latency histogram buckets (seconds), Prometheus "le" bounds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+COUNTER_HELP = {
+    "queries": "Queries searched",
+    "candidates_scored": "Documents scored (accumulated) across queries",
+    "docs_filtered_out": "Documents excluded by metadata filters across queries",
+    "filter_fallbacks": "Searches whose filters matched fewer than k documents and fell back to approach only",
+}
+
+
+class QueryTrace:
+    """
+    Stage times (ms) and counters of one search (or one search_many batch).
+    """
+    __slots__ = ("stages", "counters", "total_ms", "n_queries")
+
+    def __init__(self, stages, counters, total_ms, n_queries=1):
+        self.stages = stages
+        self.counters = counters
+        self.total_ms = total_ms
+        self.n_queries = n_queries
+
+    def to_dict(self):
+        return {
+            "n_queries": self.n_queries,
+            "total_ms": round(self.total_ms, 4),
+            "stages": {stage: round(ms, 4) for stage, ms in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+    def __repr__(self):
+        stages = ", ".join(f"{s}={ms:.3f}ms" for s, ms in self.stages.items())
+        return f"QueryTrace(total={self.total_ms:.3f}ms, {stages})"
+
+
+class QueryTimer:
+    """
+    Lap timer for one search; get one from Instrumentation.start() and use
+    it as a context manager (finish() is called on exit if it wasn't).
+    """
+    __slots__ = ("_inst", "_start", "_last", "stages", "counters", "_profiler", "n_queries", "_done")
+
+    def __init__(self, inst, profiler=None, n_queries=1):
+        self._inst = inst
+        self._profiler = profiler
+        self.n_queries = n_queries
+        self.stages = {}
+        self.counters = {}
+        self._done = False
+        self._start = self._last = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._done:
+            return
+        if exc_type is None:
+            self.finish()
+        else:
+            # failed search: not counted, but don't leave the profiler running
+            self._done = True
+            self._inst.release_profiler(self)
+
+    def mark(self, stage):
+        """
+        End of stage: the time since the previous mark is added to it
+        """
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self._last)
+        self._last = now
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def finish(self, trace=False):
+        """
+        Record into the engine totals.
+        RETURNS a QueryTrace if trace, else None
+        """
+        total = time.perf_counter() - self._start
+        self._done = True
+        self._inst.record(self, total)
+        if not trace:
+            return None
+        return QueryTrace(
+            {s: sec * 1000 for s, sec in self.stages.items()}, dict(self.counters), total * 1000, self.n_queries
+        )
+
+
+class Instrumentation:
+    """
+    Totals across all searches of an engine (thread-safe).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+        # sampled cProfile
+        self.profile_every = 0
+        self.profile_out = None
+        self.profile_dump_every = 0
+        self._profile_lock = threading.Lock()
+        self._profile_stats = None
+        self._profiled = 0
+        self._seen = 0
+
+    # ----------------------------------------------
+    # RECORDING
+    # ----------------------------------------------
+
+    def start(self, n_queries=1):
+        """
+        RETURNS a QueryTimer; every profile_every-th call also runs under cProfile
+        """
+        profiler = None
+        if self.profile_every:
+            self._seen += 1
+            # cProfile can't profile two threads' searches at once; skip if busy
+            if self._seen % self.profile_every == 0 and self._profile_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+                profiler.enable()
+        return QueryTimer(self, profiler, n_queries)
+
+    def release_profiler(self, timer):
+        if timer._profiler is not None:
+            timer._profiler.disable()
+            timer._profiler = None
+            self._profile_lock.release()
+
+    def record(self, timer, total):
+        if timer._profiler is not None:
+            timer._profiler.disable()
+            self._add_profile(timer._profiler)
+
+        with self._lock:
+            for stage, sec in timer.stages.items():
+                self.stage_seconds[stage] += sec
+                self.stage_calls[stage] += 1
+            for name, n in timer.counters.items():
+                self.counters[name] += n
+            self.counters["queries"] += timer.n_queries
+
+            # a batch adds one observation per query, at its mean latency
+            per_query = total / max(timer.n_queries, 1)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if per_query <= bound:
+                    self.latency_buckets[i] += timer.n_queries
+            self.latency_sum += total
+            self.latency_count += timer.n_queries
+
+    # ----------------------------------------------
+    # PROFILING
+    # ----------------------------------------------
+
+    def enable_profiling(self, every=100, out="search.prof", dump_every=10):
+        """
+        :param every: profile one query in every
+        :param out: file the aggregated profile is dumped to
+        :param dump_every: dump after this many profiled queries
+        """
+        self.profile_every = every
+        self.profile_out = out
+        self.profile_dump_every = dump_every
+
+    def disable_profiling(self):
+        self.profile_every = 0
+        self.dump_profile()
+
+    def _add_profile(self, profiler):
+        try:
+            if self._profile_stats is None:
+                self._profile_stats = pstats.Stats(profiler)
+            else:
+                self._profile_stats.add(profiler)
+            self._profiled += 1
+        finally:
+            self._profile_lock.release()
+
+        if self.profile_dump_every and self._profiled % self.profile_dump_every == 0:
+            self.dump_profile()
+
+    def dump_profile(self, out=None):
+        """
+        Write the aggregated profile (pstats format).
+        RETURNS the file written, None if nothing was profiled yet
+        """
+        out = out or self.profile_out
+        with self._profile_lock:
+            if self._profile_stats is None or out is None:
+                return None
+            self._profile_stats.dump_stats(out)
+        return out
+
+    # ----------------------------------------------
+    # EXPORT
+    # ----------------------------------------------
+
+    def stats(self):
+        """
+        Totals as a dict (what GET /stats returns)
+        """
+        with self._lock:
+            stages = {
+                stage: {
+                    "calls": self.stage_calls[stage],
+                    "total_ms": round(sec * 1000, 3),
+                    "mean_ms": round(sec * 1000 / self.stage_calls[stage], 4),
+                }
+                for stage, sec in self.stage_seconds.items()
+            }
+            counters = {name: self.counters.get(name, 0) for name in COUNTER_HELP}
+            latency_count = self.latency_count
+            latency_sum = self.latency_sum
+
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "counters": counters,
+            "stages": stages,
+            "mean_query_ms": round(latency_sum * 1000 / latency_count, 4) if latency_count else None,
+            "profiled_queries": self._profiled,
+        }
+
+    def prometheus(self, prefix=METRIC_PREFIX):
+        """
+        Totals in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name, help_text in COUNTER_HELP.items():
+                metric = f"{prefix}_{name}_total"
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter",
+                          f"{metric} {self.counters.get(name, 0)}"]
+
+            metric = f"{prefix}_stage_seconds_total"
+            lines += [f"# HELP {metric} Time spent per search stage", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{stage="{s}"}} {sec:.9f}' for s, sec in sorted(self.stage_seconds.items())]
+
+            metric = f"{prefix}_stage_calls_total"
+            lines += [f"# HELP {metric} Times each search stage ran", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{stage="{s}"}} {n}' for s, n in sorted(self.stage_calls.items())]
+
+            metric = f"{prefix}_query_latency_seconds"
+            lines += [f"# HELP {metric} Search latency per query", f"# TYPE {metric} histogram"]
+            lines += [
+                f'{metric}_bucket{{le="{bound}"}} {n}'
+                for bound, n in zip(LATENCY_BUCKETS, self.latency_buckets)
+            ]
+            lines += [
+                f'{metric}_bucket{{le="+Inf"}} {self.latency_count}',
+                f"{metric}_sum {self.latency_sum:.9f}",
+                f"{metric}_count {self.latency_count}",
+            ]
+        return "\n".join(lines) + "\n"
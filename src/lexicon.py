@@ -0,0 +1,214 @@
+"""
+Keyword lexicons for metadata: Montessori materials, approach, evidence
+type and domain keywords. Build time (merge_corpora.py) and query time
+(filter_search.py) both read them from here.
+
+At query time the lexicons are compiled into a LexiconMatcher: a trie
+over preprocess_text tokens, so a query is matched against every entry
+in one pass over its tokens, on word boundaries ("age" no longer
+matches "page"). A query token also matches an entry token when it only
+adds a plural "s"/"es" ("pink towers", "classes").
+
+Usage:
+    matcher = query_lexicon()
+    matcher.match("Do golden beads help with attention?")
+    -> [LexiconMatch(category="evidence_type", label="Material", term="golden bead", start=1, end=3),
+        LexiconMatch(category="domain", label="Cognitive", term="attention", start=5, end=6)]
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+
+from idx_tfidf import preprocess_text
+
+
+# ----------------------------------------------
+# LEXICONS
+# ----------------------------------------------
+
+# merge_corpora.py matches these as plain substrings of the passage text,
+# so changing this list relabels the corpus
+MONTESSORI_MATERIALS = [
+    "pink tower", "metal inset", "stamp game", "moveable alphabet",
+    "spindle box", "binomial cube", "trinomial cube", "knobbed cylinder",
+    "golden bead", "sandpaper letter", "red rod", "long rod",
+    "brown stair", "color tablet", "sound cylinder", "rough and smooth board",
+    "smooth board", "rough board", "wooden cylinder", "geometry cabinet",
+    "glass bead", "fraction inset", "inset", "botany cabinet",
+    "divergent and convergent lines"
+]
+
+# other spellings accepted in queries only
+MATERIAL_VARIANTS = ["movable alphabet"]
+
+APPROACH_KEYWORDS = {
+    "Montessori": ["montessori"],
+    "Traditional": ["traditional"],
+}
+
+EVIDENCE_KEYWORDS = {
+    "Material": MONTESSORI_MATERIALS + MATERIAL_VARIANTS,
+    "Study": ["study", "studies", "research", "citation"],
+}
+
+DOMAIN_FILTER_MAP = {
+    "Cognitive": {
+        "keywords": [
+            "cognitive", "attention", "memory", "executive",
+            "problem solving", "thinking", "concentration"
+        ],
+        "implies": [
+            "Cognitive",
+            "Behavioral/Cognitive",
+            "Academic/Cognitive",
+            "Behavioral", # pretty hand in hand/similar
+        ],
+    },
+
+    "Behavioral": {
+        "keywords": [
+            "behavior", "misbehavior", "discipline", "self-regulation",
+            "motivation", "reward", "punishment", "control",
+            # used to be caught by substring matching on "behavior"
+            "behavioral", "behaviour", "behavioural"
+        ],
+        "implies": [
+            "Behavioral",
+            "Behavioral/Cognitive",
+            "Behavioral/Social",
+            "Cognitive", # pretty hand in hand/similar
+        ],
+    },
+
+    "Social": {
+        "keywords": [
+            "social", "peer", "collaboration", "interaction",
+            "community", "group", "age"
+        ],
+        "implies": [
+            "Social",
+            "Behavioral/Social",
+            "Cognitive/Social",
+        ],
+    },
+
+    "Academic": {
+        "keywords": [
+            "academic", "reading", "math", "literacy",
+            "numeracy", "achievement", "school performance",
+            # used to be caught by substring matching on "math"
+            "mathematics"
+        ],
+        "implies": [
+            "Academic",
+            "Academic/Cognitive",
+            "Academic/Behavioral",
+        ],
+    },
+
+    "Environment": {
+        "keywords": [
+            "environment", "classroom", "noise", "space",
+            "materials", "prepared environment"
+        ],
+        "implies": [
+            "Environment",
+            "Cognitive/Environment",
+            "Academic/Environment",
+        ],
+    },
+}
+
+PLURAL_SUFFIXES = ("es", "s")
+
+
+# ----------------------------------------------
+# MATCHER
+# ----------------------------------------------
+
+LexiconMatch = namedtuple("LexiconMatch", ["category", "label", "term", "start", "end"])
+
+# key of the (category, label, term) entries ending at a trie node
+_ENTRIES = None
+
+
+class LexiconMatcher:
+    """
+    Token trie over lexicon entries.
+    -----
+    :param lexicons: {category: {label: [terms]}}; terms are normalised
+        with preprocess_text, so "self-regulation" is "self regulation"
+    """
+    def __init__(self, lexicons):
+        self.root = {}
+        self.size = 0
+        for category, labels in lexicons.items():
+            for label, terms in labels.items():
+                for term in terms:
+                    self.add(category, label, term)
+
+    def add(self, category, label, term):
+        tokens = preprocess_text(term).split()
+        if not tokens:
+            return
+        node = self.root
+        for token in tokens:
+            node = node.setdefault(token, {})
+        node.setdefault(_ENTRIES, []).append((category, label, term))
+        self.size += 1
+
+    @staticmethod
+    def _children(nodes, token):
+        """
+        children of nodes reachable with token or its plural-stripped forms
+        """
+        children = [node[token] for node in nodes if token in node]
+        for suffix in PLURAL_SUFFIXES:
+            if len(token) > len(suffix) + 1 and token.endswith(suffix):
+                stem = token[:-len(suffix)]
+                children.extend(node[stem] for node in nodes if stem in node)
+        return children
+
+    def match(self, text):
+        """
+        Every lexicon entry found in text, including overlapping ones
+        ("rough and smooth board" and "smooth board").
+        -----
+        RETURNS list of LexiconMatch, start/end being token positions in
+            preprocess_text(text)
+        """
+        tokens = preprocess_text(text).split()
+        matches = []
+        for start in range(len(tokens)):
+            nodes = self._children([self.root], tokens[start])
+            end = start + 1
+            while nodes:
+                for node in nodes:
+                    for category, label, term in node.get(_ENTRIES, ()):
+                        matches.append(LexiconMatch(category, label, term, start, end))
+                if end == len(tokens):
+                    break
+                nodes = self._children(nodes, tokens[end])
+                end += 1
+        return matches
+
+    def labels(self, text):
+        """
+        RETURNS {category: set of matched labels}
+        """
+        found = {}
+        for m in self.match(text):
+            found.setdefault(m.category, set()).add(m.label)
+        return found
+
+
+@lru_cache(maxsize=1)
+def query_lexicon():
+    """
+    The matcher filter_search.py uses, compiled once per process.
+    """
+    return LexiconMatcher({
+        "approach": APPROACH_KEYWORDS,
+        "evidence_type": EVIDENCE_KEYWORDS,
+        "domain": {name: group["keywords"] for name, group in DOMAIN_FILTER_MAP.items()},
+    })
@@ -1,6 +1,12 @@
+import argparse
+import numpy as np
 import pandas as pd
 import re
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+from lexicon import MONTESSORI_MATERIALS
+from dedup import DUPLICATES_FILE, collapse_duplicates, find_duplicates
 
 EXCERPT_FILE = "metadata/all_excerpts.csv"
 PASSAGE_FILE = "data/corpus.csv"
@@ -11,46 +17,44 @@ OUTPUT_FILE = "data/full_corpus.csv"
 # HELPERS
 # ----------------------------------------------
 
-MONTESSORI_MATERIALS = [
-    "pink tower", "metal inset", "stamp game", "moveable alphabet",
-    "spindle box", "binomial cube", "trinomial cube", "knobbed cylinder",
-    "golden bead", "sandpaper letter", "red rod", "long rod",
-    "brown stair", "color tablet", "sound cylinder", "rough and smooth board",
-    "smooth board", "rough board", "wooden cylinder", "geometry cabinet",
-    "glass bead", "fraction inset", "inset", "botany cabinet",
-    "divergent and convergent lines"
+# materials that contain another material ("metal inset" -> "inset") can
+# never change the outcome of an any-substring check
+MATERIAL_NEEDLES = [
+    mat for mat in MONTESSORI_MATERIALS
+    if not any(other != mat and other in mat for other in MONTESSORI_MATERIALS)
 ]
 
+# eg:
+# (Author, 1999)
+# (Author & Author, 1972)
+# (Author et al., 1996)
+# (Author, 1948/1976)
+# (Author, 1969, p. 2)
+# (Author, 1980; Other & Author, 1992)
+CITATION_PATTERN = re.compile(r"""
+    \(                                  # opening parenthesis
+    [^()]*?                             # any text, notably author name or text/study name
+    \b\d{4}(?:/\d{4})?\b                # year or year/year
+    [^()]*?                             # any text to capture page numbers or other authors
+    \)                                  # closing parenthesis
+    """, re.VERBOSE)
+
+
 def contains_material(text):
     """
-    checks if a passage contains a Montessori material.
+    checks if a passage contains a Montessori material (lexicon.py).
+    plain substring test, unlike the word-boundary query matcher, so the
+    corpus labels don't change.
     """
     text = text.lower()
-    return any(mat in text for mat in MONTESSORI_MATERIALS)
+    return any(mat in text for mat in MATERIAL_NEEDLES)
 
 
 def detect_citation(text):
     """
-    detects citations to categorize studies.
-
-    eg:
-    (Author, 1999)
-    (Author & Author, 1972)
-    (Author et al., 1996)
-    (Author, 1948/1976)
-    (Author, 1969, p. 2)
-    (Author, 1980; Other & Author, 1992)
-    """
-
-    citation_pattern = r"""
-    \(                                  # opening parenthesis
-    [^()]*?                             # any text, notably author name or text/study name
-    \b\d{4}(?:/\d{4})?\b                # year or year/year
-    [^()]*?                             # any text to capture page numbers or other authors
-    \)                                  # closing parenthesis
+    detects citations to categorize studies (see CITATION_PATTERN).
     """
-
-    return re.search(citation_pattern, text, re.VERBOSE) is not None
+    return CITATION_PATTERN.search(text) is not None
 
 def build_indexed_text(row):
     """
@@ -95,6 +99,40 @@ def build_passage_indexed_text(row):
     return "\n".join(parts)
 
 
+def contains_any(texts, needles):
+    """
+    contains_material over an object array of lowercased texts: one
+    substring scan per needle, only over rows that haven't matched yet
+    (an alternation regex is slower than this in CPython).
+    """
+    found = np.zeros(len(texts), dtype=bool)
+    for needle in needles:
+        rest = np.flatnonzero(~found)
+        found[rest] = [needle in text for text in texts[rest]]
+    return found
+
+
+def build_passage_indexed_texts(df):
+    """
+    build_passage_indexed_text for a whole frame, column-wise.
+    """
+    text = np.full(len(df), "", dtype=object)
+
+    for label, col in [
+        ("Approach", "approach"),
+        ("Domain", "domain"),
+        ("Evidence Type", "evidence_type"),
+        ("Source", "source_title")
+    ]:
+        present = df[col].notna().to_numpy()
+        values = [str(v) for v in df[col].to_numpy(dtype=object)[present]]
+        text[present] = text[present] + f"{label}: " + np.array(values, dtype=object) + "\n"
+
+    raw = np.array([str(v) for v in df["raw_text"]], dtype=object)
+    # back through a list so pandas picks the same string dtype as apply() did
+    return pd.Series((text + "Excerpt: " + raw).tolist(), index=df.index)
+
+
 # ----------------------------------------------
 # EXCERPTS
 # ----------------------------------------------
@@ -140,58 +178,88 @@ def load_excerpts():
 # PASSAGES
 # ----------------------------------------------
 
-def load_passages():
-    df = pd.read_csv(PASSAGE_FILE)
-
-    approaches = []
-    evidence_types = []
-    domains = []
-    source_titles = []
-
-    for i, row in df.iterrows():
-        filename = row["source_file"]
-        text = row["text"]
-        source_title = row["source_title"]
-        source_titles.append(source_title)
-
-        # === APPROACH ===
-        if filename.startswith("cleaned_ch"):
-            if "traditional" in text.lower():
-                approaches.append("Traditional")
-            else:
-                approaches.append("Montessori")
-        else:
-            approaches.append(None)
-
-        # === EVIDENCE ===
-        if filename.startswith("research-paper"):
-            evidence_types.append("Study")
-        
-        elif contains_material(text):
-            evidence_types.append("Material")
-        elif detect_citation(text):
-            evidence_types.append("Study")
-        else:
-            evidence_types.append("Example")
-
-        # === DOMAIN ===
-        if filename.startswith("research-paper"):
-            domains.append("Cognitive")
-        elif evidence_types[-1] == "Study": # if curr is study
-            domains.append("Behavioral/Cognitive")
-        else:
-            domains.append(None)
-
-    df["approach"] = approaches
-    df["evidence_type"] = evidence_types
-    df["domain"] = domains
-    df["source_title"] = source_titles
+def read_passage_table(path=PASSAGE_FILE):
+    """
+    build_corpus.py writes csv by default, or Parquet row groups.
+    """
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def infer_passage_metadata(df):
+    """
+    approach / evidence_type / domain for every passage, column-wise.
+    -----
+    - approach: book chapters are Montessori, unless they mention "traditional"
+    - evidence_type: research papers are Studies; otherwise Material if a
+      Montessori material is named, Study if there is a citation, else Example
+    - domain: research papers are Cognitive, other Studies Behavioral/Cognitive
+    RETURNS (approach, evidence_type, domain) object arrays
+    """
+    filename = df["source_file"].astype(object)
+    text = df["text"].to_numpy(dtype=object)
+    lower = np.array([t.lower() for t in text], dtype=object)
+
+    is_chapter = filename.str.startswith("cleaned_ch").to_numpy(dtype=bool)
+    is_paper = filename.str.startswith("research-paper").to_numpy(dtype=bool)
+
+    # papers are Studies whatever they contain: only scan the other rows
+    has_material = np.zeros(len(df), dtype=bool)
+    has_material[~is_paper] = contains_any(lower[~is_paper], MATERIAL_NEEDLES)
+
+    unresolved = np.flatnonzero(~is_paper & ~has_material)
+    has_citation = np.zeros(len(df), dtype=bool)
+    has_citation[unresolved] = [CITATION_PATTERN.search(t) is not None for t in text[unresolved]]
+
+    mentions_traditional = np.zeros(len(df), dtype=bool)
+    mentions_traditional[is_chapter] = ["traditional" in t for t in lower[is_chapter]]
+
+    # === APPROACH ===
+    approach = np.full(len(df), None, dtype=object)
+    approach[is_chapter] = np.where(mentions_traditional[is_chapter], "Traditional", "Montessori")
+
+    # === EVIDENCE ===
+    evidence_type = np.select(
+        [is_paper, has_material, has_citation],
+        ["Study", "Material", "Study"],
+        "Example",
+    ).astype(object)
+
+    # === DOMAIN ===
+    domain = np.full(len(df), None, dtype=object)
+    domain[evidence_type == "Study"] = "Behavioral/Cognitive"
+    domain[is_paper] = "Cognitive"
+
+    return approach, evidence_type, domain
+
+
+def load_passages(workers=1, chunk_size=20000):
+    """
+    :param workers: > 1 splits the passages into chunk_size chunks and
+        infers their metadata in a process pool (for large corpora)
+    """
+    df = read_passage_table(PASSAGE_FILE)
+
+    if workers > 1 and len(df) > chunk_size:
+        # workers only need the two columns the rules look at
+        inputs = df[["source_file", "text"]]
+        chunks = [inputs.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(infer_passage_metadata, chunks))
+        approach, evidence_type, domain = (np.concatenate(cols) for cols in zip(*parts))
+    else:
+        approach, evidence_type, domain = infer_passage_metadata(df)
+
+    df["approach"] = approach
+    df["evidence_type"] = evidence_type
+    df["domain"] = domain
 
     # separate the raw para/evidence for displaying
     df["raw_text"] = df["text"]
 
     # enriched text, if applicable
-    df["text"] = df.apply(build_passage_indexed_text, axis=1)
+    df["text"] = build_passage_indexed_texts(df)
 
 
     return df[[
@@ -212,13 +280,25 @@ def load_passages():
 # MERGE ALL CORPORA
 # ----------------------------------------------
 
-def build_full_corpus():
+def build_full_corpus(workers=1, dedup=False):
+    """
+    :param workers: see load_passages
+    :param dedup: drop near-duplicate documents (excerpts that reappear in
+        a passage, see dedup.py), merging their metadata into the document
+        kept; the duplicate map is written to DUPLICATES_FILE
+    """
     excerpts = load_excerpts()
-    passages = load_passages()
+    passages = load_passages(workers=workers)
 
     corpus = pd.concat([excerpts, passages], ignore_index=True)
 
     os.makedirs("data", exist_ok=True)
+    if dedup:
+        duplicates = find_duplicates(corpus)
+        duplicates.to_csv(DUPLICATES_FILE, index=False)
+        corpus = collapse_duplicates(corpus, duplicates)
+        print(f"Dropped {len(duplicates)} near-duplicates (map in {DUPLICATES_FILE})")
+
     corpus.to_csv(OUTPUT_FILE, index=False)
     total = len(corpus)
 
@@ -240,4 +320,9 @@ def build_full_corpus():
 
 
 if __name__ == "__main__":
-    build_full_corpus()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Merge the excerpts and passages into the full corpus")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--dedup", action="store_true", help="drop near-duplicates (dedup.py)")
+    args = parser.parse_args()
+
+    build_full_corpus(workers=args.workers, dedup=args.dedup)
\ No newline at end of file
@@ -0,0 +1,271 @@
+"""
+Multi-stage retrieval: candidate generation, rerank stages, latency budget.
+
+FilterMontessoriSearchEngine.search() ranks the whole (filtered) corpus
+with one scorer. A SearchPipeline instead runs
+    1. a cheap first stage: sparse top-N (TF-IDF or BM25 postings, topk.py)
+    2. rerank stages over those N candidates only: BM25 weights, dense
+       (LSA) similarity, a boost for the approach/domain/evidence type
+       inferred from the query
+so more expensive scoring is only paid for N documents. A rerank stage's
+scores are rescaled to the range of the first stage's scores and added
+with the stage's weight.
+
+Every stage declares its cost (fixed ms + ms per candidate); after each
+run the per-candidate cost is updated with a moving average of the
+measured time. Given budget_ms, the pipeline checks before each rerank
+stage whether it still fits in what is left of the budget: if it only
+fits on fewer candidates, the candidates are truncated to the best ones
+so far; if it does not fit on k of them, the stage is skipped.
+
+Usage:
+    engine = FilterMontessoriSearchEngine()
+    pipeline = SearchPipeline(engine, [DenseRerank(0.5), MetadataBoost(0.2)],
+                              n_candidates=200, budget_ms=5)
+    hits, report = pipeline.search("concentration in the classroom", k=5)
+    report -> [StageReport(stage="tfidf", n_candidates=200, ms=0.4, status="ran"), ...]
+"""
+
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from idx_tfidf import preprocess_text
+from hits import build_hits
+from segments import count_vectorize, vectorize
+
+
+# weight of the newest measurement in a stage's running cost estimate
+COST_SMOOTHING = 0.2
+
+StageReport = namedtuple("StageReport", ["stage", "n_candidates", "ms", "status"])
+
+
+class QueryContext:
+    """
+    Per-query state shared by the stages; query vectors are built on
+    first use only.
+    """
+    def __init__(self, engine, query, filters):
+        self.engine = engine
+        self.query = query
+        self.processed = preprocess_text(query)
+        self.filters = filters or {}
+        self._vectors = {}
+
+    def vector(self, kind):
+        """
+        :param kind: "tfidf" (TF-IDF weights), "counts" (raw counts, for
+            BM25) or "dense" (unit LSA embedding)
+        """
+        if kind not in self._vectors:
+            engine = self.engine
+            if kind == "counts":
+                vec = count_vectorize(engine.vectorizer, [self.processed])
+            elif kind == "dense":
+                # projection of the TF-IDF vector (minus any OOV columns)
+                n_features = engine.dense_index.components.shape[0]
+                vec = engine.dense_index.embed(self.vector("tfidf")[:, :n_features])[0]
+            else:
+                vec = vectorize(engine.vectorizer, [self.processed], engine.oov_buckets)
+            self._vectors[kind] = vec
+        return self._vectors[kind]
+
+
+# ----------------------------------------------
+# STAGES
+# ----------------------------------------------
+
+class Stage:
+    """
+    A rerank stage: scores for given candidate documents.
+    -----
+    :param weight: weight of the (rescaled) stage scores in the final score
+    :param fixed_ms, per_doc_ms: declared cost, overriding the class default
+    """
+    name = "stage"
+    fixed_ms = 0.05
+    per_doc_ms = 0.001
+
+    def __init__(self, weight=1.0, fixed_ms=None, per_doc_ms=None):
+        self.weight = weight
+        if fixed_ms is not None:
+            self.fixed_ms = fixed_ms
+        if per_doc_ms is not None:
+            self.per_doc_ms = per_doc_ms
+
+    def available(self, engine):
+        return True
+
+    def estimate(self, n):
+        return self.fixed_ms + self.per_doc_ms * n
+
+    def fits(self, budget_ms):
+        """
+        Number of candidates the stage can score within budget_ms
+        """
+        return int(max(budget_ms - self.fixed_ms, 0) / self.per_doc_ms) if self.per_doc_ms > 0 else np.inf
+
+    def observe(self, n, ms):
+        if n > 0:
+            measured = max(ms - self.fixed_ms, 0) / n
+            self.per_doc_ms += COST_SMOOTHING * (measured - self.per_doc_ms)
+
+    def score(self, ctx, doc_ids):
+        raise NotImplementedError
+
+
+class BM25Rerank(Stage):
+    """
+    BM25 weights of the candidates (needs idx_tfidf.py --bm25)
+    """
+    name = "bm25"
+    fixed_ms = 0.1
+    per_doc_ms = 0.0005
+
+    def available(self, engine):
+        return engine.bm25_scorer is not None
+
+    def score(self, ctx, doc_ids):
+        scorer = ctx.engine.bm25_scorer
+        mask = np.zeros(scorer.n_docs, dtype=bool)
+        mask[doc_ids] = True
+        matched, scores = scorer.score(ctx.vector("counts"), candidates=mask)
+
+        # matched is sorted; candidates not in it score 0
+        out = np.zeros(len(doc_ids))
+        pos = np.searchsorted(matched, doc_ids)
+        pos_ok = pos < len(matched)
+        hit = np.zeros(len(doc_ids), dtype=bool)
+        hit[pos_ok] = matched[pos[pos_ok]] == doc_ids[pos_ok]
+        out[hit] = scores[pos[hit]]
+        return out
+
+
+class DenseRerank(Stage):
+    """
+    LSA cosine similarity of the candidates (needs idx_tfidf.py --dense)
+    """
+    name = "dense"
+    fixed_ms = 0.1
+    per_doc_ms = 0.0005
+
+    def available(self, engine):
+        return engine.dense_index is not None
+
+    def score(self, ctx, doc_ids):
+        return ctx.engine.dense_index.score_docs(ctx.vector("dense"), doc_ids)
+
+
+class MetadataBoost(Stage):
+    """
+    Share of the inferred filters (approach / evidence_type / domain) a
+    candidate matches, from the facet bitmaps. Boosts instead of filtering.
+    """
+    name = "metadata"
+    fixed_ms = 0.02
+    per_doc_ms = 0.0001
+
+    def score(self, ctx, doc_ids):
+        facets = ctx.engine.facets
+        bitmaps = []
+        if ctx.filters.get("approach"):
+            bitmaps.append(facets.value("approach", ctx.filters["approach"]))
+        if ctx.filters.get("evidence_type"):
+            bitmaps.append(facets.value("evidence_type", ctx.filters["evidence_type"]))
+        if ctx.filters.get("domain"):
+            bitmaps.append(facets.any_of("domain", ctx.filters["domain"]))
+
+        if not bitmaps:
+            return np.zeros(len(doc_ids))
+        return sum(facets.contains(b, doc_ids).astype(np.float64) for b in bitmaps) / len(bitmaps)
+
+
+# ----------------------------------------------
+# PIPELINE
+# ----------------------------------------------
+
+class SearchPipeline:
+    """
+    First stage + rerank stages over a FilterMontessoriSearchEngine.
+    -----
+    :param stages: rerank Stages, run in this order (stages the engine
+        has no index for are left out)
+    :param ranking: first stage, "tfidf" or "bm25" (ValueError if the
+        engine's index has no BM25 postings)
+    :param n_candidates: N, documents kept by the first stage
+    :param budget_ms: default per-query latency budget, None for no limit
+    """
+    def __init__(self, engine, stages=(), ranking="tfidf", n_candidates=100, budget_ms=None):
+        if ranking not in ("tfidf", "bm25"):
+            raise ValueError(f"first stage ranking must be 'tfidf' or 'bm25', got {ranking!r}")
+        # same error as engine.search(ranking="bm25") without a BM25 index
+        engine.check_ranking(ranking)
+        self.engine = engine
+        self.stages = [stage for stage in stages if stage.available(engine)]
+        self.ranking = ranking
+        self.n_candidates = n_candidates
+        self.budget_ms = budget_ms
+
+    def _first_stage(self, ctx, mask, n):
+        if self.ranking == "bm25":
+            scorer, query_vec = self.engine.bm25_scorer, ctx.vector("counts")
+        else:
+            scorer, query_vec = self.engine.scorer, ctx.vector("tfidf")
+        return scorer.top_k(query_vec, n, candidates=mask)
+
+    def search(self, query, k=5, filter_policy="auto", fields=None, budget_ms=None):
+        """
+        :param filter_policy: "auto" (filter with the inferred filters),
+            "suggest" (only use them for MetadataBoost) or "off"
+        :param budget_ms: overrides the pipeline's budget for this query
+        -----
+        RETURNS (list of lazy Hits, list of StageReport)
+        """
+        if filter_policy not in ("auto", "suggest", "off"):
+            raise ValueError(f"filter_policy must be 'auto', 'suggest' or 'off', got {filter_policy!r}")
+        budget_ms = self.budget_ms if budget_ms is None else budget_ms
+        start = time.perf_counter()
+
+        engine = self.engine
+        filters = engine.suggest_filters(query) if filter_policy != "off" else None
+        mask = engine.live_mask
+        if filters and filter_policy == "auto":
+            mask, _ = engine.filter_candidates(
+                filters.get("approach"), filters.get("evidence_type"), filters.get("domain"), k
+            )
+
+        ctx = QueryContext(engine, query, filters)
+        doc_ids, scores = self._first_stage(ctx, mask, max(k, self.n_candidates))
+        report = [StageReport(self.ranking, len(doc_ids), (time.perf_counter() - start) * 1000, "ran")]
+
+        # rerank scores are rescaled to the first stage's range
+        reference = scores.max() if len(scores) and scores.max() > 0 else 1.0
+        combined = scores.astype(np.float64)
+
+        for stage in self.stages:
+            status = "ran"
+            if budget_ms is not None:
+                left = budget_ms - (time.perf_counter() - start) * 1000
+                if stage.estimate(len(doc_ids)) > left:
+                    n_fit = stage.fits(left)
+                    if n_fit < k:
+                        report.append(StageReport(stage.name, len(doc_ids), 0.0, "skipped"))
+                        continue
+                    keep = np.lexsort((-doc_ids, -combined))[:n_fit]
+                    doc_ids, combined = doc_ids[keep], combined[keep]
+                    status = "truncated"
+
+            stage_start = time.perf_counter()
+            stage_scores = stage.score(ctx, doc_ids)
+            top = stage_scores.max() if len(stage_scores) else 0
+            if top > 0:
+                combined = combined + stage.weight * stage_scores * (reference / top)
+            ms = (time.perf_counter() - stage_start) * 1000
+            stage.observe(len(doc_ids), ms)
+            report.append(StageReport(stage.name, len(doc_ids), ms, status))
+
+        # score desc, then higher doc index first (as in topk.py)
+        order = np.lexsort((-doc_ids, -combined))[:k]
+        return build_hits(engine.store, doc_ids[order], combined[order], fields), report
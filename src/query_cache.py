@@ -0,0 +1,286 @@
+"""
+Query result cache for the search engines.
+
+Keys are the preprocess_text-normalised query plus the resolved filters
+and k, so "Benefits of the Pink Tower?" and "benefits of the pink tower"
+share an entry. Entries live in a bounded LRU (optional TTL) and can be
+backed by an SQLite file that survives restarts. Every entry is tagged
+with the index version (manifest build id); when it changes, the cache
+is dropped, and without one nothing is cached.
+
+Usage:
+    engine = CachedSearchEngine(FilterMontessoriSearchEngine(), max_entries=2048, ttl=3600)
+    engine.search("benefits of the Pink Tower", k=5)
+    print(engine.cache.stats())
+"""
+
+import copy
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from hits import Hit, SearchResults
+from idx_tfidf import MATRIX_FILE, preprocess_text
+
+
+class QueryCache:
+    """
+    Bounded LRU with optional TTL and optional on-disk (SQLite) tier.
+    -----
+    :param max_entries: in-memory capacity, least recently used evicted first
+    :param ttl: seconds an entry stays valid (None = forever)
+    :param disk_path: SQLite file for the persistent tier (None = memory only)
+
+    Until set_version() is given an index version (not None), every
+    lookup misses and nothing is stored.
+    """
+    def __init__(self, max_entries=1024, ttl=None, disk_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = None
+        self._entries = OrderedDict()   # key -> (created, value)
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ["hits", "misses", "disk_hits", "evictions", "expirations", "invalidations"], 0
+        )
+
+        self._db = None
+        if disk_path is not None:
+            os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, version TEXT, created REAL, value BLOB)"
+            )
+            self._db.commit()
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def set_version(self, version):
+        """
+        Drop everything cached under a different index version.
+        """
+        with self._lock:
+            if version == self.version:
+                return
+            if self.version is not None:
+                self._stats["invalidations"] += 1
+            self.version = version
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM results WHERE version != ?", (str(version),))
+                self._db.commit()
+
+    def get(self, key):
+        with self._lock:
+            if self.version is None:
+                self._stats["misses"] += 1
+                return None
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, value = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value
+                del self._entries[key]
+                self._stats["expirations"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT created, value FROM results WHERE key = ? AND version = ?",
+                    (key, str(self.version)),
+                ).fetchone()
+                if row is not None and not self._expired(row[0]):
+                    value = pickle.loads(row[1])
+                    self._insert(key, row[0], value)
+                    self._stats["hits"] += 1
+                    self._stats["disk_hits"] += 1
+                    return value
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            if self.version is None:
+                return
+            created = time.time()
+            self._insert(key, created, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                    (key, str(self.version), created, pickle.dumps(value)),
+                )
+                self._db.commit()
+
+    def _insert(self, key, created, value):
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM results")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+                "version": self.version,
+            }
+
+
+def index_version(engine):
+    """
+    Build id of the engine's index (manifest) plus its segment generation
+    (segments.py). Without an index manifest: the doc store's build id,
+    else the pickled matrix's mtime, else None (nothing to tell a rebuild
+    by, so QueryCache caches nothing).
+    """
+    generation = getattr(engine, "segment_generation", 0)
+    manifest = getattr(engine, "index_manifest", None)
+    if manifest is not None:
+        return f"{manifest['build_id']}:{generation}"
+    store_manifest = getattr(getattr(engine, "store", None), "manifest", None)
+    if store_manifest is not None:
+        return f"store:{store_manifest['build_id']}:{generation}"
+    if os.path.exists(MATRIX_FILE):
+        return f"pickle:{os.path.getmtime(MATRIX_FILE)}"
+    return None
+
+
+def cache_key(query, k, filters, **options):
+    """
+    The preprocess_text-normalised query plus everything else that
+    changes its results (resolved filters, k, fields, ranking, ...)
+    """
+    return json.dumps([preprocess_text(query), filters, k, options], sort_keys=True)
+
+
+def result_entry(results):
+    """
+    SearchResults -> what the cache stores: (index, score, snippet, group)
+    of every hit plus the facets / groups. No field values: those are read
+    from the store again when the entry is used, as Hits always do.
+    """
+    return {
+        "hits": [(h.index, h.score, h.snippet, h.group) for h in results],
+        "facets": results.facets,
+        "groups": results.groups,
+    }
+
+
+def entry_results(store, entry, fields=None):
+    """
+    result_entry -> SearchResults of new Hits (copies, so callers can't
+    change the cached entry)
+    """
+    fields = store.check_fields(fields)
+    results = SearchResults()
+    for index, score, snippet, group in entry["hits"]:
+        hit = Hit(index, score, store, fields)
+        hit.snippet, hit.group = copy.deepcopy(snippet), copy.deepcopy(group)
+        results.append(hit)
+    results.facets = copy.deepcopy(entry["facets"])
+    results.groups = copy.deepcopy(entry["groups"])
+    return results
+
+
+class CachedSearchEngine:
+    """
+    Cache in front of BasicMontessoriSearchEngine / FilterMontessoriSearchEngine.
+    Filters are resolved before the lookup (no interactive prompt), so
+    filter_policy is "auto", "suggest" or "off". Every search option is
+    part of the key; results come back as the engine's Hits (snippet,
+    group, facets and groups included), only trace isn't supported.
+    """
+    def __init__(self, engine, cache=None, **cache_kwargs):
+        self.engine = engine
+        self.cache = cache if cache is not None else QueryCache(**cache_kwargs)
+        self.cache.set_version(index_version(engine))
+
+    def _resolve_filters(self, query, filter_policy):
+        if filter_policy == "auto" and hasattr(self.engine, "suggest_filters"):
+            return self.engine.suggest_filters(query)
+        return None
+
+    def cache_key(self, query, k, filters, fields=None, ranking="tfidf", **options):
+        return cache_key(query, k, filters, fields=fields, ranking=ranking, **options)
+
+    def search(self, query, k=5, filter_policy="auto", fields=None, ranking="tfidf", snippets=False, collapse=False,
+               diversify=None, group_by=None, facets=None, facet_top_n=None, facet_min_score=0.0):
+        return self.search_many(
+            [query], k=k, filter_policy=filter_policy, fields=fields, ranking=ranking, snippets=snippets,
+            collapse=collapse, diversify=diversify, group_by=group_by, facets=facets, facet_top_n=facet_top_n,
+            facet_min_score=facet_min_score,
+        )[0]
+
+    def search_many(self, queries, k=5, filter_policy="auto", fields=None, ranking="tfidf", snippets=False,
+                    collapse=False, diversify=None, group_by=None, facets=None, facet_top_n=None,
+                    facet_min_score=0.0):
+        """
+        Cached results where possible; all misses go to the engine as
+        one search_many() call (one search() per query with group_by or
+        facets, which search_many doesn't do).
+        """
+        if filter_policy not in ("auto", "suggest", "off"):
+            raise ValueError(f"filter_policy must be 'auto', 'suggest' or 'off', got {filter_policy!r}")
+        if facets and not hasattr(self.engine, "suggest_filters"):
+            raise ValueError("facets need a FilterMontessoriSearchEngine")
+
+        # index rebuilt/reloaded since the entries were stored?
+        self.cache.set_version(index_version(self.engine))
+
+        filters = [self._resolve_filters(q, filter_policy) for q in queries]
+        if fields is not None:
+            fields = list(fields)
+        options = {"snippets": snippets, "collapse": collapse, "diversify": diversify}
+        per_query = {"group_by": group_by}
+        if facets:
+            per_query.update(facets=facets, facet_top_n=facet_top_n, facet_min_score=facet_min_score)
+        keys = [
+            self.cache_key(q, k, f, fields, ranking, **options, **per_query)
+            for q, f in zip(queries, filters)
+        ]
+
+        entries = [self.cache.get(key) for key in keys]
+        missing = [i for i, e in enumerate(entries) if e is None]
+
+        if missing:
+            miss_queries = [queries[i] for i in missing]
+            if group_by is not None or facets:
+                if hasattr(self.engine, "suggest_filters"):
+                    per_query["filter_policy"] = "auto" if filter_policy == "auto" else "off"
+                fresh = [
+                    self.engine.search(q, k=k, fields=fields, ranking=ranking, **options, **per_query)
+                    for q in miss_queries
+                ]
+            elif hasattr(self.engine, "suggest_filters"):
+                fresh = self.engine.search_many(
+                    miss_queries, k=k, filters=[filters[i] for i in missing],
+                    fields=fields, ranking=ranking, **options,
+                )
+            else:
+                fresh = self.engine.search_many(miss_queries, k=k, fields=fields, ranking=ranking, **options)
+
+            for i, hits in zip(missing, fresh):
+                entries[i] = result_entry(hits)
+                self.cache.put(keys[i], entries[i])
+
+        return [entry_results(self.engine.store, e, fields) for e in entries]
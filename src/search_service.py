@@ -0,0 +1,500 @@
+"""
+Headless search service (HTTP/JSON) over FilterMontessoriSearchEngine.
+
+The index is loaded once. Requests arriving within a short window are
+coalesced into one search_many() call, so concurrent clients share a
+single batched scoring pass. Only the standard library is used.
+
+Usage:
+    python src/search_service.py [--host 127.0.0.1] [--port 8000]
+        [--batch-window-ms 5] [--max-batch 64]
+        [--max-concurrency 32] [--timeout 10]
+        [--cache-size 2048 [--cache-ttl 3600] [--cache-db models/query_cache.db]]
+        [--profile-every N --profile-out search.prof]
+
+With --cache-size, results are cached (query_cache.py) in front of the
+scoring: cached requests of a batch are answered without the engine,
+the rest are scored together as usual. Requests with "trace" bypass it.
+
+Endpoints:
+    GET  /health
+    GET  /stats    per-stage timings and counters (JSON, instrumentation.py)
+    GET  /metrics  the same in the Prometheus text format
+    POST /search   {"query": "...", "k": 5, "filter_policy": "auto", "fields": [...],
+                    "ranking": "tfidf", "trace": false}
+                   filter_policy is "auto", "suggest" or "off"
+                   ranking is "tfidf", "bm25" (index built with --bm25) or
+                   "dense" (index built with --dense)
+                   fields (optional) projects the results onto some of
+                   RESULT_FIELDS; every field is returned by default
+                   trace adds the stage times / counters of the batch
+                   the query was scored in
+                   "facets": true (or a list of facets.COUNT_COLUMNS) adds
+                   value counts over the matching documents, optionally
+                   limited by "facet_top_n" / "facet_min_score"; such
+                   requests are scored on their own, not batched
+                   "snippets": true gives every result a "snippet" (the
+                   highlighted passage window with the most query terms,
+                   see snippets.py)
+                   "collapse": true shows one result per near-duplicate
+                   cluster (needs data/duplicates.csv, see dedup.py)
+                   "diversify": "mmr" or "source" picks the k results
+                   from the top-N for diversity (see diversify.py)
+                   "group_by": "source_file" or "source_title" returns the
+                   best result of each of the k best groups, with its
+                   "group" and the response's "groups" (see grouping.py);
+                   scored on its own, like facets
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import numpy as np
+
+from diversify import DIVERSIFY_METHODS
+from facets import COUNT_COLUMNS
+from grouping import GROUP_FIELDS
+from filter_search import FILTER_POLICIES, FilterMontessoriSearchEngine
+from hits import RESULT_FIELDS
+from instrumentation import METRIC_PREFIX
+from query_cache import QueryCache, cache_key, entry_results, index_version, result_entry
+from topk import RANKINGS
+
+
+DEFAULT_K = 5
+MAX_K = 100
+MAX_BODY_BYTES = 1 << 16
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def to_jsonable(value):
+    """
+    numpy scalars -> python, NaN -> None
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+# ----------------------------------------------
+# MICRO-BATCHING
+# ----------------------------------------------
+
+class MicroBatcher:
+    """
+    Collects search requests for up to batch_window seconds (or max_batch
+    requests) and runs them as one engine.search_many() call in a worker
+    thread, so the event loop never blocks on scoring. With a cache
+    (query_cache.QueryCache), only the requests it misses are scored.
+    """
+    def __init__(self, engine, batch_window=0.005, max_batch=64, cache=None):
+        self.engine = engine
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.cache = cache
+        self.queue = asyncio.Queue()
+        # one thread: the engine itself is not made thread-safe
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.batched_requests = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, query, k, filters, fields=None, ranking="tfidf", trace=False, snippets=False,
+                     collapse=False, diversify=None):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, k, filters, fields, ranking, trace, snippets, collapse, diversify, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # requests whose client already gave up don't need scoring
+            batch = [item for item in batch if not item[-1].done()]
+            if not batch:
+                continue
+
+            self.batches += 1
+            self.batched_requests += len(batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self._search_batch, batch)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (*_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _cache_version(self):
+        # index rebuilt/reloaded since the entries were stored?
+        self.cache.set_version(index_version(self.engine))
+
+    def _search_batch(self, batch):
+        """
+        One search_many() call per distinct k (the filter fallback depends
+        on k), field projection, ranking, snippets, collapse and
+        diversification, usually just one, for the requests not cached.
+        """
+        results = [None] * len(batch)
+        keys = [None] * len(batch)
+        if self.cache is not None:
+            self._cache_version()
+            for i, (query, k, filters, fields, ranking, trace, snippets, collapse, diversify, _) in enumerate(batch):
+                if trace:
+                    continue
+                keys[i] = cache_key(query, k, filters, fields=fields, ranking=ranking, snippets=snippets,
+                                    collapse=collapse, diversify=diversify, group_by=None)
+                entry = self.cache.get(keys[i])
+                if entry is not None:
+                    results[i] = entry_results(self.engine.store, entry, fields)
+
+        groups = {}
+        for i, (_, k, _, fields, ranking, _, snippets, collapse, diversify, _) in enumerate(batch):
+            if results[i] is None:
+                groups.setdefault((k, fields, ranking, snippets, collapse, diversify), []).append(i)
+
+        for (k, fields, ranking, snippets, collapse, diversify), positions in groups.items():
+            hits = self.engine.search_many(
+                [batch[i][0] for i in positions],
+                k=k,
+                filters=[batch[i][2] for i in positions],
+                fields=fields,
+                ranking=ranking,
+                trace=any(batch[i][5] for i in positions),
+                snippets=snippets,
+                collapse=collapse,
+                diversify=diversify,
+            )
+            for i, h in zip(positions, hits):
+                results[i] = h
+                if keys[i] is not None:
+                    self.cache.put(keys[i], result_entry(h))
+        return results
+
+    def search_one(self, search, key, fields):
+        """
+        search() of one unbatched request (facets, group_by) through the
+        cache; key None = not cached
+        """
+        if self.cache is None or key is None:
+            return search()
+        self._cache_version()
+        entry = self.cache.get(key)
+        if entry is None:
+            results = search()
+            self.cache.put(key, result_entry(results))
+            return results
+        return entry_results(self.engine.store, entry, fields)
+
+
+# ----------------------------------------------
+# HTTP
+# ----------------------------------------------
+
+class SearchService:
+    def __init__(self, engine, batch_window=0.005, max_batch=64,
+                 max_concurrency=32, request_timeout=10.0, cache=None):
+        self.engine = engine
+        self.batcher = MicroBatcher(engine, batch_window, max_batch, cache)
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.requests = 0
+        self.started = time.time()
+        self._slots = None
+
+    async def search(self, payload):
+        """
+        Handle one /search payload (already JSON-decoded).
+        """
+        query = payload.get("query")
+        if not isinstance(query, str) or not query.strip():
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "'query' must be a non-empty string")
+
+        k = payload.get("k", DEFAULT_K)
+        if not isinstance(k, int) or not 0 < k <= MAX_K:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, f"'k' must be an integer in 1..{MAX_K}")
+
+        filter_policy = payload.get("filter_policy", "auto")
+        if filter_policy not in FILTER_POLICIES or filter_policy == "prompt":
+            allowed = [p for p in FILTER_POLICIES if p != "prompt"]
+            raise ServiceError(HTTPStatus.BAD_REQUEST, f"'filter_policy' must be one of {allowed}")
+
+        fields = payload.get("fields")
+        if fields is not None:
+            if not isinstance(fields, list) or not all(f in RESULT_FIELDS for f in fields):
+                raise ServiceError(HTTPStatus.BAD_REQUEST, f"'fields' must be a list of {RESULT_FIELDS}")
+            fields = tuple(fields)
+
+        trace = payload.get("trace", False)
+        if not isinstance(trace, bool):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "'trace' must be true or false")
+
+        snippets = payload.get("snippets", False)
+        if not isinstance(snippets, bool):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "'snippets' must be true or false")
+
+        collapse = payload.get("collapse", False)
+        if not isinstance(collapse, bool):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "'collapse' must be true or false")
+
+        diversify = payload.get("diversify")
+        if diversify is not None and diversify not in DIVERSIFY_METHODS:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, f"'diversify' must be null or one of {list(DIVERSIFY_METHODS)}")
+
+        group_by = payload.get("group_by")
+        if group_by is not None and group_by not in GROUP_FIELDS:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, f"'group_by' must be null or one of {list(GROUP_FIELDS)}")
+        if group_by is not None and diversify is not None:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "'group_by' and 'diversify' can't be combined")
+
+        ranking = payload.get("ranking", "tfidf")
+        if ranking not in RANKINGS:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, f"'ranking' must be one of {list(RANKINGS)}")
+        if ranking == "bm25" and self.engine.bm25_scorer is None:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "no BM25 index (build it with idx_tfidf.py --bm25)")
+        if ranking == "dense" and self.engine.dense_index is None:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "no dense index (build it with idx_tfidf.py --dense)")
+
+        suggested = None
+        if filter_policy != "off":
+            suggested = self.engine.suggest_filters(query)
+        applied = suggested if filter_policy == "auto" else None
+
+        facets = payload.get("facets", False)
+        if not (isinstance(facets, bool) or isinstance(facets, list) and all(c in COUNT_COLUMNS for c in facets)):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, f"'facets' must be true/false or a list of {COUNT_COLUMNS}")
+        facet_top_n = payload.get("facet_top_n")
+        if facet_top_n is not None and (not isinstance(facet_top_n, int) or facet_top_n <= 0):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "'facet_top_n' must be a positive integer")
+        facet_min_score = payload.get("facet_min_score", 0.0)
+        if not isinstance(facet_min_score, (int, float)):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "'facet_min_score' must be a number")
+
+        if facets or group_by:
+            # facet counts and groups need every match of the query, not just a batch's top-k
+            search = functools.partial(
+                self.engine.search, query, k,
+                filter_policy="auto" if filter_policy == "auto" else "off",
+                fields=fields, ranking=ranking, trace=trace,
+                facets=facets, facet_top_n=facet_top_n, facet_min_score=facet_min_score, snippets=snippets,
+                collapse=collapse, diversify=diversify, group_by=group_by,
+            )
+            key = None if trace else cache_key(
+                query, k, applied, fields=fields, ranking=ranking, snippets=snippets, collapse=collapse,
+                diversify=diversify, group_by=group_by, facets=facets, facet_top_n=facet_top_n,
+                facet_min_score=facet_min_score,
+            )
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.batcher.executor, self.batcher.search_one, search, key, fields
+            )
+        else:
+            results = await self.batcher.submit(
+                query, k, applied, fields, ranking, trace, snippets, collapse, diversify
+            )
+        response = {
+            "query": query,
+            "k": k,
+            "ranking": ranking,
+            "filter_policy": filter_policy,
+            "suggested_filters": suggested,
+            "applied_filters": applied,
+            "results": [
+                {key: to_jsonable(value) for key, value in r.items()}
+                for r in results
+            ],
+        }
+        if facets:
+            response["facets"] = results.facets
+        if group_by:
+            response["groups"] = results.groups
+        if trace:
+            response["trace"] = results.trace.to_dict()
+        return response
+
+    def health(self):
+        health = {
+            "status": "ok",
+            "documents": len(self.engine.store),
+            "uptime_s": round(time.time() - self.started, 1),
+            "requests": self.requests,
+            "batches": self.batcher.batches,
+            "batched_requests": self.batcher.batched_requests,
+        }
+        if self.batcher.cache is not None:
+            health["cache"] = self.batcher.cache.stats()
+        return health
+
+    def metrics(self):
+        """
+        Engine metrics (Prometheus text format) plus the service's own
+        """
+        prefix = METRIC_PREFIX
+        lines = [
+            f"# HELP {prefix}_http_requests_total Search requests received",
+            f"# TYPE {prefix}_http_requests_total counter",
+            f"{prefix}_http_requests_total {self.requests}",
+            f"# HELP {prefix}_batches_total Batches scored by the micro-batcher",
+            f"# TYPE {prefix}_batches_total counter",
+            f"{prefix}_batches_total {self.batcher.batches}",
+        ]
+        return self.engine.instrumentation.prometheus(prefix) + "\n".join(lines) + "\n"
+
+    async def handle(self, reader, writer):
+        try:
+            status, body = await self._handle_request(reader)
+        except ServiceError as e:
+            status, body = e.status, {"error": str(e)}
+        except Exception as e:
+            status, body = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"}
+
+        # str bodies are plain text (/metrics), everything else JSON
+        if isinstance(body, str):
+            data, content_type = body.encode("utf-8"), PROMETHEUS_CONTENT_TYPE
+        else:
+            data, content_type = json.dumps(body).encode("utf-8"), "application/json"
+        writer.write(
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode("ascii") + data
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader):
+        request_line = await reader.readline()
+        try:
+            method, path, _ = request_line.decode("ascii").split(" ", 2)
+        except ValueError:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "malformed request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if path == "/health" and method == "GET":
+            return HTTPStatus.OK, self.health()
+        if path == "/stats" and method == "GET":
+            return HTTPStatus.OK, self.engine.instrumentation.stats()
+        if path == "/metrics" and method == "GET":
+            return HTTPStatus.OK, self.metrics()
+        if path != "/search":
+            raise ServiceError(HTTPStatus.NOT_FOUND, f"no route {path}")
+        if method != "POST":
+            raise ServiceError(HTTPStatus.METHOD_NOT_ALLOWED, "use POST /search")
+
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES:
+            raise ServiceError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "request body too large")
+        try:
+            payload = json.loads(await reader.readexactly(length))
+        except (ValueError, asyncio.IncompleteReadError):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "body must be JSON")
+        if not isinstance(payload, dict):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "body must be a JSON object")
+
+        self.requests += 1
+        # concurrency limit: requests wait for a slot, within their timeout
+        try:
+            return HTTPStatus.OK, await asyncio.wait_for(
+                self._search_limited(payload), self.request_timeout
+            )
+        except asyncio.TimeoutError:
+            raise ServiceError(HTTPStatus.GATEWAY_TIMEOUT, f"timed out after {self.request_timeout}s")
+
+    async def _search_limited(self, payload):
+        async with self._slots:
+            return await self.search(payload)
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self.batcher.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port} (POST /search, GET /health, GET /stats, GET /metrics)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Montessori search HTTP/JSON service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--batch-window-ms", type=float, default=5.0)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-concurrency", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--cache-size", type=int, default=0,
+                        help="cache the results of up to N queries (0 = no cache)")
+    parser.add_argument("--cache-ttl", type=float, default=None, help="seconds a cached result stays valid")
+    parser.add_argument("--cache-db", default=None, help="SQLite file keeping the cache across restarts")
+    parser.add_argument("--profile-every", type=int, default=0,
+                        help="run one query in N under cProfile (0 = off)")
+    parser.add_argument("--profile-out", default="search.prof",
+                        help="aggregated profile, pstats format")
+    args = parser.parse_args()
+
+    engine = FilterMontessoriSearchEngine()
+    cache = None
+    if args.cache_size:
+        cache = QueryCache(max_entries=args.cache_size, ttl=args.cache_ttl, disk_path=args.cache_db)
+    if args.profile_every:
+        engine.instrumentation.enable_profiling(every=args.profile_every, out=args.profile_out)
+    service = SearchService(
+        engine,
+        batch_window=args.batch_window_ms / 1000,
+        max_batch=args.max_batch,
+        max_concurrency=args.max_concurrency,
+        request_timeout=args.timeout,
+        cache=cache,
+    )
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("\nGoodbye 👋")
+    finally:
+        if args.profile_every and engine.instrumentation.dump_profile():
+            print(f"Profile written to {args.profile_out}")
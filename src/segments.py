@@ -0,0 +1,478 @@
+"""
+Incremental index updates (append / delete) without refitting the vectorizer.
+
+New passages are vectorized against the existing vocabulary and IDF and
+written as delta segments next to the base index; deletions are
+tombstones (the deleted row: base index or segment + row number)
+filtered out at query time, so a doc_id deleted and added again is
+only hidden in its old row. Once there are too many
+delta segments they are merged into one (in a background thread by
+default), dropping tombstoned rows. IDF drift (how far the frozen IDF is
+from what a refit would give) is tracked so we know when a full rebuild
+with idx_tfidf.py is worth it.
+
+Layout of SEGMENTS_DIR:
+    segments.json     base build id, generation, segment list, tombstones
+                      ({"doc_id", "segment" (None = base index), "row"})
+    df_delta.bin      per-term document-frequency change since the build
+    seg_<n>/          one delta segment: CSR arrays + corpus rows (pickle)
+
+Usage:
+    writer = SegmentWriter()
+    writer.add_documents(new_rows_df)   # needs doc_id + text columns
+    writer.delete_documents(["excerpt_12"])
+    print(writer.idf_drift())
+
+Search engines pick up the segments the next time they are started.
+"""
+
+import json
+import os
+import pickle
+import shutil
+import threading
+import zlib
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, diags, vstack
+from sklearn.feature_extraction.text import CountVectorizer
+
+from idx_tfidf import PROCESSED_CORPUS_FILE, VECTORIZER_FILE, preprocess_text
+from index_store import INDEX_DIR, load_index, open_array, read_manifest, write_array
+from doc_store import as_column_store, load_corpus
+
+
+SEGMENTS_DIR = os.path.join(INDEX_DIR, "segments")
+STATE_FILE = "segments.json"
+DF_DELTA_FILE = "df_delta.bin"
+
+MAX_SEGMENTS = 8          # merge delta segments once there are more than this
+REBUILD_DRIFT = 0.05      # mean relative IDF change that warrants a full rebuild
+
+CORPUS_COLUMNS = [
+    "doc_id", "text", "raw_text", "approach", "domain", "evidence_type",
+    "source_type", "source_title", "source_file", "paragraph_index"
+]
+
+
+# ----------------------------------------------
+# VECTORIZING AGAINST THE FROZEN VOCABULARY
+# ----------------------------------------------
+
+def oov_column(term, n_features, oov_buckets):
+    return n_features + zlib.crc32(term.encode("utf-8")) % oov_buckets
+
+
+def vectorize(vectorizer, processed_texts, oov_buckets=0):
+    """
+    vectorizer.transform, optionally hashing out-of-vocabulary terms into
+    oov_buckets extra columns (weighted with the largest IDF, i.e. as rare
+    terms) so new words in appended passages are still searchable.
+    -----
+    :param processed_texts: preprocess_text output
+    """
+    if not oov_buckets:
+        return vectorizer.transform(processed_texts)
+
+    n_features = len(vectorizer.vocabulary_)
+    analyzer = vectorizer.build_analyzer()
+    max_idf = float(vectorizer.idf_.max())
+
+    # un-normalised tf-idf of the in-vocabulary terms (raw counts x idf)
+    counts = CountVectorizer.transform(vectorizer, processed_texts)
+    X = (counts @ diags(vectorizer.idf_)).tocsr()
+
+    rows, cols, vals = [], [], []
+    for i, text in enumerate(processed_texts):
+        oov_counts = {}
+        for term in analyzer(text):
+            if term not in vectorizer.vocabulary_:
+                col = oov_column(term, n_features, oov_buckets)
+                oov_counts[col] = oov_counts.get(col, 0) + 1
+        for col, tf in oov_counts.items():
+            rows.append(i)
+            cols.append(col)
+            vals.append(tf * max_idf)
+
+    shape = (X.shape[0], n_features + oov_buckets)
+    X = csr_matrix((X.data, X.indices, X.indptr), shape=shape)
+    X = (X + csr_matrix((vals, (rows, cols)), shape=shape)).tocsr()
+
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    inv = np.zeros(len(norms))
+    np.divide(1.0, norms, out=inv, where=norms > 0)
+    return (diags(inv) @ X).tocsr()
+
+
+def count_vectorize(vectorizer, processed_texts):
+    """
+    Raw term counts over the vectorizer's vocabulary (BM25 queries).
+    """
+    return CountVectorizer.transform(vectorizer, processed_texts)
+
+
+def document_frequency(vectorizer, n_docs):
+    """
+    Recover df from the fitted smooth IDF: idf = ln((1 + n) / (1 + df)) + 1
+    """
+    return (1 + n_docs) / np.exp(vectorizer.idf_ - 1) - 1
+
+
+# ----------------------------------------------
+# STATE
+# ----------------------------------------------
+
+def read_state(segments_dir=SEGMENTS_DIR):
+    path = os.path.join(segments_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_state(segments_dir, state):
+    tmp_path = os.path.join(segments_dir, STATE_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, os.path.join(segments_dir, STATE_FILE))
+
+
+def write_segment(segments_dir, name, matrix, corpus):
+    seg_dir = os.path.join(segments_dir, name)
+    os.makedirs(seg_dir, exist_ok=True)
+    matrix = csr_matrix(matrix)
+    arrays = {
+        "data": write_array(seg_dir, "data", matrix.data),
+        "indices": write_array(seg_dir, "indices", matrix.indices),
+        "indptr": write_array(seg_dir, "indptr", matrix.indptr),
+    }
+    corpus.to_pickle(os.path.join(seg_dir, "corpus.pkl"))
+    return {
+        "name": name,
+        "n_docs": int(matrix.shape[0]),
+        "n_features": int(matrix.shape[1]),
+        "arrays": arrays,
+    }
+
+
+def open_segment(segments_dir, entry):
+    seg_dir = os.path.join(segments_dir, entry["name"])
+    arrays = {name: open_array(seg_dir, e) for name, e in entry["arrays"].items()}
+    matrix = csr_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]),
+        shape=(entry["n_docs"], entry["n_features"]),
+        copy=False,
+    )
+    corpus = pd.read_pickle(os.path.join(seg_dir, "corpus.pkl"))
+    return matrix, corpus
+
+
+class SegmentState:
+    """
+    What a search engine needs from the segments: the base + delta
+    matrix/corpus, which rows are live, and the state generation.
+    """
+    def __init__(self, matrix, corpus, live_mask, generation, n_delta_docs, oov_buckets):
+        self.matrix = matrix
+        self.corpus = corpus
+        self.live_mask = live_mask        # None when nothing is tombstoned
+        self.generation = generation
+        self.n_delta_docs = n_delta_docs
+        self.oov_buckets = oov_buckets
+
+
+def attach_segments(tfidf_matrix, corpus, manifest, segments_dir=SEGMENTS_DIR):
+    """
+    Append the delta segments to the base matrix/corpus and compute the
+    live-document mask. Segments written against another base build are
+    ignored (a full rebuild supersedes them).
+    """
+    state = read_state(segments_dir)
+    if state is None:
+        return SegmentState(tfidf_matrix, corpus, None, 0, 0, 0)
+
+    base_build = manifest["build_id"] if manifest is not None else None
+    if state["base_build_id"] != base_build:
+        print(f"** Ignoring index segments in {segments_dir}: written for another base build")
+        return SegmentState(tfidf_matrix, corpus, None, 0, 0, 0)
+
+    width = tfidf_matrix.shape[1] + state["oov_buckets"]
+    matrices = [csr_matrix(
+        (tfidf_matrix.data, tfidf_matrix.indices, tfidf_matrix.indptr),
+        shape=(tfidf_matrix.shape[0], width),
+    )]
+    corpora = []
+    for entry in state["segments"]:
+        m, c = open_segment(segments_dir, entry)
+        matrices.append(m)
+        corpora.append(c)
+
+    n_delta = sum(entry["n_docs"] for entry in state["segments"])
+    if n_delta:
+        tfidf_matrix = vstack(matrices, format="csr")
+        # the base corpus may be a doc store: materialised to append the delta rows
+        corpus = pd.concat([as_column_store(corpus).to_frame()] + corpora, ignore_index=True)
+    else:
+        tfidf_matrix = matrices[0]
+
+    live_mask = None
+    if state["tombstones"]:
+        # first row of the base index and of every segment in the stacked matrix
+        offsets = {None: 0}
+        offset = matrices[0].shape[0]
+        for entry in state["segments"]:
+            offsets[entry["name"]] = offset
+            offset += entry["n_docs"]
+        live_mask = np.ones(tfidf_matrix.shape[0], dtype=bool)
+        live_mask[[offsets[t["segment"]] + t["row"] for t in state["tombstones"]]] = False
+
+    return SegmentState(
+        tfidf_matrix, corpus, live_mask, state["generation"], n_delta, state["oov_buckets"]
+    )
+
+
+# ----------------------------------------------
+# WRITER
+# ----------------------------------------------
+
+class SegmentWriter:
+    """
+    Appends / deletes documents as delta segments over the base index.
+    -----
+    :param index_dir: base index (must have been built by idx_tfidf.py)
+    :param oov_buckets: hashed columns for terms outside the vocabulary
+        (0 = ignore unseen terms); fixed once the first segment exists
+    :param max_segments: merge the delta segments beyond this many
+    :param background_merge: merge in a background thread
+    """
+    def __init__(self, index_dir=INDEX_DIR, vectorizer_file=VECTORIZER_FILE,
+                 oov_buckets=0, max_segments=MAX_SEGMENTS, background_merge=True):
+        self.index_dir = index_dir
+        self.segments_dir = os.path.join(index_dir, "segments")
+        self.max_segments = max_segments
+        self.background_merge = background_merge
+        self.vectorizer = pickle.load(open(vectorizer_file, "rb"))
+        self.n_features = len(self.vectorizer.vocabulary_)
+
+        self.manifest = read_manifest(index_dir)
+        if self.manifest is None:
+            raise FileNotFoundError(f"no index in {index_dir}; run idx_tfidf.py first")
+
+        self._lock = threading.Lock()
+        self._merge_thread = None
+        self._base_rows = None
+
+        os.makedirs(self.segments_dir, exist_ok=True)
+        state = read_state(self.segments_dir)
+        if state is None or state["base_build_id"] != self.manifest["build_id"]:
+            state = self._new_state(oov_buckets)
+        elif state["oov_buckets"] != oov_buckets and state["segments"]:
+            raise ValueError(
+                f"segments were written with oov_buckets={state['oov_buckets']}"
+            )
+        self.state = state
+
+    def _new_state(self, oov_buckets):
+        # old segments belong to a previous build
+        for name in os.listdir(self.segments_dir):
+            path = os.path.join(self.segments_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+        write_array(self.segments_dir, "df_delta", np.zeros(self.n_features, dtype=np.int64))
+        state = {
+            "base_build_id": self.manifest["build_id"],
+            "base_docs": self.manifest["n_docs"],
+            "generation": 0,
+            "next_segment": 0,
+            "oov_buckets": oov_buckets,
+            "segments": [],
+            "tombstones": [],
+            "docs_added": 0,
+            "docs_deleted": 0,
+        }
+        write_state(self.segments_dir, state)
+        return state
+
+    def _df_delta(self):
+        return np.fromfile(os.path.join(self.segments_dir, DF_DELTA_FILE), dtype=np.int64)
+
+    def _update_df(self, matrix, sign):
+        vocab_part = csr_matrix(matrix)[:, :self.n_features]
+        df = np.bincount(vocab_part.indices, minlength=self.n_features)
+        write_array(self.segments_dir, "df_delta", self._df_delta() + sign * df)
+
+    def _base_doc_rows(self):
+        """
+        doc_id -> row of the base index, read once from the doc store (or
+        the pickled corpus if there is none)
+        """
+        if self._base_rows is None:
+            corpus = load_corpus(PROCESSED_CORPUS_FILE, os.path.join(self.index_dir, "docs"))
+            doc_ids = as_column_store(corpus).column("doc_id")
+            self._base_rows = {d: row for row, d in enumerate(doc_ids)}
+        return self._base_rows
+
+    def _live_doc_rows(self):
+        """
+        doc_id -> (segment name, row) of every document not tombstoned;
+        segment None = the base index
+        """
+        dead = {(t["segment"], t["row"]) for t in self.state["tombstones"]}
+        live = {d: (None, row) for d, row in self._base_doc_rows().items() if (None, row) not in dead}
+        for entry in self.state["segments"]:
+            doc_ids = open_segment(self.segments_dir, entry)[1]["doc_id"]
+            live.update(
+                (d, (entry["name"], row)) for row, d in enumerate(doc_ids) if (entry["name"], row) not in dead
+            )
+        return live
+
+    def add_documents(self, df):
+        """
+        Vectorize new rows against the frozen vocabulary and write them as
+        one delta segment.
+        -----
+        :param df: DataFrame with at least doc_id and text (the indexed
+            text); other corpus columns are filled with NaN if missing
+        """
+        df = df.copy()
+        for col in CORPUS_COLUMNS:
+            if col not in df:
+                df[col] = df["text"] if col == "raw_text" else np.nan
+        df = df[CORPUS_COLUMNS]
+        df["processed_text"] = df["text"].apply(preprocess_text)
+
+        with self._lock:
+            clash = set(self._live_doc_rows()).intersection(df["doc_id"])
+            if clash or df["doc_id"].duplicated().any():
+                raise ValueError(f"doc_ids already in the index: {sorted(clash)[:5]}")
+
+            matrix = vectorize(self.vectorizer, df["processed_text"].tolist(), self.state["oov_buckets"])
+            name = f"seg_{self.state['next_segment']:05d}"
+            entry = write_segment(self.segments_dir, name, matrix, df.reset_index(drop=True))
+
+            self._update_df(matrix, +1)
+            self.state["segments"].append(entry)
+            self.state["next_segment"] += 1
+            self.state["generation"] += 1
+            self.state["docs_added"] += len(df)
+            write_state(self.segments_dir, self.state)
+
+        self.maybe_merge()
+        return df["doc_id"].tolist()
+
+    def delete_documents(self, doc_ids):
+        """
+        Tombstone documents (base or delta); they are filtered at query time
+        and dropped from delta segments on the next merge. doc_ids that are
+        in neither (or already deleted) are ignored.
+        -----
+        RETURNS the doc_ids that were deleted
+        """
+        with self._lock:
+            live = self._live_doc_rows()
+            new = [d for d in dict.fromkeys(doc_ids) if d in live]
+            if not new:
+                return []
+
+            # keep the df bookkeeping honest for the drift estimate
+            base_rows = sorted(live[d][1] for d in new if live[d][0] is None)
+            if base_rows:
+                base = load_index(self.index_dir)[0]
+                self._update_df(base[base_rows], -1)
+            for entry in self.state["segments"]:
+                rows = sorted(live[d][1] for d in new if live[d][0] == entry["name"])
+                if rows:
+                    self._update_df(open_segment(self.segments_dir, entry)[0][rows], -1)
+
+            self.state["tombstones"].extend(
+                {"doc_id": d, "segment": live[d][0], "row": live[d][1]} for d in new
+            )
+            self.state["generation"] += 1
+            self.state["docs_deleted"] += len(new)
+            write_state(self.segments_dir, self.state)
+        return new
+
+    # ----------------------------------------------
+    # MERGING
+    # ----------------------------------------------
+
+    def maybe_merge(self):
+        if len(self.state["segments"]) <= self.max_segments:
+            return
+        if self._merge_thread is not None and self._merge_thread.is_alive():
+            return
+        if self.background_merge:
+            self._merge_thread = threading.Thread(target=self.merge, daemon=True)
+            self._merge_thread.start()
+        else:
+            self.merge()
+
+    def wait_for_merge(self):
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+
+    def merge(self):
+        """
+        Merge all delta segments into one, dropping tombstoned rows.
+        Tombstones of the base index stay (as the live mask).
+        Engines that already opened the old segments keep working on them.
+        """
+        with self._lock:
+            entries = list(self.state["segments"])
+            in_segments = [t for t in self.state["tombstones"] if t["segment"] is not None]
+            if not entries or (len(entries) < 2 and not in_segments):
+                return
+
+            dead = {(t["segment"], t["row"]) for t in in_segments}
+            matrices, corpora = [], []
+            for entry in entries:
+                m, c = open_segment(self.segments_dir, entry)
+                keep = np.array([(entry["name"], row) not in dead for row in range(len(c))], dtype=bool)
+                matrices.append(m[np.flatnonzero(keep)])
+                corpora.append(c[keep])
+
+            name = f"seg_{self.state['next_segment']:05d}"
+            merged = write_segment(
+                self.segments_dir,
+                name,
+                vstack(matrices, format="csr"),
+                pd.concat(corpora, ignore_index=True),
+            )
+
+            self.state["segments"] = [merged]
+            self.state["tombstones"] = [t for t in self.state["tombstones"] if t["segment"] is None]
+            self.state["next_segment"] += 1
+            self.state["generation"] += 1
+            write_state(self.segments_dir, self.state)
+
+            for entry in entries:
+                shutil.rmtree(os.path.join(self.segments_dir, entry["name"]), ignore_errors=True)
+
+    # ----------------------------------------------
+    # IDF DRIFT
+    # ----------------------------------------------
+
+    def idf_drift(self):
+        """
+        Compare the frozen IDF with the IDF a refit on base + deltas -
+        tombstones would produce (vocabulary terms only).
+        """
+        n_base = self.state["base_docs"]
+        n_now = n_base + self.state["docs_added"] - self.state["docs_deleted"]
+
+        df_base = document_frequency(self.vectorizer, n_base)
+        df_now = np.maximum(df_base + self._df_delta(), 0)
+        idf_now = np.log((1 + n_now) / (1 + df_now)) + 1
+
+        rel = np.abs(idf_now - self.vectorizer.idf_) / self.vectorizer.idf_
+        return {
+            "base_docs": n_base,
+            "current_docs": int(n_now),
+            "docs_added": self.state["docs_added"],
+            "docs_deleted": self.state["docs_deleted"],
+            "mean_rel_idf_change": float(rel.mean()),
+            "max_rel_idf_change": float(rel.max()),
+            "rebuild_recommended": bool(rel.mean() > REBUILD_DRIFT),
+        }
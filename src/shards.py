@@ -0,0 +1,439 @@
+"""
+Document shards of the postings, scored in parallel by a coordinator.
+
+idx_tfidf.py --shards N splits the documents into N contiguous ranges.
+Every shard holds the postings (see index_store.py) of its rows of the
+global matrix, so vocabulary, idf and document normalisation are those
+of the unsharded index (BM25 weights are computed over the whole corpus
+before splitting). Global doc id = shard doc_offset + local doc id.
+
+A query is scored on every shard at once (PostingsScorer.top_k on the
+shard, candidate mask sliced to its range) in a process pool, threads or
+serially, and the per-shard top-k lists are merged with a heap. A
+shard's top-k holds every document of the global top-k that lives in
+it, in the same order (score desc, doc id desc, zero-score fill
+included), so the merged list is exactly the unsharded result. Query
+terms are ordered by the global per-term max weights, so even the float
+summation order, hence every score, matches.
+
+Worker processes open the shard files with np.memmap on first use, so
+they share the page cache instead of holding copies.
+
+Layout of SHARDS_DIR:
+    manifest.json       build id, index_build_id, shard ranges and arrays
+    term_max.bin        global per-term max weight (bm25_term_max.bin for BM25)
+    shard_000/          postings_*.bin (+ bm25_postings_*.bin)
+    shard_001/ ...
+
+Usage:
+    python src/idx_tfidf.py --shards 4 [--bm25]
+    engine = FilterMontessoriSearchEngine()   # uses the shards (engine.shards)
+    engine.shards.executor = "thread"         # or "process" (default), "serial"
+"""
+
+import heapq
+import itertools
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from index_store import (
+    INDEX_DIR, BM25_B, BM25_K1, StaleIndexError, bm25_stats, bm25_weigher, bm25_weights, chunked_row_norms,
+    normalized_postings, open_array, read_manifest, row_normalizer, write_array, write_manifest,
+    write_postings_chunked,
+)
+from topk import PostingsScorer, select_matches
+
+
+SHARDS_DIR = os.path.join(INDEX_DIR, "shards")
+FORMAT_VERSION = 1
+
+EXECUTORS = ("process", "thread", "serial")
+
+
+# ----------------------------------------------
+# WRITE
+# ----------------------------------------------
+
+def shard_bounds(n_docs, n_shards):
+    """
+    RETURNS n_shards + 1 increasing doc offsets (contiguous, near-equal ranges)
+    """
+    n_shards = max(1, min(n_shards, n_docs))
+    return np.linspace(0, n_docs, n_shards + 1).astype(np.int64)
+
+
+def _write_postings(shard_dir, prefix, indptr, indices, data):
+    return {
+        "postings_indptr": write_array(shard_dir, f"{prefix}postings_indptr", indptr),
+        "postings_indices": write_array(shard_dir, f"{prefix}postings_indices", indices),
+        "postings_data": write_array(shard_dir, f"{prefix}postings_data", data),
+    }
+
+
+def write_shards(tfidf_matrix, index_manifest, shards_dir=SHARDS_DIR, n_shards=4,
+                 bm25_counts=None, k1=BM25_K1, b=BM25_B, chunk_rows=None):
+    """
+    Split the postings into document shards.
+    -----
+    :param tfidf_matrix: the (n_docs x n_features) matrix the index was built from
+    :param index_manifest: manifest of that index (index_store.write_index)
+    :param n_shards: number of shards (at most n_docs)
+    :param bm25_counts: optional term counts, also shards BM25 postings
+        (weights over the whole corpus, see index_store.bm25_weights)
+    :param chunk_rows: write the postings out of core, chunk_rows rows at
+        a time (see index_store.write_postings_chunked); None = in memory
+    -----
+    RETURNS the shards manifest
+    """
+    # a previous build may have had more shards
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    os.makedirs(shards_dir)
+
+    matrix = csr_matrix(tfidf_matrix)
+    matrix.sort_indices()
+    row_norms = chunked_row_norms(matrix, chunk_rows)
+    bounds = shard_bounds(matrix.shape[0], n_shards)
+
+    weights = counts = None
+    if bm25_counts is not None and chunk_rows is None:
+        weights, avgdl = bm25_weights(bm25_counts, k1, b)
+    elif bm25_counts is not None:
+        counts = csr_matrix(bm25_counts, dtype=np.float64)
+        doc_len, avgdl, idf = bm25_stats(counts, chunk_rows)
+        weigh_bm25 = bm25_weigher(doc_len, avgdl, idf, k1, b)
+
+    shards = []
+    term_max = np.zeros(matrix.shape[1])
+    bm25_term_max = np.zeros(matrix.shape[1])
+    for i, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+        name = f"shard_{i:03d}"
+        shard_dir = os.path.join(shards_dir, name)
+        os.makedirs(shard_dir)
+
+        if chunk_rows is None:
+            indptr, indices, data, shard_max = normalized_postings(matrix[lo:hi], row_norms[lo:hi])
+            arrays = _write_postings(shard_dir, "", indptr, indices, data)
+        else:
+            arrays, shard_max = write_postings_chunked(
+                shard_dir, "", matrix, row_normalizer(row_norms), chunk_rows, lo, hi
+            )
+        np.maximum(term_max, shard_max, out=term_max)
+        entry = {
+            "dir": name,
+            "doc_offset": int(lo),
+            "n_docs": int(hi - lo),
+            "arrays": arrays,
+        }
+
+        if counts is not None:
+            entry["bm25_arrays"], shard_max = write_postings_chunked(
+                shard_dir, "bm25_", counts, weigh_bm25, chunk_rows, lo, hi
+            )
+            np.maximum(bm25_term_max, shard_max, out=bm25_term_max)
+        elif weights is not None:
+            postings = weights[lo:hi].tocsc()
+            postings.sort_indices()
+            np.maximum(bm25_term_max, np.asarray(postings.max(axis=0).todense()).ravel(), out=bm25_term_max)
+            entry["bm25_arrays"] = _write_postings(
+                shard_dir, "bm25_", postings.indptr, postings.indices, postings.data
+            )
+        shards.append(entry)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "build_id": uuid.uuid4().hex,
+        "index_build_id": index_manifest["build_id"],
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "n_docs": int(matrix.shape[0]),
+        "n_features": int(matrix.shape[1]),
+        "n_shards": len(shards),
+        "term_max": write_array(shards_dir, "term_max", term_max),
+        "shards": shards,
+    }
+    if bm25_counts is not None:
+        manifest["bm25"] = {
+            "k1": k1,
+            "b": b,
+            "avgdl": avgdl,
+            "term_max": write_array(shards_dir, "bm25_term_max", bm25_term_max),
+        }
+
+    write_manifest(shards_dir, manifest)
+    return manifest
+
+
+# ----------------------------------------------
+# SHARD WORKERS
+# ----------------------------------------------
+
+# per process: (shards_dir, build_id, shard, kind) -> PostingsScorer
+_OPEN_SHARDS = {}
+
+
+class _CandidateCount:
+    """
+    Stands in for a QueryTimer inside a worker: only keeps candidates_scored.
+    """
+    __slots__ = ("scored",)
+
+    def __init__(self):
+        self.scored = 0
+
+    def mark(self, stage):
+        pass
+
+    def count(self, name, n=1):
+        if name == "candidates_scored":
+            self.scored += n
+
+
+def _shard_scorer(shards_dir, build_id, shard, kind):
+    key = (shards_dir, build_id, shard, kind)
+    scorer = _OPEN_SHARDS.get(key)
+    if scorer is not None:
+        return scorer
+
+    manifest = read_manifest(shards_dir)
+    if manifest is None or manifest["build_id"] != build_id:
+        raise StaleIndexError(f"{shards_dir} was rebuilt since the engine loaded it")
+
+    entry = manifest["shards"][shard]
+    shard_dir = os.path.join(shards_dir, entry["dir"])
+    if kind == "bm25":
+        arrays, term_max = entry["bm25_arrays"], manifest["bm25"]["term_max"]
+    else:
+        arrays, term_max = entry["arrays"], manifest["term_max"]
+
+    scorer = PostingsScorer(
+        open_array(shard_dir, arrays["postings_indptr"]),
+        open_array(shard_dir, arrays["postings_indices"]),
+        open_array(shard_dir, arrays["postings_data"]),
+        # global bounds: same term order (and float sums) as unsharded
+        open_array(shards_dir, term_max),
+        entry["n_docs"],
+        normalize_queries=kind != "bm25",
+    )
+    _OPEN_SHARDS[key] = scorer
+    return scorer
+
+
+def shard_top_k(shards_dir, build_id, shard, kind, query_vec, k, candidates=None):
+    """
+    Task: top-k of one shard, local doc ids.
+    RETURNS (doc_ids, scores, n_candidates_scored)
+    """
+    counter = _CandidateCount()
+    doc_ids, scores = _shard_scorer(shards_dir, build_id, shard, kind).top_k(
+        query_vec, k, candidates=candidates, timer=counter
+    )
+    return doc_ids, scores, counter.scored
+
+
+def shard_top_k_matches(shards_dir, build_id, shard, kind, query_vec, k, candidates, min_score, top_n):
+    """
+    Task: top_k_matches of one shard, local doc ids.
+    RETURNS ((doc_ids, scores), (matched doc_ids, their scores), n_candidates_scored)
+    """
+    counter = _CandidateCount()
+    top, matches = _shard_scorer(shards_dir, build_id, shard, kind).top_k_matches(
+        query_vec, k, candidates=candidates, min_score=min_score, top_n=top_n, timer=counter
+    )
+    return top, matches, counter.scored
+
+
+def shard_top_k_many(shards_dir, build_id, shard, kind, query_matrix, k, candidates, batch_size):
+    """
+    Task: top_k_many of one shard, local doc ids
+    """
+    return _shard_scorer(shards_dir, build_id, shard, kind).top_k_many(
+        query_matrix, k, candidates=candidates, batch_size=batch_size
+    )
+
+
+def merge_top_k(ranked, k):
+    """
+    Heap merge of per-shard (doc_ids, scores) lists, each best first,
+    global doc ids.
+    -----
+    RETURNS (doc_ids, scores) of the best k: score desc, doc id desc
+    """
+    # ascending (-score, -doc_id) is the engines' ranking order
+    merged = heapq.merge(*[zip((-scores).tolist(), (-doc_ids).tolist()) for doc_ids, scores in ranked])
+    top = list(itertools.islice(merged, k))
+    return (
+        np.array([-doc for _, doc in top], dtype=np.intp),
+        np.array([-score for score, _ in top], dtype=np.float64),
+    )
+
+
+# ----------------------------------------------
+# COORDINATOR
+# ----------------------------------------------
+
+class ShardedIndex:
+    """
+    Scores queries on every shard concurrently and merges the results.
+    -----
+    executor: "process" (a pool of worker processes, default), "thread"
+    (numpy / scipy release the GIL in their kernels) or "serial"; may be
+    changed at any time, the pool is (re)started on the next query.
+    """
+    def __init__(self, shards_dir, manifest, executor="process", workers=None):
+        if executor not in EXECUTORS:
+            raise ValueError(f"executor must be one of {EXECUTORS}, got {executor!r}")
+        self.shards_dir = os.path.abspath(shards_dir)
+        self.manifest = manifest
+        self.build_id = manifest["build_id"]
+        self.n_docs = manifest["n_docs"]
+        self.offsets = [s["doc_offset"] for s in manifest["shards"]]
+        self.sizes = [s["n_docs"] for s in manifest["shards"]]
+        self.kinds = ("tfidf", "bm25") if "bm25" in manifest else ("tfidf",)
+        self.executor = executor
+        self.workers = workers or min(self.n_shards, os.cpu_count() or 1)
+        self._pool = None
+        self._pool_executor = None
+
+    @property
+    def n_shards(self):
+        return len(self.offsets)
+
+    def scorer(self, kind="tfidf"):
+        """
+        RETURNS a ShardedScorer (PostingsScorer interface) for kind in self.kinds
+        """
+        if kind not in self.kinds:
+            raise ValueError(f"shards have no {kind} postings (built with {self.kinds})")
+        return ShardedScorer(self, kind)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _map(self, task, shard_args):
+        """
+        task(shards_dir, build_id, shard, *args) for every shard, in shard order
+        """
+        calls = [(self.shards_dir, self.build_id, shard, *args) for shard, args in enumerate(shard_args)]
+        if self.executor == "serial":
+            return [task(*call) for call in calls]
+
+        if self._pool is None or self._pool_executor != self.executor:
+            self.close()
+            pool_cls = ProcessPoolExecutor if self.executor == "process" else ThreadPoolExecutor
+            self._pool = pool_cls(max_workers=self.workers)
+            self._pool_executor = self.executor
+        futures = [self._pool.submit(task, *call) for call in calls]
+        return [f.result() for f in futures]
+
+    def _slice(self, candidates, shard):
+        if candidates is None:
+            return None
+        lo = self.offsets[shard]
+        return candidates[lo:lo + self.sizes[shard]]
+
+    def top_k(self, kind, query_vec, k, candidates=None, timer=None):
+        per_shard = self._map(shard_top_k, [
+            (kind, query_vec, k, self._slice(candidates, shard)) for shard in range(self.n_shards)
+        ])
+        if timer is not None:
+            timer.mark("score")
+            timer.count("candidates_scored", sum(n for _, _, n in per_shard))
+
+        result = merge_top_k(
+            [(doc_ids + offset, scores) for (doc_ids, scores, _), offset in zip(per_shard, self.offsets)], k
+        )
+        if timer is not None:
+            timer.mark("select")
+        return result
+
+    def top_k_matches(self, kind, query_vec, k, candidates=None, min_score=0.0, top_n=None, timer=None):
+        per_shard = self._map(shard_top_k_matches, [
+            (kind, query_vec, k, self._slice(candidates, shard), min_score, top_n)
+            for shard in range(self.n_shards)
+        ])
+        if timer is not None:
+            timer.mark("score")
+            timer.count("candidates_scored", sum(n for _, _, n in per_shard))
+
+        top = merge_top_k(
+            [(doc_ids + offset, scores) for ((doc_ids, scores), _, _), offset in zip(per_shard, self.offsets)], k
+        )
+        # each shard's best top_n includes its part of the global best top_n
+        matches = select_matches(
+            np.concatenate([ids + offset for (_, (ids, _), _), offset in zip(per_shard, self.offsets)]),
+            np.concatenate([scores for _, (_, scores), _ in per_shard]),
+            min_score, top_n,
+        )
+        if timer is not None:
+            timer.mark("select")
+        return top, matches
+
+    def top_k_many(self, kind, query_matrix, k, candidates=None, batch_size=256):
+        query_matrix = csr_matrix(query_matrix)
+        n_queries = query_matrix.shape[0]
+        if candidates is None or isinstance(candidates, np.ndarray):
+            candidates = [candidates] * n_queries
+
+        per_shard = self._map(shard_top_k_many, [
+            (kind, query_matrix, k, [self._slice(mask, shard) for mask in candidates], batch_size)
+            for shard in range(self.n_shards)
+        ])
+        return [
+            merge_top_k(
+                [(doc_ids + offset, scores) for (doc_ids, scores), offset in zip(ranked, self.offsets)], k
+            )
+            for ranked in zip(*per_shard)
+        ]
+
+
+class ShardedScorer:
+    """
+    One ranking of a ShardedIndex, usable wherever a PostingsScorer is
+    (top_k / top_k_matches / top_k_many with the same arguments and results).
+    """
+    def __init__(self, index, kind):
+        self.index = index
+        self.kind = kind
+        self.n_docs = index.n_docs
+
+    def top_k(self, query_vec, k, candidates=None, timer=None):
+        return self.index.top_k(self.kind, query_vec, k, candidates, timer)
+
+    def top_k_matches(self, query_vec, k, candidates=None, min_score=0.0, top_n=None, timer=None):
+        return self.index.top_k_matches(self.kind, query_vec, k, candidates, min_score, top_n, timer)
+
+    def top_k_many(self, query_matrix, k, candidates=None, batch_size=256):
+        return self.index.top_k_many(self.kind, query_matrix, k, candidates, batch_size)
+
+
+# ----------------------------------------------
+# LOAD
+# ----------------------------------------------
+
+def load_shards(index_manifest, shards_dir=SHARDS_DIR, executor="process", workers=None):
+    """
+    Used by the search engines.
+    -----
+    RETURNS ShardedIndex, or None if there are no shards or they were
+    built from another TF-IDF index
+    """
+    manifest = read_manifest(shards_dir)
+    if manifest is None or index_manifest is None:
+        return None
+    try:
+        if manifest.get("format_version") != FORMAT_VERSION:
+            raise StaleIndexError(f"format version {manifest.get('format_version')}, expected {FORMAT_VERSION}")
+        if manifest["index_build_id"] != index_manifest["build_id"]:
+            raise StaleIndexError("built from another TF-IDF index")
+        return ShardedIndex(shards_dir, manifest, executor, workers)
+    except StaleIndexError as e:
+        print(f"** Ignoring stale shards in {shards_dir}: {e}")
+        print("** Re-run idx_tfidf.py --shards N to rebuild.")
+        return None
@@ -0,0 +1,317 @@
+"""
+Query-aware snippets from precomputed token offsets.
+
+Instead of showing raw_text[:500] (which often ends before the part of a
+long passage that matched), a snippet is the window of SNIPPET_TOKENS
+tokens with the most query-term matches, with the matches highlighted.
+
+At index time every raw_text is tokenised once the way preprocess_text
+sees it (runs of ASCII letters / digits, lower-cased), and two things
+are stored:
+
+    token offsets      byte offsets (start, end) of every token in the
+                       UTF-8 raw_text, per document
+    term positions     for every vocabulary term, the (doc, token number)
+                       of each occurrence, sorted by doc
+
+A snippet then only looks up the query terms' positions in that document
+(a binary search per term), picks the densest window and decodes just
+the window's bytes from the document store, so its cost depends on the
+number of matches, not on the length of the passage. Only vocabulary
+unigrams are highlighted (stop words and pruned terms don't score).
+Documents without offsets (delta segments, no index) are tokenised on
+the fly instead.
+
+Layout of SNIPPETS_DIR:
+    manifest.json       build id, index_build_id, n_docs, n_features
+    token_*.bin         indptr (per doc) + starts / ends (byte offsets)
+    pos_*.bin           indptr (per term) + docs / tokens
+
+Usage:
+    hits = engine.search("pink tower", k=5, snippets=True)
+    hits[0]["snippet"]  ->  {"text": "...", "highlights": [[12, 16], ...], "cut_start": True, "cut_end": True}
+    highlight(hits[0]["snippet"])  ->  "... the **pink** **tower** is ..."
+"""
+
+import os
+import re
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from index_store import (
+    INDEX_DIR, ArrayAppender, StaleIndexError, create_array, finish_array, open_array, read_manifest,
+    term_destinations, write_array, write_manifest,
+)
+
+
+SNIPPETS_DIR = os.path.join(INDEX_DIR, "snippets")
+FORMAT_VERSION = 1
+
+# window length in tokens (~ 250-350 characters of English)
+SNIPPET_TOKENS = 50
+
+# preprocess_text keeps [a-z0-9] after lower-casing; on the UTF-8 bytes
+# that is ASCII letters and digits (multi-byte characters never match)
+TOKEN_PATTERN = re.compile(rb"[A-Za-z0-9]+")
+
+
+def token_spans(raw_bytes):
+    """
+    RETURNS (starts, ends, tokens): byte offsets and lower-cased tokens
+    """
+    starts, ends, tokens = [], [], []
+    for m in TOKEN_PATTERN.finditer(raw_bytes):
+        starts.append(m.start())
+        ends.append(m.end())
+        tokens.append(m.group().lower().decode("ascii"))
+    return np.array(starts, dtype=np.int32), np.array(ends, dtype=np.int32), tokens
+
+
+def _encode(text):
+    return text.encode("utf-8") if isinstance(text, str) else b""
+
+
+# ----------------------------------------------
+# WRITE
+# ----------------------------------------------
+
+def write_snippet_index(raw_texts, vectorizer, index_manifest, snippets_dir=SNIPPETS_DIR):
+    """
+    Token offsets + term positions of every document (see module docstring).
+    -----
+    :param raw_texts: raw_text of every document, in index order
+    :param vectorizer: the fitted vectorizer (its vocabulary ids are the term ids)
+    :param index_manifest: manifest of the TF-IDF index built alongside
+    """
+    return write_snippet_index_chunks([raw_texts], vectorizer, index_manifest, snippets_dir)
+
+
+def write_snippet_index_chunks(chunks, vectorizer, index_manifest, snippets_dir=SNIPPETS_DIR):
+    """
+    write_snippet_index over lists of raw_texts, in index order (e.g.
+    tfidf_build.iter_text_chunks for idx_tfidf.py --workers).
+
+    Pass 1 writes the token offsets chunk by chunk and spills each chunk's
+    (term, doc, position) triples to disk; pass 2 scatters them into the
+    term-grouped postings (index_store.term_destinations), so only one
+    chunk is in memory at a time.
+    """
+    os.makedirs(snippets_dir, exist_ok=True)
+    n_features = len(vectorizer.vocabulary_)
+
+    token_indptr = ArrayAppender(snippets_dir, "token_indptr", np.int64)
+    token_starts = ArrayAppender(snippets_dir, "token_starts", np.int32)
+    token_ends = ArrayAppender(snippets_dir, "token_ends", np.int32)
+    token_indptr.append([0])
+
+    # ------- pass 1: token offsets, spilled term positions -------
+    spills = []
+    term_counts = np.zeros(n_features, dtype=np.int64)
+    n_docs = n_tokens = 0
+    for raw_texts in chunks:
+        tokens = []
+        lengths = np.zeros(len(raw_texts), dtype=np.int64)
+        for i, text in enumerate(raw_texts):
+            s, e, t = token_spans(_encode(text))
+            token_starts.append(s)
+            token_ends.append(e)
+            tokens.extend(t)
+            lengths[i] = len(t)
+        chunk_indptr = np.concatenate([[0], np.cumsum(lengths)])
+        token_indptr.append(chunk_indptr[1:] + n_tokens)
+
+        term_ids = pd.Series(tokens, dtype=object).map(vectorizer.vocabulary_).fillna(-1).to_numpy(np.int64)
+        docs = np.repeat(np.arange(len(raw_texts), dtype=np.int64), lengths)
+        positions = np.arange(len(term_ids), dtype=np.int64) - chunk_indptr[docs]
+
+        known = np.flatnonzero(term_ids >= 0)
+        term_counts += np.bincount(term_ids[known], minlength=n_features)
+        spill = os.path.join(snippets_dir, f"spill_{len(spills)}.npy")
+        np.save(spill, np.stack([term_ids[known], docs[known] + n_docs, positions[known]]))
+        spills.append(spill)
+
+        n_docs += len(raw_texts)
+        n_tokens += len(term_ids)
+
+    # ------- pass 2: postings grouped by term, (doc, position) ascending within a term -------
+    pos_indptr = np.zeros(n_features + 1, dtype=np.int64)
+    np.cumsum(term_counts, out=pos_indptr[1:])
+    pos_docs = create_array(snippets_dir, "pos_docs", np.int32, int(pos_indptr[-1]))
+    pos_tokens = create_array(snippets_dir, "pos_tokens", np.int32, int(pos_indptr[-1]))
+    cursor = pos_indptr[:-1].copy()
+    for spill in spills:
+        terms, docs, positions = np.load(spill)
+        dest = term_destinations(terms, cursor)
+        pos_docs[dest] = docs
+        pos_tokens[dest] = positions
+        os.remove(spill)
+
+    arrays = {
+        "token_indptr": token_indptr.finish(),
+        "token_starts": token_starts.finish(),
+        "token_ends": token_ends.finish(),
+        "pos_indptr": write_array(snippets_dir, "pos_indptr", pos_indptr),
+        "pos_docs": finish_array(snippets_dir, "pos_docs", pos_docs),
+        "pos_tokens": finish_array(snippets_dir, "pos_tokens", pos_tokens),
+    }
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "build_id": uuid.uuid4().hex,
+        "index_build_id": index_manifest["build_id"],
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "n_docs": n_docs,
+        "n_features": n_features,
+        "n_tokens": n_tokens,
+        "arrays": arrays,
+    }
+    write_manifest(snippets_dir, manifest)
+    return manifest
+
+
+# ----------------------------------------------
+# SNIPPETS
+# ----------------------------------------------
+
+def densest_window(matches, n_tokens, window):
+    """
+    :param matches: sorted token numbers of the query-term matches
+    RETURNS (lo, hi) token range of at most window tokens holding the most
+    matches, centred on them (the start of the text if nothing matched)
+    """
+    if len(matches):
+        # matches in [p, p + window) for every match p
+        reach = np.searchsorted(matches, matches + window)
+        best = int(np.argmax(reach - np.arange(len(matches))))
+        first, last = int(matches[best]), int(matches[reach[best] - 1])
+        slack = window - (last - first + 1)
+        lo = max(0, min(first - slack // 2, n_tokens - window))
+    else:
+        lo = 0
+    return lo, min(n_tokens, lo + window)
+
+
+def _char_offsets(snippet_bytes, byte_offsets):
+    """
+    byte offsets into snippet_bytes -> character offsets into its decoded text
+    """
+    b = np.frombuffer(snippet_bytes, dtype=np.uint8)
+    # characters start at every byte that isn't a UTF-8 continuation byte
+    char_at = np.concatenate([[0], np.cumsum((b & 0xC0) != 0x80)])
+    return char_at[np.asarray(byte_offsets)]
+
+
+def highlight(snippet, before="**", after="**", ellipsis="..."):
+    """
+    The snippet as one string, highlights wrapped in before / after
+    """
+    text, parts, last = snippet["text"], [], 0
+    for start, end in snippet["highlights"]:
+        parts += [text[last:start], before, text[start:end], after]
+        last = end
+    parts.append(text[last:])
+    return (ellipsis if snippet["cut_start"] else "") + "".join(parts) + (ellipsis if snippet["cut_end"] else "")
+
+
+class SnippetIndex:
+    """
+    Snippets for the engines; precomputed offsets for the first n_docs
+    documents (none without an index), tokenising on the fly for the rest.
+    """
+    def __init__(self, vectorizer, snippets_dir=None, manifest=None, window=SNIPPET_TOKENS):
+        self.vocabulary = vectorizer.vocabulary_
+        self.window = window
+        self.n_docs = 0
+        if manifest is not None:
+            arrays = {name: np.asarray(open_array(snippets_dir, entry)) for name, entry in manifest["arrays"].items()}
+            self.token_indptr = arrays["token_indptr"]
+            self.token_starts = arrays["token_starts"]
+            self.token_ends = arrays["token_ends"]
+            self.pos_indptr = arrays["pos_indptr"]
+            self.pos_docs = arrays["pos_docs"]
+            self.pos_tokens = arrays["pos_tokens"]
+            self.n_docs = manifest["n_docs"]
+
+    def _indexed_tokens(self, doc, term_ids):
+        lo, hi = self.token_indptr[doc], self.token_indptr[doc + 1]
+        matches = []
+        for t in term_ids:
+            p_lo, p_hi = self.pos_indptr[t], self.pos_indptr[t + 1]
+            docs = self.pos_docs[p_lo:p_hi]
+            a, b = np.searchsorted(docs, doc), np.searchsorted(docs, doc, side="right")
+            matches.append(self.pos_tokens[p_lo + a:p_lo + b])
+        return self.token_starts[lo:hi], self.token_ends[lo:hi], np.unique(np.concatenate(matches + [[]]).astype(np.int64))
+
+    def _tokenized(self, raw_bytes, term_ids):
+        starts, ends, tokens = token_spans(raw_bytes)
+        wanted = set(int(t) for t in term_ids)
+        matches = [i for i, tok in enumerate(tokens) if self.vocabulary.get(tok, -1) in wanted]
+        return starts, ends, np.array(matches, dtype=np.int64)
+
+    def snippet(self, store, doc, term_ids):
+        """
+        :param store: the engine's column store (raw_text is read from it)
+        :param term_ids: vocabulary ids of the query terms (e.g. query_vec.indices)
+        RETURNS {"text", "highlights" (character [start, end] in text), "cut_start", "cut_end"}
+        """
+        term_ids = [t for t in np.asarray(term_ids).tolist() if t < len(self.vocabulary)]
+        if doc < self.n_docs:
+            starts, ends, matches = self._indexed_tokens(doc, term_ids)
+            doc_len = None
+        else:
+            raw = store.raw_bytes("raw_text", doc)
+            starts, ends, matches = self._tokenized(raw, term_ids)
+            doc_len = len(raw)
+
+        n = len(starts)
+        if n == 0:
+            text = store.get("raw_text", doc)
+            return {"text": text if isinstance(text, str) else "", "highlights": [], "cut_start": False, "cut_end": False}
+
+        lo, hi = densest_window(matches, n, self.window)
+        byte_lo = 0 if lo == 0 else int(starts[lo])
+        byte_hi = doc_len if hi == n else int(ends[hi - 1])
+        snippet_bytes = store.raw_bytes("raw_text", doc, byte_lo, byte_hi)
+
+        shown = matches[(matches >= lo) & (matches < hi)]
+        spans = np.stack([starts[shown] - byte_lo, ends[shown] - byte_lo], axis=1)
+        text = snippet_bytes.decode("utf-8")
+        if len(text) != len(snippet_bytes):
+            spans = _char_offsets(snippet_bytes, spans)
+        return {
+            "text": text,
+            "highlights": spans.tolist(),
+            "cut_start": lo > 0,
+            "cut_end": hi < n,
+        }
+
+    def attach(self, hits, term_ids):
+        """
+        Set the snippet of every hit (hit["snippet"])
+        """
+        for hit in hits:
+            hit.snippet = self.snippet(hit._store, hit.index, term_ids)
+
+
+def load_snippet_index(index_manifest, vectorizer, snippets_dir=SNIPPETS_DIR):
+    """
+    Used by the search engines.
+    -----
+    RETURNS SnippetIndex; without precomputed offsets (tokenising every
+    hit) if there are none or they belong to another TF-IDF index
+    """
+    manifest = read_manifest(snippets_dir)
+    if manifest is None or index_manifest is None:
+        return SnippetIndex(vectorizer)
+    try:
+        if manifest.get("format_version") != FORMAT_VERSION:
+            raise StaleIndexError(f"format version {manifest.get('format_version')}, expected {FORMAT_VERSION}")
+        if manifest["index_build_id"] != index_manifest["build_id"]:
+            raise StaleIndexError("built from another TF-IDF index")
+        return SnippetIndex(vectorizer, snippets_dir, manifest)
+    except StaleIndexError as e:
+        print(f"** Ignoring stale snippet offsets in {snippets_dir}: {e}")
+        print("** Re-run idx_tfidf.py to rebuild; snippets are computed on the fly until then.")
+        return SnippetIndex(vectorizer)
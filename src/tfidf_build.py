@@ -0,0 +1,299 @@
+"""
+Out-of-core, parallel TF-IDF build (idx_tfidf.py --workers N).
+
+TfidfVectorizer.fit_transform holds every preprocessed document plus the
+full unigram + bigram vocabulary before min_df pruning in one process.
+This builds the same vectorizer and matrix in two passes over the corpus
+csv, read CHUNK_SIZE rows at a time and handed to a process pool (at
+most 2 x workers chunks in flight):
+
+    pass 1   each worker preprocesses its chunk, runs the vectorizer's
+             analyzer and counts in how many of the chunk's documents
+             each term occurs; the counts are split into N_PARTITIONS
+             hash partitions (crc32 of the term) written to scratch files.
+             Each partition is then merged over all chunks on its own
+             (Counter addition) and pruned with min_df / max_df, so only
+             one partition of the unpruned vocabulary is in memory at a
+             time.
+    pass 2   the surviving terms, sorted, are the vocabulary (same ids as
+             sklearn); idf comes from the merged counts. Workers
+             vectorize the chunks again into CSR segments on disk, which
+             are concatenated into memory-mapped data / indices / indptr
+             files.
+
+Memory then depends on the chunk size, the number of workers and the
+pruned vocabulary, not on the number of documents; idx_tfidf.py writes
+the rest of the index from the memory-mapped result and chunked reads
+of the csv in the same way (index_store.write_postings_chunked,
+doc_store.write_doc_store_chunks, snippets.write_snippet_index_chunks). The result equals
+TfidfVectorizer(**params).fit_transform(): same vocabulary and idf
+(bit for bit), same matrix up to the order of float additions in the
+row norms (~1e-16).
+
+Usage:
+    vectorizer, matrix, counts = build_tfidf_chunked(
+        "data/full_corpus.csv", TFIDF_PARAMS, preprocess_text, scratch_dir, workers=4)
+"""
+
+import os
+import pickle
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from numbers import Integral
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
+
+CHUNK_SIZE = 20_000     # documents per chunk
+N_PARTITIONS = 16       # hash partitions of the pass-1 term counts
+
+# set in each worker by _init_worker
+_VECTORIZER = None
+_PREPROCESS = None
+
+
+def _init_worker(vectorizer, preprocess):
+    global _VECTORIZER, _PREPROCESS
+    _VECTORIZER = vectorizer
+    _PREPROCESS = preprocess
+
+
+def iter_text_chunks(corpus_file, chunk_size=CHUNK_SIZE, column="text"):
+    """
+    (chunk number, list of texts) for every chunk of the corpus csv
+    """
+    for i, chunk in enumerate(pd.read_csv(corpus_file, usecols=[column], chunksize=chunk_size)):
+        yield i, chunk[column].tolist()
+
+
+def map_chunks(fn, tasks, workers, initargs):
+    """
+    fn over tasks in a process pool, results in task order; at most
+    2 x workers tasks in flight. workers=1 runs in this process.
+    """
+    if workers == 1:
+        _init_worker(*initargs)
+        for task in tasks:
+            yield fn(task)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(fn, task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# ----------------------------------------------
+# PASS 1: DOCUMENT FREQUENCIES
+# ----------------------------------------------
+
+def _partition_file(scratch_dir, chunk_id, partition):
+    return os.path.join(scratch_dir, f"df_{chunk_id:05d}_{partition:03d}.pkl")
+
+
+def count_chunk(task):
+    """
+    Worker: document frequencies of one chunk, written per partition.
+    -----
+    RETURNS (chunk_id, number of documents)
+    """
+    chunk_id, texts, scratch_dir, n_partitions = task
+    analyze = _VECTORIZER.build_analyzer()
+    df = Counter()
+    for text in texts:
+        df.update(set(analyze(_PREPROCESS(text))))
+
+    parts = [{} for _ in range(n_partitions)]
+    for term, n in df.items():
+        parts[zlib.crc32(term.encode("utf-8")) % n_partitions][term] = n
+
+    for p, counts in enumerate(parts):
+        with open(_partition_file(scratch_dir, chunk_id, p), "wb") as f:
+            pickle.dump(counts, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return chunk_id, len(texts)
+
+
+def merge_partition(task):
+    """
+    Worker: one partition's document frequencies over all chunks,
+    pruned to min_count <= df <= max_count (scratch files are removed).
+    -----
+    RETURNS (terms, dfs) that survive
+    """
+    partition, n_chunks, scratch_dir, min_count, max_count = task
+    df = Counter()
+    for chunk_id in range(n_chunks):
+        path = _partition_file(scratch_dir, chunk_id, partition)
+        with open(path, "rb") as f:
+            df.update(pickle.load(f))
+        os.remove(path)
+
+    kept = [(term, n) for term, n in df.items() if min_count <= n <= max_count]
+    return [t for t, _ in kept], [n for _, n in kept]
+
+
+def doc_count_bounds(vectorizer, n_docs):
+    """
+    (min_doc_count, max_doc_count) from min_df / max_df, as in CountVectorizer.fit
+    """
+    max_df, min_df = vectorizer.max_df, vectorizer.min_df
+    max_doc_count = max_df if isinstance(max_df, Integral) else max_df * n_docs
+    min_doc_count = min_df if isinstance(min_df, Integral) else min_df * n_docs
+    if max_doc_count < min_doc_count:
+        raise ValueError("max_df corresponds to < documents than min_df")
+    return min_doc_count, max_doc_count
+
+
+def smooth_idf(dfs, n_docs, vectorizer):
+    """
+    idf from document frequencies, computed as TfidfTransformer.fit does
+    """
+    df = np.asarray(dfs, dtype=np.float64)
+    df += float(vectorizer.smooth_idf)
+    n_samples = n_docs + int(vectorizer.smooth_idf)
+    idf = np.full_like(df, fill_value=n_samples, dtype=np.float64)
+    idf /= df
+    np.log(idf, out=idf)
+    idf += 1.0
+    return idf
+
+
+# ----------------------------------------------
+# PASS 2: VECTORIZE
+# ----------------------------------------------
+
+def _segment_file(scratch_dir, kind, chunk_id, part):
+    return os.path.join(scratch_dir, f"{kind}_{chunk_id:05d}_{part}.npy")
+
+
+def vectorize_chunk(task):
+    """
+    Worker: TF-IDF rows (and raw counts if with_counts) of one chunk,
+    saved as CSR segments.
+    -----
+    RETURNS (chunk_id, number of rows, nnz)
+    """
+    chunk_id, texts, scratch_dir, with_counts = task
+    processed = [_PREPROCESS(t) for t in texts]
+    kinds = {"tfidf": _VECTORIZER.transform(processed)}
+    if with_counts:
+        kinds["counts"] = CountVectorizer.transform(_VECTORIZER, processed)
+
+    nnz = {}
+    for kind, matrix in kinds.items():
+        matrix = sparse.csr_matrix(matrix)
+        for part in ("data", "indices", "indptr"):
+            np.save(_segment_file(scratch_dir, kind, chunk_id, part), getattr(matrix, part))
+        nnz[kind] = matrix.nnz
+    return chunk_id, len(texts), nnz
+
+
+def concat_segments(scratch_dir, kind, segments, n_features, dtype):
+    """
+    Concatenate the chunks' CSR segments into memory-mapped arrays
+    (segment files are removed as they are copied).
+    -----
+    RETURNS csr_matrix over the memory-mapped data / indices / indptr
+    """
+    n_rows = sum(rows for _, rows, _ in segments)
+    nnz = sum(seg_nnz[kind] for _, _, seg_nnz in segments)
+    index_dtype = np.int32 if max(nnz, n_features) <= np.iinfo(np.int32).max else np.int64
+
+    def out(name, shape, out_dtype):
+        return np.lib.format.open_memmap(
+            os.path.join(scratch_dir, f"{kind}_{name}.npy"), mode="w+", dtype=out_dtype, shape=(shape,)
+        )
+
+    data = out("data", nnz, dtype)
+    indices = out("indices", nnz, index_dtype)
+    indptr = out("indptr", n_rows + 1, index_dtype)
+    indptr[0] = 0
+
+    row, pos = 0, 0
+    for chunk_id, rows, seg_nnz in segments:
+        n = seg_nnz[kind]
+        for part, target in (("data", data), ("indices", indices)):
+            path = _segment_file(scratch_dir, kind, chunk_id, part)
+            target[pos:pos + n] = np.load(path)
+            os.remove(path)
+        path = _segment_file(scratch_dir, kind, chunk_id, "indptr")
+        indptr[row + 1:row + rows + 1] = np.load(path)[1:] + pos
+        os.remove(path)
+        row += rows
+        pos += n
+
+    for arr in (data, indices, indptr):
+        arr.flush()
+    return sparse.csr_matrix((data, indices, indptr), shape=(n_rows, n_features), copy=False)
+
+
+# ----------------------------------------------
+# BUILD
+# ----------------------------------------------
+
+def build_tfidf_chunked(corpus_file, params, preprocess, scratch_dir, workers=None, chunk_size=CHUNK_SIZE,
+                        n_partitions=N_PARTITIONS, with_counts=False):
+    """
+    Two-pass parallel equivalent of TfidfVectorizer(**params).fit_transform
+    over preprocess(text) of the corpus csv (see module docstring).
+    -----
+    :param params: TfidfVectorizer keyword arguments (max_features and
+        a fixed vocabulary are not supported)
+    :param preprocess: text -> preprocessed text, applied in the workers
+        (must be picklable, e.g. idx_tfidf.preprocess_text)
+    :param scratch_dir: existing directory for the pass-1 counts and the
+        output arrays; the returned matrices are memory-mapped from it,
+        so keep it until they are no longer needed
+    :param workers: pool size (default: all cores); 1 = no pool
+    :param with_counts: also return the raw term counts (for BM25)
+    -----
+    RETURNS (fitted vectorizer, tfidf csr_matrix, counts csr_matrix or None)
+    """
+    vectorizer = TfidfVectorizer(**params)
+    if vectorizer.max_features is not None or vectorizer.vocabulary is not None:
+        raise ValueError("the chunked build does not support max_features or a fixed vocabulary")
+    workers = workers or os.cpu_count() or 1
+
+    # pass 1: per-chunk document frequencies, then merged per partition
+    tasks = (
+        (chunk_id, texts, scratch_dir, n_partitions)
+        for chunk_id, texts in iter_text_chunks(corpus_file, chunk_size)
+    )
+    chunk_docs = list(map_chunks(count_chunk, tasks, workers, (vectorizer, preprocess)))
+    n_chunks, n_docs = len(chunk_docs), sum(n for _, n in chunk_docs)
+
+    min_count, max_count = doc_count_bounds(vectorizer, n_docs)
+    tasks = ((p, n_chunks, scratch_dir, min_count, max_count) for p in range(n_partitions))
+    terms, dfs = [], []
+    for part_terms, part_dfs in map_chunks(merge_partition, tasks, workers, (None, None)):
+        terms.extend(part_terms)
+        dfs.extend(part_dfs)
+    if not terms:
+        raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+
+    # vocabulary ids in term order, like CountVectorizer._sort_features
+    order = sorted(range(len(terms)), key=terms.__getitem__)
+    vectorizer.vocabulary_ = {terms[i]: new_id for new_id, i in enumerate(order)}
+    vectorizer.fixed_vocabulary_ = False
+    vectorizer.idf_ = smooth_idf(np.asarray(dfs)[order], n_docs, vectorizer)
+    del terms, dfs, order
+
+    # pass 2: CSR segments per chunk, concatenated on disk
+    tasks = (
+        (chunk_id, texts, scratch_dir, with_counts)
+        for chunk_id, texts in iter_text_chunks(corpus_file, chunk_size)
+    )
+    segments = list(map_chunks(vectorize_chunk, tasks, workers, (vectorizer, preprocess)))
+
+    n_features = len(vectorizer.vocabulary_)
+    tfidf = concat_segments(scratch_dir, "tfidf", segments, n_features, vectorizer.dtype)
+    counts = concat_segments(scratch_dir, "counts", segments, n_features, vectorizer.dtype) if with_counts else None
+    return vectorizer, tfidf, counts
@@ -0,0 +1,397 @@
+"""
+Top-k scoring for the search engines.
+
+Rather than scoring every document with cosine_similarity and argsorting
+the whole score vector, queries are scored term-at-a-time over a
+column-oriented (postings) copy of the TF-IDF matrix, so only documents
+sharing a term with the query are touched. Selection uses argpartition.
+
+Ranking matches the previous `np.argsort(scores)[::-1][:k]`: score
+descending, ties broken by the higher document index first, and
+zero-score documents fill up the list when fewer than k documents match.
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+
+from index_store import normalized_postings, open_array
+
+
+# float slack for the MaxScore bounds, so summation order can never
+# prune a document that would make the top-k
+PRUNE_EPS = 1e-12
+
+# batched search densifies (queries x docs) score blocks; cap their size
+MAX_BLOCK_CELLS = 1 << 24
+
+# "tfidf": cosine over the normalised TF-IDF postings
+# "bm25": precomputed BM25 weights (idx_tfidf.py --bm25), raw query counts
+# "dense": LSA embeddings + IVF index (idx_tfidf.py --dense, see dense.py)
+RANKINGS = ("tfidf", "bm25", "dense")
+
+
+# ----------------------------------------------
+# SELECTION
+# ----------------------------------------------
+
+def top_k_indices(scores, k):
+    """
+    Positions of the k largest scores, best first.
+    -----
+    :param scores: 1-d array of scores
+    :param k: number of results
+    -----
+    Uses argpartition (O(n)) instead of a full sort; only the k selected
+    entries are sorted. Ties go to the higher position.
+    """
+    n = len(scores)
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    if k < n:
+        part = np.argpartition(scores, n - k)[n - k:]
+        kth = scores[part].min()
+
+        # argpartition picks arbitrarily among scores equal to the kth;
+        # keep the highest positions so results don't depend on it
+        above = np.flatnonzero(scores > kth)
+        tied = np.flatnonzero(scores == kth)[::-1][:k - len(above)]
+        selected = np.concatenate([above, tied])
+    else:
+        selected = np.arange(n)
+
+    # primary key: score desc, secondary: position desc
+    order = np.lexsort((-selected, -scores[selected]))
+    return selected[order]
+
+
+def top_k_rows(scores, k):
+    """
+    Row-wise top_k_indices for a dense (n_queries x n_docs) score block,
+    vectorised over all rows. Same tie-breaking as top_k_indices.
+    -----
+    RETURNS (cols, vals), each (n_queries x k), best first
+    """
+    m, n = scores.shape
+    k = min(k, n)
+    if k <= 0:
+        return np.empty((m, 0), dtype=np.intp), np.empty((m, 0))
+
+    if k < n:
+        kth = np.partition(scores, n - k, axis=1)[:, n - k][:, None]
+        above = scores > kth
+        tied = scores == kth
+        need = k - above.sum(axis=1)
+
+        # rank of every tied entry counted from the right, so the highest
+        # positions win ties
+        rank_from_right = np.cumsum(tied[:, ::-1], axis=1)[:, ::-1]
+        selected = above | (tied & (rank_from_right <= need[:, None]))
+        cols = np.nonzero(selected)[1].reshape(m, k)
+    else:
+        cols = np.tile(np.arange(n), (m, 1))
+
+    vals = np.take_along_axis(scores, cols, axis=1)
+    order = np.lexsort((-cols, -vals), axis=-1)
+    return np.take_along_axis(cols, order, axis=1), np.take_along_axis(vals, order, axis=1)
+
+
+def fill_with_zero_scores(doc_ids, scores, k, n_docs, candidates=None, block=1024):
+    """
+    Pad a result list with unmatched (zero-score) documents, highest doc
+    index first, the same order a full argsort would have produced.
+    """
+    need = k - len(doc_ids)
+    if need <= 0:
+        return doc_ids, scores
+
+    extra = []
+    hi = n_docs
+    while need > 0 and hi > 0:
+        lo = max(0, hi - block)
+        ids = np.arange(hi - 1, lo - 1, -1)
+        keep = ~np.isin(ids, doc_ids)
+        if candidates is not None:
+            keep &= candidates[ids]
+        ids = ids[keep][:need]
+        extra.append(ids)
+        need -= len(ids)
+        hi = lo
+
+    if not extra:
+        return doc_ids, scores
+    extra = np.concatenate(extra)
+    return (
+        np.concatenate([doc_ids, extra]),
+        np.concatenate([scores, np.zeros(len(extra))]),
+    )
+
+
+def select_matches(doc_ids, scores, min_score=0.0, top_n=None):
+    """
+    The scored documents facet counts are taken over: score > min_score,
+    only the best top_n of those if given.
+    -----
+    RETURNS (doc_ids, scores), doc_ids ascending
+    """
+    keep = scores > min_score
+    doc_ids, scores = doc_ids[keep], scores[keep]
+    if top_n is not None and len(doc_ids) > top_n:
+        top = np.sort(top_k_indices(scores, top_n))
+        doc_ids, scores = doc_ids[top], scores[top]
+    order = np.argsort(doc_ids, kind="stable")
+    return doc_ids[order], scores[order]
+
+
+# ----------------------------------------------
+# POSTINGS SCORER
+# ----------------------------------------------
+
+class PostingsScorer:
+    """
+    Term-at-a-time cosine scorer over per-term postings lists.
+
+    Supports an exhaustive mode (every document sharing a query term is
+    scored) and a MaxScore-style mode that stops creating new
+    accumulators once the remaining terms' upper bounds (query weight x
+    per-term max weight) can't reach the current k-th score.
+    Both return exactly the same ranking.
+
+    With normalize_queries=False query weights are used as given, which
+    is what BM25 postings need (score = sum of w(t, d) * query count).
+    """
+    def __init__(self, indptr, indices, data, term_max, n_docs, normalize_queries=True):
+        # plain ndarray views (still backed by the memmap, no copy) skip
+        # np.memmap's per-slice overhead
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.data = np.asarray(data)
+        self.term_max = np.asarray(term_max)
+        self.n_docs = n_docs
+        self.normalize_queries = normalize_queries
+
+    @classmethod
+    def from_matrix(cls, tfidf_matrix, row_norms):
+        indptr, indices, data, term_max = normalized_postings(tfidf_matrix, row_norms)
+        return cls(indptr, indices, data, term_max, tfidf_matrix.shape[0])
+
+    @classmethod
+    def from_index(cls, index_dir, manifest):
+        """
+        Open the postings written by index_store.write_index (memory-mapped).
+        """
+        arrays = manifest["arrays"]
+        return cls(
+            open_array(index_dir, arrays["postings_indptr"]),
+            open_array(index_dir, arrays["postings_indices"]),
+            open_array(index_dir, arrays["postings_data"]),
+            open_array(index_dir, arrays["term_max"]),
+            manifest["n_docs"],
+        )
+
+    @classmethod
+    def from_bm25_index(cls, index_dir, manifest):
+        """
+        Open the BM25 postings (manifest["bm25"]), see index_store.bm25_postings.
+        """
+        arrays = manifest["bm25"]["arrays"]
+        return cls(
+            open_array(index_dir, arrays["postings_indptr"]),
+            open_array(index_dir, arrays["postings_indices"]),
+            open_array(index_dir, arrays["postings_data"]),
+            open_array(index_dir, arrays["term_max"]),
+            manifest["n_docs"],
+            normalize_queries=False,
+        )
+
+    def _query_terms(self, query_vec):
+        """
+        Query terms + (unit-normalised) weights, by decreasing upper bound.
+        """
+        query_vec = csr_matrix(query_vec)
+        terms = query_vec.indices
+        weights = query_vec.data.astype(np.float64)
+
+        norm = np.sqrt(np.dot(weights, weights))
+        if norm == 0:
+            return terms[:0], weights[:0], weights[:0]
+        if self.normalize_queries:
+            weights = weights / norm
+
+        bounds = weights * self.term_max[terms]
+        order = np.lexsort((terms, -bounds))
+        return terms[order], weights[order], bounds[order]
+
+    def _postings(self, term, candidates=None):
+        start, end = self.indptr[term], self.indptr[term + 1]
+        docs = self.indices[start:end]
+        vals = self.data[start:end]
+        if candidates is not None:
+            keep = candidates[docs]
+            docs, vals = docs[keep], vals[keep]
+        return docs, vals
+
+    def score(self, query_vec, candidates=None):
+        """
+        Exhaustive term-at-a-time scoring.
+        -----
+        :param query_vec: (1 x n_features) sparse query vector
+        :param candidates: optional boolean mask over documents
+        -----
+        RETURNS (doc_ids, scores) for every document with a non-zero score,
+        doc_ids ascending
+        """
+        terms, weights, _ = self._query_terms(query_vec)
+        docs, contribs = [], []
+        for term, w in zip(terms, weights):
+            d, v = self._postings(term, candidates)
+            docs.append(d)
+            contribs.append(v * w)
+
+        if not docs:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+
+        docs = np.concatenate(docs)
+        contribs = np.concatenate(contribs)
+        doc_ids, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=contribs, minlength=len(doc_ids))
+        return doc_ids, scores
+
+    def _score_maxscore(self, query_vec, k, candidates=None):
+        terms, weights, bounds = self._query_terms(query_vec)
+        # remaining[i] = best possible contribution of terms i+1..end
+        remaining = np.concatenate([np.cumsum(bounds[::-1])[::-1][1:], [0.0]])
+
+        doc_ids = np.empty(0, dtype=np.intp)
+        scores = np.empty(0)
+        pruned = False
+
+        for i, (term, w) in enumerate(zip(terms, weights)):
+            d, v = self._postings(term, candidates)
+
+            if not pruned:
+                # still adding new documents to the accumulator
+                merged = np.concatenate([doc_ids, d])
+                contribs = np.concatenate([scores, v * w])
+                doc_ids, inverse = np.unique(merged, return_inverse=True)
+                scores = np.bincount(inverse, weights=contribs, minlength=len(doc_ids))
+            else:
+                # only update documents still in the running
+                pos = np.searchsorted(d, doc_ids)
+                pos_ok = pos < len(d)
+                hit = np.zeros(len(doc_ids), dtype=bool)
+                hit[pos_ok] = d[pos[pos_ok]] == doc_ids[pos_ok]
+                scores[hit] += v[pos[hit]] * w
+
+            if len(doc_ids) < k or scores.max() <= remaining[i]:
+                continue
+
+            theta = np.partition(scores, len(scores) - k)[len(scores) - k]
+            if remaining[i] < theta - PRUNE_EPS:
+                # unseen documents can't reach theta any more; drop the
+                # ones that can't either
+                pruned = True
+                keep = scores + remaining[i] >= theta - PRUNE_EPS
+                doc_ids, scores = doc_ids[keep], scores[keep]
+
+        return doc_ids, scores
+
+    def top_k(self, query_vec, k, candidates=None, early_termination=True, timer=None):
+        """
+        Top-k documents for a query.
+        -----
+        :param query_vec: (1 x n_features) sparse query vector
+        :param k: number of results
+        :param candidates: optional boolean mask, only these docs are ranked
+        :param early_termination: MaxScore pruning (same results, less work)
+        :param timer: optional instrumentation.QueryTimer ("score" / "select"
+            stages, candidates_scored counter)
+        -----
+        RETURNS (doc_ids, scores), best first
+        """
+        if early_termination:
+            doc_ids, scores = self._score_maxscore(query_vec, k, candidates)
+        else:
+            doc_ids, scores = self.score(query_vec, candidates)
+        return self._select(doc_ids, scores, k, candidates, timer)
+
+    def top_k_matches(self, query_vec, k, candidates=None, min_score=0.0, top_n=None, timer=None):
+        """
+        top_k plus the documents facet counts are taken over
+        (select_matches), from the same scoring pass: with top_n, MaxScore
+        keeps the best max(k, top_n) exact, otherwise every match is scored.
+        -----
+        RETURNS ((doc_ids, scores) as from top_k, (matched doc_ids, their scores))
+        """
+        if top_n is not None:
+            doc_ids, scores = self._score_maxscore(query_vec, max(k, top_n), candidates)
+        else:
+            doc_ids, scores = self.score(query_vec, candidates)
+        matches = select_matches(doc_ids, scores, min_score, top_n)
+        return self._select(doc_ids, scores, k, candidates, timer), matches
+
+    def _select(self, doc_ids, scores, k, candidates, timer):
+        if timer is not None:
+            timer.mark("score")
+            timer.count("candidates_scored", len(doc_ids))
+
+        top = top_k_indices(scores, k)
+        result = fill_with_zero_scores(doc_ids[top], scores[top], k, self.n_docs, candidates)
+        if timer is not None:
+            timer.mark("select")
+        return result
+
+    def top_k_many(self, query_matrix, k, candidates=None, batch_size=256):
+        """
+        Top-k documents for many queries at once.
+        -----
+        :param query_matrix: (n_queries x n_features) sparse query vectors
+        :param k: number of results per query
+        :param candidates: None, one boolean mask for all queries, or a list
+            with a mask (or None) per query
+        :param batch_size: max queries scored together; further capped so
+            a dense score block stays under MAX_BLOCK_CELLS
+        -----
+        Scores each batch with one sparse (queries x terms) x (terms x docs)
+        product, then selects row-wise with top_k_rows.
+        RETURNS list of (doc_ids, scores) per query, best first
+        """
+        query_matrix = csr_matrix(query_matrix, dtype=np.float64)
+        n_queries = query_matrix.shape[0]
+
+        if candidates is None or isinstance(candidates, np.ndarray):
+            candidates = [candidates] * n_queries
+
+        # unit-normalise the queries; docs are normalised in the postings
+        if self.normalize_queries:
+            q_norms = np.sqrt(np.asarray(query_matrix.multiply(query_matrix).sum(axis=1)).ravel())
+            inv = np.zeros(n_queries)
+            np.divide(1.0, q_norms, out=inv, where=q_norms > 0)
+            query_matrix = diags(inv) @ query_matrix
+
+        # the CSC postings read as CSR are the (terms x docs) matrix, no copy
+        term_doc = csr_matrix(
+            (self.data, self.indices, self.indptr),
+            shape=(len(self.indptr) - 1, self.n_docs),
+            copy=False,
+        )
+
+        batch_size = max(1, min(batch_size, MAX_BLOCK_CELLS // max(self.n_docs, 1)))
+        results = []
+        for start in range(0, n_queries, batch_size):
+            stop = min(start + batch_size, n_queries)
+            block = (query_matrix[start:stop] @ term_doc).toarray()
+
+            masks = candidates[start:stop]
+            if any(mask is not None for mask in masks):
+                for row, mask in enumerate(masks):
+                    if mask is not None:
+                        block[row, ~mask] = -np.inf
+
+            cols, vals = top_k_rows(block, k)
+            for row_cols, row_vals in zip(cols, vals):
+                keep = row_vals > -np.inf
+                results.append((row_cols[keep], row_vals[keep]))
+
+        return results
@@ -0,0 +1,47 @@
+"""
+MMR with the per-source quota (diversify.py).
+
+Usage (from the repo root):
+    python -m pytest tests
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import numpy as np
+from scipy import sparse
+
+from diversify import Diversifier
+
+# docs 0-3: near-identical paragraphs of chapter 0; 4, 5: other chapters
+MATRIX = sparse.csr_matrix(np.array([
+    [1.0, 0.1, 0.0],
+    [1.0, 0.2, 0.0],
+    [1.0, 0.3, 0.0],
+    [1.0, 0.4, 0.0],
+    [0.5, 0.0, 1.0],
+    [0.0, 1.0, 0.5],
+]))
+STORE = SimpleNamespace(factorize=lambda field: (np.array([0, 0, 0, 0, 1, 2]), None))
+SCORES = np.array([1.0, 0.99, 0.98, 0.97, 0.5, 0.4])
+
+
+def test_mmr_keeps_the_source_quota():
+    diversifier = Diversifier(MATRIX, STORE, per_source=2)
+    ids, _ = diversifier.rerank("mmr", np.arange(6), SCORES, 4)
+    assert sorted(ids) == [0, 1, 4, 5]
+
+
+def test_plain_mmr_stays_in_one_chapter():
+    # the similarity penalty alone doesn't outweigh the relevance gap
+    diversifier = Diversifier(MATRIX, STORE, mmr_quota=False)
+    ids, _ = diversifier.rerank("mmr", np.arange(6), SCORES, 4)
+    assert sorted(ids) == [0, 1, 2, 3]
+
+
+def test_mmr_fills_up_when_the_quota_runs_out():
+    diversifier = Diversifier(MATRIX, STORE, per_source=1)
+    ids, _ = diversifier.rerank("mmr", np.arange(6), SCORES, 5)
+    assert len(ids) == 5 and sorted(ids[:3]) == [0, 4, 5]
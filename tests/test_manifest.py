@@ -0,0 +1,50 @@
+"""
+Freshness checks of the index manifest (index_store.check_manifest).
+
+Usage (from the repo root):
+    python -m pytest tests
+"""
+
+import os
+import pickle
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+import index_store
+from index_store import StaleIndexError, check_manifest, write_index
+
+
+@pytest.fixture
+def built(tmp_path):
+    corpus_file = str(tmp_path / "corpus.csv")
+    with open(corpus_file, "w") as f:
+        f.write("doc_id,text\ndoc_0,the pink tower\ndoc_1,the brown stair\n")
+
+    vectorizer = TfidfVectorizer()
+    matrix = vectorizer.fit_transform(["the pink tower", "the brown stair"])
+    vectorizer_file = str(tmp_path / "vectorizer.pkl")
+    with open(vectorizer_file, "wb") as f:
+        pickle.dump(vectorizer, f)
+
+    manifest = write_index(matrix, corpus_file, vectorizer_file, str(tmp_path / "index"))
+    return manifest, corpus_file, vectorizer_file
+
+
+def test_unchanged_files_are_not_hashed(built, monkeypatch):
+    manifest, corpus_file, vectorizer_file = built
+    monkeypatch.setattr(index_store, "file_checksum", pytest.fail)
+    check_manifest(manifest, corpus_file, vectorizer_file, n_docs=2)
+
+
+def test_touched_file_is_fresh_changed_file_is_stale(built):
+    manifest, corpus_file, vectorizer_file = built
+    os.utime(corpus_file, (1, 1))
+    check_manifest(manifest, corpus_file, vectorizer_file, n_docs=2)
+
+    with open(corpus_file, "a") as f:
+        f.write("doc_2,the red rods\n")
+    with pytest.raises(StaleIndexError):
+        check_manifest(manifest, corpus_file, vectorizer_file, n_docs=2)
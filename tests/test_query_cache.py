@@ -0,0 +1,38 @@
+"""
+Index versions of the query cache (query_cache.py).
+
+Usage (from the repo root):
+    python -m pytest tests
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from query_cache import QueryCache, index_version
+
+
+def test_no_manifest_and_no_pickle_disables_caching(tmp_path, monkeypatch):
+    # e.g. an index built with --workers (no tfidf_matrix.pkl) that is stale
+    monkeypatch.chdir(tmp_path)
+    engine = SimpleNamespace(index_manifest=None, segment_generation=0, store=SimpleNamespace())
+    assert index_version(engine) is None
+
+    cache = QueryCache()
+    cache.set_version(index_version(engine))
+    cache.put("key", "value")
+    assert cache.get("key") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_doc_store_build_id_is_the_fallback_version(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    engine = SimpleNamespace(index_manifest=None, segment_generation=2,
+                             store=SimpleNamespace(manifest={"build_id": "abc"}))
+    assert index_version(engine) == "store:abc:2"
+
+    cache = QueryCache()
+    cache.set_version(index_version(engine))
+    cache.put("key", "value")
+    assert cache.get("key") == "value"
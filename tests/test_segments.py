@@ -0,0 +1,108 @@
+"""
+Incremental updates (segments.py) over a small index built in a temp dir.
+
+Usage (from the repo root):
+    python -m pytest tests
+"""
+
+import os
+import pickle
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pandas as pd
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from doc_store import STORE_COLUMNS, as_column_store, load_corpus, write_doc_store
+from index_store import load_index, read_manifest, write_index
+from segments import SegmentWriter, attach_segments
+
+TEXTS = [
+    "the pink tower trains the visual sense of dimension",
+    "children work with the brown stair and the red rods",
+    "practical life exercises build concentration and independence",
+    "the teacher observes the child before presenting a material",
+]
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    corpus = pd.DataFrame({
+        "doc_id": [f"doc_{i}" for i in range(len(TEXTS))],
+        "text": TEXTS,
+        "raw_text": TEXTS,
+        "paragraph_index": range(len(TEXTS)),
+    })
+    for col in STORE_COLUMNS:
+        if col not in corpus:
+            corpus[col] = None
+    corpus_file = str(tmp_path / "corpus.csv")
+    corpus.to_csv(corpus_file, index=False)
+
+    vectorizer = TfidfVectorizer()
+    matrix = vectorizer.fit_transform(TEXTS)
+    vectorizer_file = str(tmp_path / "vectorizer.pkl")
+    with open(vectorizer_file, "wb") as f:
+        pickle.dump(vectorizer, f)
+
+    index_dir = str(tmp_path / "index")
+    write_index(matrix, corpus_file, vectorizer_file, index_dir)
+    write_doc_store(corpus, corpus_file, os.path.join(index_dir, "docs"))
+    return index_dir
+
+
+def open_engine_state(index_dir):
+    matrix = load_index(index_dir)[0]
+    corpus = load_corpus(None, os.path.join(index_dir, "docs"))
+    return attach_segments(matrix, corpus, read_manifest(index_dir), os.path.join(index_dir, "segments"))
+
+
+def live_doc_ids(state):
+    doc_ids = pd.Series(as_column_store(state.corpus).column("doc_id"))
+    return doc_ids[state.live_mask].tolist() if state.live_mask is not None else doc_ids.tolist()
+
+
+def writer_for(index_dir):
+    return SegmentWriter(index_dir, os.path.join(os.path.dirname(index_dir), "vectorizer.pkl"),
+                         background_merge=False)
+
+
+def test_delete_then_add_same_doc_id(index_dir):
+    writer = writer_for(index_dir)
+    assert writer.delete_documents(["doc_0", "no_such_doc"]) == ["doc_0"]
+    writer.add_documents(pd.DataFrame({"doc_id": ["doc_0"], "text": ["a new pink tower passage"]}))
+
+    state = open_engine_state(index_dir)
+    assert state.matrix.shape[0] == len(TEXTS) + 1
+    assert int(state.live_mask.sum()) == len(TEXTS)
+    assert sorted(live_doc_ids(state)) == sorted(f"doc_{i}" for i in range(len(TEXTS)))
+    # the re-added row is the live one
+    assert state.live_mask[-1] and not state.live_mask[0]
+
+    # deleting it again hides the new row too
+    assert writer.delete_documents(["doc_0"]) == ["doc_0"]
+    assert "doc_0" not in live_doc_ids(open_engine_state(index_dir))
+
+
+def test_merge_with_only_base_tombstones(index_dir):
+    writer = writer_for(index_dir)
+    writer.delete_documents(["doc_1"])
+    writer.merge()
+
+    state = open_engine_state(index_dir)
+    assert writer.state["segments"] == []
+    assert "doc_1" not in live_doc_ids(state)
+    assert len(live_doc_ids(state)) == len(TEXTS) - 1
+
+
+def test_merge_drops_deleted_delta_rows(index_dir):
+    writer = writer_for(index_dir)
+    writer.add_documents(pd.DataFrame({"doc_id": ["new_0"], "text": ["sandpaper letters"]}))
+    writer.add_documents(pd.DataFrame({"doc_id": ["new_1"], "text": ["the moveable alphabet"]}))
+    writer.delete_documents(["new_0", "doc_2"])
+    writer.merge()
+
+    assert len(writer.state["segments"]) == 1
+    assert [t["doc_id"] for t in writer.state["tombstones"]] == ["doc_2"]
+    assert sorted(live_doc_ids(open_engine_state(index_dir))) == ["doc_0", "doc_1", "doc_3", "new_1"]